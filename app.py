@@ -1,67 +1,667 @@
+import atexit
+import base64
+import csv
+import hashlib
+import io
+import json
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+import queue
+import re
+import select
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, has_request_context
 import psycopg2
-from datetime import datetime
+import psycopg2.errors
+from psycopg2 import extensions, pool as pg_pool
+from psycopg2.extras import execute_values
+from datetime import date, datetime, timedelta
+import click
+import numpy as np
 from werkzeug.security import generate_password_hash, check_password_hash
 
+from forecast import build_forecast
+
 DATABASE_URL = os.environ.get('DATABASE_URL')
-print("DATABASE_URL:", DATABASE_URL)
+
+# Connection pool sizing. DB_POOL_MAX is per worker process, so keep
+# workers * DB_POOL_MAX below the Postgres max_connections setting.
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_POOL_CHECK_AFTER = float(os.environ.get('DB_POOL_CHECK_AFTER', 30))
+
+# Report the number of SQL statements a request ran in an X-Query-Count
+# response header (used by bench.py), and app/db/pool time in Server-Timing
+QUERY_COUNT_HEADER = os.environ.get('QUERY_COUNT_HEADER', '0') == '1'
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+
+# Development profiling: statements slower than SLOW_QUERY_MS are logged with
+# an EXPLAIN (ANALYZE, BUFFERS) plan, and statements repeated within one
+# request are flagged. The last QUERY_LOG_SIZE entries show at /debug/queries.
+QUERY_PROFILING = os.environ.get('QUERY_PROFILING', '0') == '1'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+QUERY_LOG_SIZE = int(os.environ.get('QUERY_LOG_SIZE', 200))
+
+# Bearer token required by /metrics; left unset, /metrics is only served
+# to a logged-in admin
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Password hashing. New hashes use PASSWORD_HASH_METHOD (a werkzeug method
+# string such as 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'), and stored
+# hashes made with other parameters are rehashed on the next login. Hashing
+# runs on AUTH_HASH_WORKERS threads with at most AUTH_HASH_QUEUE logins
+# waiting; past that /auth answers 503 straight away.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+AUTH_HASH_WORKERS = int(os.environ.get('AUTH_HASH_WORKERS', 2))
+AUTH_HASH_QUEUE = int(os.environ.get('AUTH_HASH_QUEUE', 16))
+
+# Serving mode: 'sync' serves this Flask app on threaded workers; 'async'
+# serves asgi:app on uvicorn workers, with the dashboard and notification
+# endpoints on an asyncpg pool and the rest of the app on a thread pool
+# (see asgi.py and gunicorn.conf.py)
+SERVER_MODE = os.environ.get('SERVER_MODE', 'sync')
+ASYNC_DB_POOL_MAX = int(os.environ.get('ASYNC_DB_POOL_MAX', 20))
+ASYNC_WSGI_THREADS = int(os.environ.get('ASYNC_WSGI_THREADS', 16))
+
+# Activity log writer: entries are queued and written in batches of up to
+# ACTIVITY_BATCH_SIZE, at least every ACTIVITY_FLUSH_SECONDS
+ACTIVITY_WRITER_ENABLED = os.environ.get('ACTIVITY_WRITER_ENABLED', '1') == '1'
+ACTIVITY_BATCH_SIZE = int(os.environ.get('ACTIVITY_BATCH_SIZE', 500))
+ACTIVITY_FLUSH_SECONDS = float(os.environ.get('ACTIVITY_FLUSH_SECONDS', 1))
+ACTIVITY_QUEUE_SIZE = int(os.environ.get('ACTIVITY_QUEUE_SIZE', 10000))
+
+# Expiry engine: how often Purchase.status and the stock/expiry alerts are
+# reconciled besides the run at day rollover, how long the alert check for
+# the products a stock write touched waits for further writes, and how
+# close to expiry a batch is 'near expiry'.
+EXPIRY_ENGINE_ENABLED = os.environ.get('EXPIRY_ENGINE_ENABLED', '1') == '1'
+EXPIRY_INTERVAL_SECONDS = int(os.environ.get('EXPIRY_INTERVAL_SECONDS', 900))
+EXPIRY_WAKE_DELAY_SECONDS = float(os.environ.get('EXPIRY_WAKE_DELAY_SECONDS', 2))
+NEAR_EXPIRY_DAYS = 7
+EXPIRY_LOCK_ID = 742001
+
+# Stock ledger: days between the per-batch snapshots that point-in-time
+# stock queries start from
+STOCK_SNAPSHOT_INTERVAL_DAYS = int(os.environ.get('STOCK_SNAPSHOT_INTERVAL_DAYS', 7))
+STOCK_SNAPSHOT_LOCK_ID = 742003
+
+# Stock-flow rollups: the per-type daily table is rolled through the day
+# before yesterday; /api/stock-flow caps a request at STOCK_FLOW_MAX_DAYS
+STOCK_FLOW_LOCK_ID = 742004
+STOCK_FLOW_MAX_DAYS = int(os.environ.get('STOCK_FLOW_MAX_DAYS', 3660))
+
+# Consumption forecast (see forecast.py): days of order history averaged,
+# replenishment lead time and service-level z-score behind the reorder
+# point, days of demand a suggested order covers, and how long a worker
+# serves a report before rebuilding it in the background
+FORECAST_LOOKBACK_DAYS = int(os.environ.get('FORECAST_LOOKBACK_DAYS', 90))
+FORECAST_LEAD_TIME_DAYS = int(os.environ.get('FORECAST_LEAD_TIME_DAYS', 7))
+FORECAST_SERVICE_Z = float(os.environ.get('FORECAST_SERVICE_Z', 1.65))
+FORECAST_COVER_DAYS = int(os.environ.get('FORECAST_COVER_DAYS', 30))
+FORECAST_TTL_SECONDS = float(os.environ.get('FORECAST_TTL_SECONDS', 900))
+
+# /search: results per request, statement timeout, and the minimum
+# word similarity (0-1) for a fuzzy match
+SEARCH_LIMIT = 20
+SEARCH_TIMEOUT_MS = int(os.environ.get('SEARCH_TIMEOUT_MS', 300))
+SEARCH_SIMILARITY = float(os.environ.get('SEARCH_SIMILARITY', 0.3))
+
+# Bulk import: how many per-row errors a report lists
+IMPORT_MAX_ERRORS = 1000
+
+# Rows fetched per round trip by the streaming exports
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 2000))
+
+# Most lines accepted by one /orders/batch request
+ORDER_BATCH_MAX_LINES = int(os.environ.get('ORDER_BATCH_MAX_LINES', 200))
+
+# Rows per page on the product, purchase and order lists
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 50))
+LIST_PAGE_MAX = 500
+
+# How long a worker reuses the dashboard summary before re-reading it
+DASHBOARD_CACHE_TTL = float(os.environ.get('DASHBOARD_CACHE_TTL', 10))
+
+# How often a worker checks whether its cached reference data (categories,
+# product pick-lists) is behind the version bumped by product writes
+REFERENCE_CHECK_SECONDS = float(os.environ.get('REFERENCE_CHECK_SECONDS', 5))
+
+# Seconds of overlap re-sent by the incremental /notification-json feed
+NOTIFICATION_FEED_OVERLAP = int(os.environ.get('NOTIFICATION_FEED_OVERLAP', 5))
+
+# LISTEN/NOTIFY channel behind /notification-stream, and how often an idle
+# stream sends a keep-alive comment
+NOTIFICATION_CHANNEL = 'notification_events'
+SSE_HEARTBEAT_SECONDS = int(os.environ.get('SSE_HEARTBEAT_SECONDS', 25))
+
+# In sync mode each open stream holds a request thread until its next
+# heartbeat fails, so pages only open the stream in async mode and a sync
+# worker refuses streams past SSE_MAX_CLIENTS (clients keep polling)
+SSE_MAX_CLIENTS = int(os.environ.get('SSE_MAX_CLIENTS', 4))
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev_secret_key')
+app.jinja_env.globals['notification_stream_enabled'] = SERVER_MODE == 'async'
+
+
+class InstrumentedCursor(extensions.cursor):
+    """Cursor that times the statements run on behalf of the current request."""
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            if has_request_context():
+                elapsed = time.perf_counter() - start
+                record_query(query, elapsed)
+                if QUERY_PROFILING:
+                    profile_query(self, query, vars, elapsed)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            if has_request_context():
+                record_query(query, time.perf_counter() - start)
+
+
+def record_query(query, seconds):
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    words = query.split(None, 1) if isinstance(query, str) else None
+    verb = words[0].upper() if words else 'OTHER'
+    g.query_count = g.get('query_count', 0) + 1
+    g.query_seconds = g.get('query_seconds', 0.0) + seconds
+    by_verb = g.setdefault('query_verbs', {})
+    count, total = by_verb.get(verb, (0, 0.0))
+    by_verb[verb] = (count + 1, total + seconds)
+
+
+query_log = deque(maxlen=QUERY_LOG_SIZE)
+_query_log_lock = threading.Lock()
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'VALUES')
+
+
+def query_text(query, conn):
+    if isinstance(query, bytes):
+        return query.decode('utf-8', 'replace')
+    if isinstance(query, str):
+        return query
+    return query.as_string(conn)
+
+
+def query_call_site():
+    # Innermost frame in this module outside the cursor/profiling code
+    here = os.path.abspath(__file__)
+    for frame in reversed(traceback.extract_stack()):
+        if os.path.abspath(frame.filename) == here and frame.name not in (
+                'execute', 'executemany', 'profile_query', 'query_call_site'):
+            return f"{frame.name}:{frame.lineno}"
+    return None
+
+
+def add_query_log(entry):
+    entry['route'] = request_route()
+    entry['logged_at'] = datetime.now().isoformat(timespec='seconds')
+    with _query_log_lock:
+        query_log.append(entry)
+
+
+def profile_query(cursor, query, vars, seconds):
+    conn = cursor.connection
+    sql = ' '.join(query_text(query, conn).split())
+    try:
+        statement = cursor.mogrify(query, vars).decode('utf-8', 'replace')
+    except Exception:
+        statement = sql
+
+    seen = g.setdefault('query_seen', {})
+    if statement in seen:
+        seen[statement][0] += 1
+    else:
+        seen[statement] = [1, None]
+    if seen[statement][0] == 2:
+        seen[statement][1] = query_call_site()
+
+    if seconds * 1000 < SLOW_QUERY_MS:
+        return
+    call_site = query_call_site()
+    plan = explain_analyze(conn, query, vars)
+    add_query_log({
+        'kind': 'slow',
+        'ms': round(seconds * 1000, 2),
+        'sql': sql,
+        'params': repr(vars) if vars is not None else None,
+        'call_site': call_site,
+        'plan': plan,
+    })
+    print(f"Slow query ({seconds * 1000:.1f} ms) at {call_site}: {sql[:200]}")
+
+
+def explain_analyze(conn, query, vars):
+    # EXPLAIN ANALYZE runs the statement again, so it is wrapped in a
+    # savepoint that is rolled back; the request's own changes are untouched
+    words = query_text(query, conn).split(None, 1)
+    if not words or words[0].upper() not in EXPLAINABLE:
+        return None
+    if conn.autocommit or conn.get_transaction_status() != extensions.TRANSACTION_STATUS_INTRANS:
+        return None
+    c = conn.cursor(cursor_factory=extensions.cursor)
+    c.execute("SAVEPOINT query_profile")
+    try:
+        c.execute("EXPLAIN (ANALYZE, BUFFERS) " + query_text(query, conn), vars)
+        plan = '\n'.join(row[0] for row in c.fetchall())
+    except Exception as e:
+        plan = f"EXPLAIN failed: {str(e)}"
+    c.execute("ROLLBACK TO SAVEPOINT query_profile")
+    c.execute("RELEASE SAVEPOINT query_profile")
+    return plan
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    """In-process counters and histograms, rendered in Prometheus text format.
+
+    Values are per worker process; Prometheus sums them across workers.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def render(self, gauges=()):
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self._histograms.items())
+
+        described = set()
+
+        def header(name):
+            if name in self._help and name not in described:
+                kind, text = self._help[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+
+        for (name, labels), value in counters:
+            header(name)
+            lines.append(f"{name}{format_labels(labels)} {value:g}")
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name)
+            for bound, bucket in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{bound:g}'),))} {bucket}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {total:g}")
+            lines.append(f"{name}_count{format_labels(labels)} {count}")
+        for name, value in gauges:
+            header(name)
+            lines.append(f"{name} {value:g}")
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+metrics = Metrics()
+metrics.describe('medisync_http_requests_total', 'counter', 'Requests handled, by route, method and status.')
+metrics.describe('medisync_http_errors_total', 'counter', 'Requests that raised or returned a 5xx, by route.')
+metrics.describe('medisync_http_request_duration_seconds', 'histogram', 'Request latency by route.')
+metrics.describe('medisync_db_request_seconds', 'histogram', 'Time spent in SQL per request, by route.')
+metrics.describe('medisync_db_statements_total', 'counter', 'SQL statements run by requests, by route and verb.')
+metrics.describe('medisync_db_statement_seconds_total', 'counter', 'Time spent in SQL statements, by route and verb.')
+metrics.describe('medisync_db_pool_wait_seconds', 'histogram', 'Time a request waited for a pooled connection.')
+metrics.describe('medisync_db_pool_in_use', 'gauge', 'Connections checked out of the pool.')
+metrics.describe('medisync_db_pool_idle', 'gauge', 'Idle connections in the pool.')
+metrics.describe('medisync_db_pool_max', 'gauge', 'Pool size limit.')
+metrics.describe('medisync_db_pool_timeouts_total', 'counter', 'Checkouts that timed out waiting for a connection.')
+metrics.describe('medisync_stream_clients', 'gauge', 'Open /notification-stream connections.')
+metrics.describe('medisync_auth_hash_rejected_total', 'counter', 'Logins turned away with 503 because hashing was saturated.')
+metrics.describe('medisync_activity_queue_depth', 'gauge', 'Activity log entries waiting to be written.')
+
+
+class ConnectionPool:
+    """Thread-safe, bounded pool of psycopg2 connections.
+
+    Callers block for up to ``timeout`` seconds when every connection is
+    checked out. Connections idle for longer than ``check_after`` seconds
+    are pinged before being handed out, and broken ones are replaced.
+    """
+
+    def __init__(self, dsn, minconn, maxconn, timeout, check_after):
+        self._pool = pg_pool.ThreadedConnectionPool(minconn, maxconn, dsn, cursor_factory=InstrumentedCursor)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_after = check_after
+        self.checkouts = 0
+        self.in_use = 0
+        self.timeouts = 0
+        self.replaced = 0
+        self.wait_seconds = 0.0
+
+    def getconn(self):
+        start = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise pg_pool.PoolError('Timed out waiting for a database connection')
+        try:
+            conn = self._pool.getconn()
+            if not self._is_healthy(conn):
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+                with self._lock:
+                    self.replaced += 1
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.checkouts += 1
+            self.in_use += 1
+            self.wait_seconds += time.monotonic() - start
+        return conn
+
+    def putconn(self, conn):
+        close = bool(conn.closed)
+        try:
+            if not close and conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                # Never hand a connection with an open transaction to the next request
+                conn.rollback()
+        except Exception:
+            close = True
+        try:
+            self._pool.putconn(conn, close=close)
+        finally:
+            with self._lock:
+                self.in_use -= 1
+                if close:
+                    self._last_used.pop(id(conn), None)
+                else:
+                    self._last_used[id(conn)] = time.monotonic()
+            self._slots.release()
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn))
+        if last_used is not None and time.monotonic() - last_used < self.check_after:
+            return True
+        try:
+            with conn.cursor() as c:
+                c.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max_size': self.maxconn,
+                'in_use': self.in_use,
+                'idle': len(self._pool._pool),
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'replaced': self.replaced,
+                'wait_seconds_total': round(self.wait_seconds, 6),
+            }
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+_expiry_reconciled_on = None
+
+
+def get_pool():
+    # Created lazily so every gunicorn worker builds its own pool after fork
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = ConnectionPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX,
+                                          DB_POOL_TIMEOUT, DB_POOL_CHECK_AFTER)
+    return _db_pool
+
+
+def get_db():
+    # One pooled connection per request, returned in close_db()
+    if 'db_conn' not in g:
+        start = time.perf_counter()
+        g.db_conn = get_pool().getconn()
+        g.pool_wait = time.perf_counter() - start
+        metrics.observe('medisync_db_pool_wait_seconds', {}, g.pool_wait)
+    return g.db_conn
+
+
+@app.teardown_appcontext
+def close_db(exception):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_pool().putconn(conn)
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def request_route():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@app.after_request
+def add_timing_headers(response):
+    g.response_status = response.status_code
+    if QUERY_COUNT_HEADER:
+        response.headers['X-Query-Count'] = str(g.get('query_count', 0))
+    if SERVER_TIMING and 'request_started' in g:
+        elapsed = time.perf_counter() - g.request_started
+        response.headers['Server-Timing'] = ', '.join([
+            f"app;dur={elapsed * 1000:.1f}",
+            f"db;dur={g.get('query_seconds', 0.0) * 1000:.1f};desc=\"{g.get('query_count', 0)} queries\"",
+            f"pool;dur={g.get('pool_wait', 0.0) * 1000:.1f}",
+        ])
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exception):
+    if 'request_started' not in g:
+        return
+    route = request_route()
+    status = 500 if exception else g.get('response_status', 500)
+    metrics.inc('medisync_http_requests_total', {'route': route, 'method': request.method, 'status': status})
+    metrics.observe('medisync_http_request_duration_seconds', {'route': route},
+                    time.perf_counter() - g.request_started)
+    if status >= 500:
+        metrics.inc('medisync_http_errors_total', {'route': route})
+    if 'query_count' in g:
+        metrics.observe('medisync_db_request_seconds', {'route': route}, g.query_seconds)
+        for verb, (count, seconds) in g.query_verbs.items():
+            metrics.inc('medisync_db_statements_total', {'route': route, 'verb': verb}, count)
+            metrics.inc('medisync_db_statement_seconds_total', {'route': route, 'verb': verb}, seconds)
+
+
+@app.teardown_request
+def log_repeated_queries(exception):
+    for statement, (count, call_site) in g.get('query_seen', {}).items():
+        if count > 1:
+            add_query_log({
+                'kind': 'repeated',
+                'count': count,
+                'sql': ' '.join(statement.split()),
+                'call_site': call_site,
+            })
 
 
-def init_db():
-    conn = None
+@contextmanager
+def db_connection():
+    # For code that runs outside a request (startup, background threads)
+    conn = get_pool().getconn()
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        yield conn
+    finally:
+        get_pool().putconn(conn)
 
-        c = conn.cursor()
 
-        c.execute("""CREATE TABLE IF NOT EXISTS users (
-            id SERIAL PRIMARY KEY,
-            username TEXT UNIQUE NOT NULL,
-            password TEXT NOT NULL,
-            full_name TEXT NOT NULL,
-            role TEXT DEFAULT 'staff',
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        """)
+def init_db():
+    with db_connection() as conn:
+        apply_migrations(conn)
 
-        c.execute('''CREATE TABLE IF NOT EXISTS user_activity (
-            id SERIAL PRIMARY KEY,
-            username TEXT NOT NULL,
-            activity TEXT NOT NULL,
-            activity_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )''')
 
+# Schema migrations: migrations/NNNN_name.sql, applied in order, each in its
+# own transaction and recorded in schema_migrations. Migrations are written
+# to be idempotent so a database created before they existed is adopted.
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_LOCK_ID = 742002
 
-        c.execute('''CREATE TABLE IF NOT EXISTS Category (
-            id SERIAL PRIMARY KEY,
-            category_name TEXT NOT NULL,
-            created_at DATE DEFAULT CURRENT_DATE
-        )''')
-        
-        c.execute('''CREATE TABLE IF NOT EXISTS Product (
-            id SERIAL PRIMARY KEY,
-            product_name TEXT NOT NULL,
-            product_type TEXT NOT NULL,
-            category_id INTEGER REFERENCES Category(id),
-            stock_quantity INTEGER NOT NULL DEFAULT 0,
-            stock_status TEXT DEFAULT 'in stock',
-            status TEXT DEFAULT 'active',
-            created_at DATE DEFAULT CURRENT_DATE
-        )''')
-        
+
+def load_migrations():
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r'^(\d+)_(\w+)\.sql$', filename)
+        if not match:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename), encoding='utf-8') as f:
+            migrations.append((int(match.group(1)), match.group(2), f.read()))
+    return migrations
+
+
+def apply_migrations(conn):
+    c = conn.cursor()
+    applied = []
+    # Concurrent deploys wait for each other instead of racing the DDL
+    c.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+    try:
+        c.execute("""CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""")
         conn.commit()
-        print("Database initialization schema check complete.")
-    except Exception as e:
-        print(f"Error initializing database: {str(e)}")
-        if conn:
-            conn.rollback()
+
+        c.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in c.fetchall()}
+        for version, name, sql in load_migrations():
+            if version in done:
+                continue
+            try:
+                c.execute(sql)
+                c.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Error applying migration {version:04d}_{name}: {str(e)}")
+                raise
+            print(f"Applied migration {version:04d}_{name}")
+            applied.append(version)
     finally:
-        if conn is not None:
-            conn.close()
+        c.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+        conn.commit()
+    return applied
+
+
+# The hot queries and the index each one must use. Checked by
+# `flask db-verify-plans` with sequential scans disabled, so a missing or
+# unusable index shows up as a Seq Scan in the plan whatever the table size.
+PLAN_CHECKS = [
+    ('fefo allocation', 'purchase_fefo_idx', """
+        SELECT id FROM Purchase
+        WHERE product_id = 1 AND remaining_quantity > 0 AND expiration_date > CURRENT_DATE
+        ORDER BY expiration_date, id"""),
+    ('batch lookup', 'purchase_product_batch_idx', """
+        SELECT remaining_quantity FROM Purchase WHERE product_id = 1 AND batch_number = 'B000001'"""),
+    ('order batch lookup', 'order_product_batch_idx', """
+        SELECT order_id FROM "Order" WHERE product_id = 1 AND batch_number = 'B000001'"""),
+    ('near expiry', 'purchase_near_expiry_idx', """
+        SELECT id FROM Purchase WHERE status = 'near expiry' ORDER BY expiration_date"""),
+    ('purchase date range', 'purchase_date_idx', """
+        SELECT id FROM Purchase WHERE purchase_date >= CURRENT_DATE - 7 ORDER BY purchase_date, id LIMIT 50"""),
+    ('order date range', 'order_date_idx', """
+        SELECT order_id FROM "Order" WHERE order_date >= CURRENT_DATE - 7 ORDER BY order_date, order_id LIMIT 50"""),
+    ('purchase page', 'purchase_page_date_idx', """
+        SELECT id FROM Purchase
+        WHERE (COALESCE(purchase_date, DATE '0001-01-01'), id) < ('2026-01-01', 1000)
+        ORDER BY COALESCE(purchase_date, DATE '0001-01-01') DESC, id DESC LIMIT 50"""),
+    ('order page', 'order_page_date_idx', """
+        SELECT order_id FROM "Order"
+        WHERE (COALESCE(order_date, DATE '0001-01-01'), order_id) < ('2026-01-01', 1000)
+        ORDER BY COALESCE(order_date, DATE '0001-01-01') DESC, order_id DESC LIMIT 50"""),
+    ('notification feed', 'notification_updated_at_idx', """
+        SELECT id FROM notification WHERE updated_at > NOW() - INTERVAL '1 day' ORDER BY updated_at, id"""),
+    ('recent notifications', 'notification_created_at_idx', """
+        SELECT id FROM notification WHERE created_at > NOW() - INTERVAL '1 day'"""),
+    ('open batch notifications', 'notification_batch_idx', """
+        SELECT id FROM notification WHERE ignored = FALSE AND product_id = 1 AND batch_id = 'B000001'"""),
+]
+
+
+def plan_nodes(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+
+def verify_query_plans(conn):
+    failures = []
+    c = conn.cursor()
+    try:
+        c.execute("SET LOCAL enable_seqscan = off")
+        for label, index, sql in PLAN_CHECKS:
+            c.execute("EXPLAIN (FORMAT JSON) " + sql)
+            plan = c.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            nodes = list(plan_nodes(plan[0]['Plan']))
+            if any(n['Node Type'] == 'Seq Scan' for n in nodes):
+                failures.append(f"{label}: sequential scan")
+            elif not any(n.get('Index Name') == index for n in nodes):
+                failures.append(f"{label}: {index} not used")
+    finally:
+        conn.rollback()
+    return failures
+
 
 # Login required decorator
 def login_required(f):
@@ -73,9 +673,216 @@ def login_required(f):
     decorated_function.__name__ = f.__name__
     return decorated_function
 
+
+def admin_required(f):
+    def decorated_function(*args, **kwargs):
+        if 'logged_in' not in session:
+            flash('Please log in to access this page', 'error')
+            return redirect(url_for('login'))
+        if session.get('role') != 'admin':
+            flash('Administrator access required', 'error')
+            return redirect(url_for('dashboard'))
+        return f(*args, **kwargs)
+    decorated_function.__name__ = f.__name__
+    return decorated_function
+
+class HashQueueFull(Exception):
+    pass
+
+
+class HashExecutor:
+    """Runs password hashing on a fixed set of threads with a bounded backlog.
+
+    Keeps a burst of logins from tying up every request thread; callers
+    beyond the backlog get HashQueueFull instead of waiting.
+    """
+
+    def __init__(self, workers, queue_size):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self.workers = workers
+        self.queue_size = queue_size
+        self.completed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+
+    def run(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashQueueFull('Too many logins in progress')
+        try:
+            return self._executor.submit(self._timed, fn, *args, **kwargs).result()
+        finally:
+            self._slots.release()
+
+    def _timed(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.completed += 1
+                self.busy_seconds += time.perf_counter() - start
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'busy_seconds_total': round(self.busy_seconds, 3),
+            }
+
+
+hash_executor = None
+_hash_executor_lock = threading.Lock()
+
+
+def get_hash_executor():
+    global hash_executor
+    if hash_executor is None:
+        with _hash_executor_lock:
+            if hash_executor is None:
+                hash_executor = HashExecutor(AUTH_HASH_WORKERS, AUTH_HASH_QUEUE)
+    return hash_executor
+
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+
+# Hash method setting -> the prefix werkzeug writes for it: a short setting
+# like 'pbkdf2' comes out with its defaults filled in ('pbkdf2:sha256:...')
+_password_hash_prefixes = {}
+
+
+def password_needs_rehash(stored_hash):
+    method = PASSWORD_HASH_METHOD
+    prefix = _password_hash_prefixes.get(method)
+    if prefix is None:
+        prefix = generate_password_hash('', method=method).split('$', 1)[0]
+        _password_hash_prefixes[method] = prefix
+    return stored_hash.split('$', 1)[0] != prefix
+
+
+class ActivityWriter(threading.Thread):
+    """Buffers user_activity rows and writes them from a background thread.
+
+    Entries are flushed with one multi-row INSERT once ``max_batch`` are
+    queued or ``flush_interval`` seconds after the first one arrived. When
+    the queue is full new entries are dropped (and counted) rather than
+    slowing down requests.
+    """
+
+    _STOP = object()
+
+    def __init__(self, max_batch, flush_interval, max_queue):
+        super().__init__(name='activity-writer', daemon=True)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+
+    def submit(self, username, activity):
+        try:
+            self._queue.put_nowait((username, activity, datetime.now()))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            print(f"Activity queue full, dropped: {username} {activity}")
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self.write(batch)
+
+    def write(self, batch):
+        for attempt in range(3):
+            try:
+                with db_connection() as conn:
+                    c = conn.cursor()
+                    execute_values(c, """
+                        INSERT INTO user_activity (username, activity, activity_time)
+                        VALUES %s
+                    """, batch, page_size=len(batch))
+                    conn.commit()
+                with self._lock:
+                    self.written += len(batch)
+                    self.flushes += 1
+                return
+            except Exception as e:
+                print(f"Error writing activity batch (attempt {attempt + 1}): {e}")
+                time.sleep(0.5 * (attempt + 1))
+        with self._lock:
+            self.failed_flushes += 1
+            self.dropped += len(batch)
+        for username, activity, activity_time in batch:
+            print(f"Lost activity: {activity_time} {username} {activity}")
+
+    def stop(self, timeout=10):
+        # Queued entries ahead of the sentinel are flushed before the thread exits
+        try:
+            self._queue.put(self._STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'written': self.written,
+                'dropped': self.dropped,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+            }
+
+
+activity_writer = None
+_activity_writer_lock = threading.Lock()
+
+
+def get_activity_writer():
+    global activity_writer
+    if activity_writer is None:
+        with _activity_writer_lock:
+            if activity_writer is None:
+                activity_writer = ActivityWriter(ACTIVITY_BATCH_SIZE, ACTIVITY_FLUSH_SECONDS,
+                                                 ACTIVITY_QUEUE_SIZE)
+                activity_writer.start()
+                atexit.register(activity_writer.stop)
+    return activity_writer
+
+
 def log_activity(username, activity):
+    if ACTIVITY_WRITER_ENABLED:
+        get_activity_writer().submit(username, activity)
+        return
+
+    conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
         c.execute("""
@@ -85,81 +892,1365 @@ def log_activity(username, activity):
         conn.commit()
     except Exception as e:
         print(f"Error logging activity: {e}")
-    finally:
         if conn:
-            conn.close()
+            conn.rollback()
 
-def update_expiry_status():
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
+# Purchase.status as a function of a date expression. Used by the expiry
+# engine and by purchase writes so a batch never waits for the next run.
+def expiry_status_sql(date_expr):
+    return f"""CASE
+            WHEN {date_expr} <= CURRENT_DATE THEN 'expired'
+            WHEN {date_expr} <= CURRENT_DATE + {NEAR_EXPIRY_DAYS} THEN 'near expiry'
+            ELSE 'in stock'
+        END"""
+
+
+# Notification engine: one pass computes every alert that should be open
+# (low/out of stock per product against its low_stock_threshold, near-expiry
+# and expired per batch with stock left), retires open alerts that no longer
+# hold and raises the new ones. Alerts are keyed type:product_id:batch_id,
+# so a pass over unchanged stock writes nothing and an alert the user has
+# ignored stays quiet until its condition clears. With product_ids set the
+# pass only looks at those products' alerts.
+NOTIFICATION_ENGINE_SQL = """
+    WITH wanted AS (
+        SELECT CASE WHEN p.stock_quantity <= 0 THEN 'out-of-stock' ELSE 'low-stock' END AS type,
+               p.id AS product_id,
+               NULL::text AS batch_id,
+               CASE WHEN p.stock_quantity <= 0
+                    THEN p.product_name || ' is out of stock.'
+                    ELSE p.product_name || ' is running low: ' || p.stock_quantity
+                         || ' left (threshold ' || p.low_stock_threshold || ').'
+               END AS message
+        FROM Product p
+        WHERE p.status = 'active'
+            AND (p.stock_quantity <= 0 OR p.stock_quantity < p.low_stock_threshold)
+            AND (%(product_ids)s::int[] IS NULL OR p.id = ANY(%(product_ids)s::int[]))
+        UNION ALL
+        SELECT CASE WHEN pu.expiration_date <= CURRENT_DATE THEN 'expired' ELSE 'near-expiry' END,
+               pu.product_id,
+               pu.batch_number,
+               'Batch ' || pu.batch_number || ' of ' || p.product_name
+                   || CASE WHEN pu.expiration_date <= CURRENT_DATE THEN ' expired on ' ELSE ' expires on ' END
+                   || to_char(pu.expiration_date, 'YYYY-MM-DD')
+                   || ' (' || pu.remaining_quantity || ' left).'
+        FROM Purchase pu
+        JOIN Product p ON p.id = pu.product_id
+        WHERE pu.remaining_quantity > 0
+            AND pu.expiration_date <= CURRENT_DATE + %(near_expiry_days)s
+            AND p.status = 'active'
+            AND (%(product_ids)s::int[] IS NULL OR pu.product_id = ANY(%(product_ids)s::int[]))
+    ),
+    keyed AS (
+        SELECT w.*, w.type || ':' || w.product_id || ':' || COALESCE(w.batch_id, '') AS dedup_key
+        FROM wanted w
+    ),
+    resolved AS (
+        UPDATE notification n
+        SET resolved_at = NOW(), ignored = TRUE
+        WHERE n.resolved_at IS NULL
+            AND n.dedup_key IS NOT NULL
+            AND (%(product_ids)s::int[] IS NULL OR n.product_id = ANY(%(product_ids)s::int[]))
+            AND NOT EXISTS (SELECT 1 FROM keyed k WHERE k.dedup_key = n.dedup_key)
+        RETURNING n.id
+    ),
+    raised AS (
+        INSERT INTO notification (message, type, product_id, batch_id, dedup_key)
+        SELECT k.message, k.type, k.product_id, k.batch_id, k.dedup_key
+        FROM keyed k
+        WHERE NOT EXISTS (
+            SELECT 1 FROM notification n
+            WHERE n.dedup_key = k.dedup_key AND n.resolved_at IS NULL
+        )
+        -- A retired alert whose condition is back is re-opened as new
+        ON CONFLICT (dedup_key) DO UPDATE
+        SET message = EXCLUDED.message,
+            is_read = FALSE,
+            ignored = FALSE,
+            resolved_at = NULL,
+            last_notified = NULL,
+            created_at = CURRENT_TIMESTAMP
+        RETURNING id
+    )
+    SELECT (SELECT COUNT(*) FROM raised), (SELECT COUNT(*) FROM resolved)
+"""
+
+
+def generate_notifications(conn, product_ids=None):
+    # Runs in the caller's transaction; returns (raised, resolved)
+    c = conn.cursor()
+    c.execute(NOTIFICATION_ENGINE_SQL, {'near_expiry_days': NEAR_EXPIRY_DAYS,
+                                        'product_ids': product_ids})
+    return c.fetchone()
 
-        c = conn.cursor()
 
-        # Expired: expiration_date < today
-        c.execute("""
-            UPDATE Purchase
-            SET status = 'expired'
-            WHERE expiration_date <= CURRENT_DATE
-        """)
+def reconcile_product_alerts(conn, product_ids):
+    # Alerts for the products a write touched. Purchase.status is already
+    # set by the write itself, so this is the alert part of a full pass
+    # only. Waits for a full pass in progress rather than racing its inserts.
+    c = conn.cursor()
+    c.execute("SELECT pg_advisory_xact_lock(%s)", (EXPIRY_LOCK_ID,))
+    raised, resolved = generate_notifications(conn, sorted(product_ids))
+    conn.commit()
+    if raised or resolved:
+        print(f"Alerts for {len(product_ids)} products: {raised} raised, {resolved} resolved")
 
-        # Near expiry: expires within 7 days
-        c.execute("""
-            UPDATE Purchase
-            SET status = 'near expiry'
-            WHERE expiration_date > CURRENT_DATE
-              AND expiration_date <= CURRENT_DATE + INTERVAL '7 days'
-              AND status != 'expired'
-        """)
 
-        # In stock: expires later
+def reconcile_expiry(conn):
+    global _expiry_reconciled_on
+    c = conn.cursor()
+
+    # Only one worker reconciles at a time; the others keep serving
+    c.execute("SELECT pg_try_advisory_xact_lock(%s)", (EXPIRY_LOCK_ID,))
+    if not c.fetchone()[0]:
+        conn.rollback()
+        return False
+
+    # Only rows whose status actually changes are written
+    status = expiry_status_sql('expiration_date')
+    c.execute(f"""
+        UPDATE Purchase
+        SET status = {status}
+        WHERE status IS DISTINCT FROM {status}
+    """)
+    purchases_changed = c.rowcount
+
+    raised, resolved = generate_notifications(conn)
+
+    c.execute("""
+        INSERT INTO app_state (key, value, updated_at)
+        VALUES ('expiry_reconciled_on', CURRENT_DATE::text, NOW())
+        ON CONFLICT (key) DO UPDATE
+        SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+        RETURNING value
+    """)
+    reconciled_on = c.fetchone()[0]
+    conn.commit()
+
+    _expiry_reconciled_on = reconciled_on
+    if purchases_changed:
+        invalidate_dashboard(conn)
+    print(f"Expiry reconciled: {purchases_changed} purchases updated, "
+          f"{raised} notifications raised, {resolved} resolved")
+    return True
+
+
+def ensure_expiry_reconciled():
+    # Cheap guard for read routes: a no-op once today's reconcile has run,
+    # whichever worker ran it. Only does the work if the engine is behind.
+    global _expiry_reconciled_on
+    if _expiry_reconciled_on == datetime.now().date().isoformat():
+        return
+    conn = get_db()
+    try:
+        c = conn.cursor()
         c.execute("""
-            UPDATE Purchase
-            SET status = 'in stock'
-            WHERE expiration_date > CURRENT_DATE + INTERVAL '7 days'
-              AND status NOT IN ('expired', 'near expiry')
+            SELECT value = CURRENT_DATE::text
+            FROM app_state
+            WHERE key = 'expiry_reconciled_on'
         """)
+        row = c.fetchone()
+        conn.rollback()
+        if row and row[0]:
+            _expiry_reconciled_on = datetime.now().date().isoformat()
+            return
+        reconcile_expiry(conn)
+    except Exception as e:
+        print(f"Error checking expiry watermark: {e}")
+        conn.rollback()
+
+
+# Stock per batch from the ledger (see migrations 0009 and 0013) as of %(at)s: the
+# nearest snapshot at or before it plus only the movements after that.
+# Optionally narrowed to %(product_id)s.
+LEDGER_BALANCE_SQL = """
+    SELECT m.product_id, m.batch_number, SUM(m.quantity) AS quantity
+    FROM (
+        SELECT s.product_id, s.batch_number, s.quantity
+        FROM stock_snapshot s
+        WHERE s.snapshot_date = (SELECT MAX(snapshot_date) FROM stock_snapshot_run
+                                 WHERE snapshot_date <= %(at)s)
+            AND (%(product_id)s::int IS NULL OR s.product_id = %(product_id)s)
+        UNION ALL
+        SELECT m.product_id, m.batch_number, m.quantity
+        FROM stock_movement m
+        WHERE m.moved_at >= COALESCE((SELECT MAX(snapshot_date) FROM stock_snapshot_run
+                                      WHERE snapshot_date <= %(at)s), '-infinity')
+            AND m.moved_at < %(at)s
+            AND (%(product_id)s::int IS NULL OR m.product_id = %(product_id)s)
+    ) m
+    GROUP BY m.product_id, m.batch_number
+"""
+
+
+def stock_as_of(conn, at, product_id=None, by_batch=True):
+    group = "l.product_id, p.product_name, l.batch_number" if by_batch else "l.product_id, p.product_name"
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT {group}, SUM(l.quantity)
+        FROM ({LEDGER_BALANCE_SQL}) l
+        LEFT JOIN Product p ON p.id = l.product_id
+        GROUP BY {group}
+        HAVING SUM(l.quantity) <> 0
+        ORDER BY {group}
+    """, {'at': at, 'product_id': product_id})
+    return c.fetchall()
+
+
+def take_stock_snapshots(conn):
+    # Each snapshot is the previous one plus the movements since, and dates
+    # are only snapshotted once a day has passed, so no transaction still
+    # open can add a movement before them. Catches up on missed dates.
+    c = conn.cursor()
+    c.execute("SELECT pg_try_advisory_xact_lock(%s)", (STOCK_SNAPSHOT_LOCK_ID,))
+    if not c.fetchone()[0]:
+        conn.rollback()
+        return []
+
+    c.execute("SELECT MAX(snapshot_date), CURRENT_DATE - 1 FROM stock_snapshot_run")
+    previous, latest_due = c.fetchone()
+    due = latest_due if previous is None else previous + timedelta(days=STOCK_SNAPSHOT_INTERVAL_DAYS)
+    taken = []
+    while due <= latest_due:
+        c.execute("INSERT INTO stock_snapshot_run (snapshot_date, batches) VALUES (%s, 0)", (due,))
+        c.execute("""
+            INSERT INTO stock_snapshot (snapshot_date, product_id, batch_number, quantity)
+            SELECT %(due)s, product_id, batch_number, SUM(quantity)
+            FROM (
+                SELECT product_id, batch_number, quantity
+                FROM stock_snapshot
+                WHERE snapshot_date = %(previous)s
+                UNION ALL
+                SELECT product_id, batch_number, quantity
+                FROM stock_movement
+                WHERE moved_at >= %(since)s AND moved_at < %(due)s
+            ) m
+            GROUP BY product_id, batch_number
+            HAVING SUM(quantity) <> 0
+        """, {'due': due, 'previous': previous, 'since': previous or '-infinity'})
+        batches = c.rowcount
+        c.execute("UPDATE stock_snapshot_run SET batches = %s WHERE snapshot_date = %s", (batches, due))
+        taken.append((due, batches))
+        previous, due = due, due + timedelta(days=STOCK_SNAPSHOT_INTERVAL_DAYS)
+    conn.commit()
+    return taken
 
-        conn.commit()
+
+def reconcile_stock_ledger(conn):
+    # Compare the mutable counters with the ledger in one pass: every
+    # batch's remaining_quantity and every product's stock_quantity.
+    # Returns (level, product_id, batch_number, counter, ledger) per mismatch.
+    c = conn.cursor()
+    c.execute(f"""
+        WITH ledger AS ({LEDGER_BALANCE_SQL}),
+        batches AS (
+            SELECT product_id, batch_number, SUM(remaining_quantity) AS quantity
+            FROM Purchase
+            GROUP BY product_id, batch_number
+        )
+        SELECT 'batch', COALESCE(b.product_id, l.product_id), COALESCE(b.batch_number, l.batch_number),
+               COALESCE(b.quantity, 0), COALESCE(l.quantity, 0)
+        FROM batches b
+        FULL JOIN ledger l ON l.product_id = b.product_id AND l.batch_number = b.batch_number
+        WHERE COALESCE(b.quantity, 0) <> COALESCE(l.quantity, 0)
+        UNION ALL
+        SELECT 'product', p.id, NULL, p.stock_quantity, COALESCE(l.quantity, 0)
+        FROM Product p
+        LEFT JOIN (SELECT product_id, SUM(quantity) AS quantity FROM ledger GROUP BY product_id) l
+            ON l.product_id = p.id
+        WHERE p.stock_quantity <> COALESCE(l.quantity, 0)
+        ORDER BY 2, 1, 3
+    """, {'at': 'infinity', 'product_id': None})
+    mismatches = c.fetchall()
+    conn.rollback()
+    return mismatches
+
+
+# Daily stock in/out per product_type for days between two SQL date
+# expressions (see migration 0010): the per-type rollup up to its watermark,
+# and stock_flow_daily for days after it or re-dirtied since.
+def stock_flow_days_sql(date_from, date_to):
+    return f"""
+        SELECT t.day, t.product_type, t.stock_in, t.stock_out
+        FROM stock_flow_daily_type t
+        WHERE t.day BETWEEN {date_from} AND {date_to}
+            AND t.day <= (SELECT value::date FROM app_state WHERE key = 'stock_flow_rolled_through')
+            AND NOT EXISTS (SELECT 1 FROM stock_flow_dirty_day d WHERE d.day = t.day)
+        UNION ALL
+        SELECT f.day, p.product_type, f.stock_in, f.stock_out
+        FROM stock_flow_daily f
+        JOIN Product p ON p.id = f.product_id
+        WHERE f.day BETWEEN {date_from} AND {date_to}
+            AND (f.day > COALESCE((SELECT value::date FROM app_state
+                                   WHERE key = 'stock_flow_rolled_through'), '-infinity')
+                 OR EXISTS (SELECT 1 FROM stock_flow_dirty_day d WHERE d.day = f.day))"""
+
+
+def stock_flow_series(conn, date_from, date_to, grain, product_id=None, product_type=None):
+    if product_id is not None:
+        # One product's days straight from its own rollup rows
+        source = """
+            SELECT f.day, p.product_type, f.stock_in, f.stock_out
+            FROM stock_flow_daily f
+            JOIN Product p ON p.id = f.product_id
+            WHERE f.product_id = %(product_id)s AND f.day BETWEEN %(from)s AND %(to)s"""
+    else:
+        source = stock_flow_days_sql('%(from)s', '%(to)s')
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT date_trunc(%(grain)s, flow.day)::date AS period, flow.product_type,
+               SUM(flow.stock_in), SUM(flow.stock_out)
+        FROM ({source}) flow
+        WHERE %(type)s::text IS NULL OR flow.product_type = %(type)s
+        GROUP BY period, flow.product_type
+        ORDER BY period, flow.product_type
+    """, {'from': date_from, 'to': date_to, 'grain': grain,
+          'product_id': product_id, 'type': product_type})
+    rows = c.fetchall()
+    conn.rollback()
+    return [{'period': row[0].isoformat(), 'product_type': row[1],
+             'stock_in': int(row[2]), 'stock_out': int(row[3])} for row in rows]
+
+
+def load_forecast_inputs(conn):
+    # Two set-based reads: per-product order totals over the lookback
+    # window from the daily rollups, and every open, unexpired batch
+    c = conn.cursor()
+    c.execute("""
+        SELECT p.id, p.product_name, p.product_type, p.stock_quantity,
+               LEAST(%(lookback)s, GREATEST(CURRENT_DATE - COALESCE(p.created_at, CURRENT_DATE) + 1, 1)),
+               COALESCE(f.out_sum, 0), COALESCE(f.out_sumsq, 0)
+        FROM Product p
+        LEFT JOIN (
+            SELECT product_id, SUM(stock_out)::float8 AS out_sum,
+                   SUM(stock_out * stock_out)::float8 AS out_sumsq
+            FROM stock_flow_daily
+            WHERE day > CURRENT_DATE - %(lookback)s AND day <= CURRENT_DATE AND stock_out <> 0
+            GROUP BY product_id
+        ) f ON f.product_id = p.id
+        WHERE p.status = 'active'
+        ORDER BY p.id
+    """, {'lookback': FORECAST_LOOKBACK_DAYS})
+    products = c.fetchall()
+    c.execute("""
+        SELECT pu.product_id, pu.batch_number, pu.remaining_quantity,
+               pu.expiration_date, pu.expiration_date - CURRENT_DATE
+        FROM Purchase pu
+        JOIN Product p ON p.id = pu.product_id
+        WHERE p.status = 'active' AND pu.remaining_quantity > 0 AND pu.expiration_date > CURRENT_DATE
+        ORDER BY pu.product_id, pu.expiration_date, pu.id
+    """)
+    batches = c.fetchall()
+    c.execute("SELECT CURRENT_DATE")
+    today = c.fetchone()[0]
+    conn.rollback()
+    return today, products, batches
+
+
+def build_forecast_report(conn, inputs=None):
+    today, products, batches = inputs or load_forecast_inputs(conn)
+    ids = np.array([row[0] for row in products], dtype=np.int64)
+    batch_ids = np.array([row[0] for row in batches], dtype=np.int64)
+    result = build_forecast(
+        stock_days=[row[4] for row in products],
+        out_sum=[row[5] for row in products],
+        out_sumsq=[row[6] for row in products],
+        batch_product=np.searchsorted(ids, batch_ids),
+        batch_remaining=[row[2] for row in batches],
+        batch_days=[row[4] for row in batches],
+        lead_time_days=FORECAST_LEAD_TIME_DAYS,
+        service_z=FORECAST_SERVICE_Z,
+        cover_days=FORECAST_COVER_DAYS,
+    )
+
+    # Slow movers can show centuries of supply; no stock-out date is given
+    # past ten years
+    days_of_supply = result['days_of_supply']
+    finite = np.isfinite(days_of_supply)
+    dated = days_of_supply <= 3650
+    stockout = np.full(len(ids), None, dtype=object)
+    stockout[dated] = (np.datetime64(today, 'D')
+                       + np.floor(days_of_supply[dated]).astype(np.int64).astype('timedelta64[D]')).astype(str)
+
+    # Most urgent first; products that never run out last
+    urgency = np.argsort(days_of_supply, kind='stable')
+    columns = zip(ids[urgency].tolist(),
+                  [products[i][1] for i in urgency],
+                  [products[i][2] for i in urgency],
+                  [products[i][3] for i in urgency],
+                  np.round(result['rate'][urgency], 3).tolist(),
+                  result['usable_stock'][urgency].tolist(),
+                  [round(float(days_of_supply[i]), 1) if finite[i] else None for i in urgency],
+                  stockout[urgency].tolist(),
+                  result['expiring_unused'][urgency].tolist(),
+                  np.round(result['reorder_point'][urgency], 1).tolist(),
+                  result['suggested_order'][urgency].tolist())
+    product_rows = [{
+        'product_id': product_id,
+        'product_name': name,
+        'product_type': product_type,
+        'stock_quantity': stock_quantity,
+        'avg_daily_consumption': rate,
+        'usable_stock': int(round(usable)),
+        'days_of_supply': dos,
+        'stockout_date': stockout_date,
+        'expiring_unused': int(round(expiring)),
+        'reorder_point': reorder_point,
+        'suggested_order': int(suggested),
+    } for (product_id, name, product_type, stock_quantity, rate, usable, dos, stockout_date,
+           expiring, reorder_point, suggested) in columns]
+
+    at_risk = np.flatnonzero(result['batch_expiring_unused'] >= 0.5)
+    batch_rows = [{
+        'product_id': batches[i][0],
+        'batch_number': batches[i][1],
+        'remaining_quantity': batches[i][2],
+        'expiration_date': batches[i][3].isoformat(),
+        'expiring_unused': int(round(result['batch_expiring_unused'][i])),
+    } for i in at_risk[np.argsort([batches[i][4] for i in at_risk], kind='stable')]]
+
+    return {
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'as_of': today.isoformat(),
+        'lookback_days': FORECAST_LOOKBACK_DAYS,
+        'lead_time_days': FORECAST_LEAD_TIME_DAYS,
+        'cover_days': FORECAST_COVER_DAYS,
+        'products': product_rows,
+        'batches_at_risk': batch_rows,
+    }
+
+
+# Each worker keeps the last report and serves it while a background thread
+# rebuilds it once it is older than FORECAST_TTL_SECONDS; only the very
+# first request waits for a build.
+_forecast_cache = {'report': None, 'built_at': 0.0, 'refreshing': False}
+_forecast_lock = threading.Lock()
+
+
+def refresh_forecast_report():
+    try:
+        with db_connection() as conn:
+            report = build_forecast_report(conn)
+        _forecast_cache['report'] = report
+        _forecast_cache['built_at'] = time.monotonic()
     except Exception as e:
-        print("Error updating expiry status:", e)
+        print(f"Error building forecast report: {e}")
     finally:
-        if conn:
-            conn.close()
+        _forecast_cache['refreshing'] = False
 
-# at the top, after your imports and database connection setup
 
-def update_expiry_notifications():
-    try:
-        conn = psycopg2.connect(DATABASE_URL)
+def get_forecast_report():
+    if _forecast_cache['report'] is None:
+        with _forecast_lock:
+            if _forecast_cache['report'] is None:
+                _forecast_cache['refreshing'] = True
+                refresh_forecast_report()
+        return _forecast_cache['report']
+
+    if time.monotonic() - _forecast_cache['built_at'] >= FORECAST_TTL_SECONDS:
+        with _forecast_lock:
+            if not _forecast_cache['refreshing']:
+                _forecast_cache['refreshing'] = True
+                threading.Thread(target=refresh_forecast_report, name='forecast-refresh', daemon=True).start()
+    return _forecast_cache['report']
 
-        c = conn.cursor()
 
+def refresh_stock_flow_rollups(conn, rebuild=False):
+    # Roll stock_flow_daily up by product_type for the days after the
+    # watermark and any dirty days. rebuild=True first recomputes
+    # stock_flow_daily from Purchase and "Order" and re-rolls everything.
+    c = conn.cursor()
+    c.execute("SELECT pg_try_advisory_xact_lock(%s)", (STOCK_FLOW_LOCK_ID,))
+    if not c.fetchone()[0]:
+        conn.rollback()
+        return None
+
+    if rebuild:
+        c.execute("LOCK TABLE Purchase, \"Order\" IN SHARE MODE")
+        c.execute("TRUNCATE stock_flow_daily, stock_flow_daily_type, stock_flow_dirty_day")
+        c.execute("DELETE FROM app_state WHERE key = 'stock_flow_rolled_through'")
         c.execute("""
-            UPDATE notification n
-            SET ignored = TRUE
-            FROM purchase pu
-            WHERE n.ignored = FALSE
-                AND n.product_id = pu.product_id
-                AND n.batch_id = pu.batch_number
-                AND (
-                    -- If purchase is expired but notification is near-expiry → ignore near-expiry
-                    (pu.status = 'expired' AND n.type = 'near-expiry')
-                    -- If purchase is near-expiry but notification is expired → ignore expired
-                    OR (pu.status = 'near expiry' AND n.type = 'expired')
-                );
+            INSERT INTO stock_flow_daily (product_id, day, stock_in, stock_out)
+            SELECT product_id, day, SUM(stock_in), SUM(stock_out)
+            FROM (
+                SELECT product_id, purchase_date AS day, purchase_quantity::bigint AS stock_in, 0::bigint AS stock_out
+                FROM Purchase
+                UNION ALL
+                SELECT product_id, order_date, 0, order_quantity
+                FROM "Order"
+            ) flow
+            WHERE day IS NOT NULL
+            GROUP BY product_id, day
         """)
 
-        # 👇 Add this line right after the execute
-        print(f"Rows updated: {c.rowcount}")
+    c.execute("""
+        SELECT (SELECT value::date FROM app_state WHERE key = 'stock_flow_rolled_through'),
+               CURRENT_DATE - 2
+    """)
+    through, target = c.fetchone()
+    c.execute("DELETE FROM stock_flow_dirty_day WHERE day <= %s RETURNING day", (target,))
+    dirty = [row[0] for row in c.fetchall()]
+    c.execute("""
+        SELECT DISTINCT day FROM stock_flow_daily
+        WHERE day <= %(target)s AND (%(through)s::date IS NULL OR day > %(through)s)
+    """, {'target': target, 'through': through})
+    days = sorted(set(dirty) | {row[0] for row in c.fetchall()})
+
+    c.execute("DELETE FROM stock_flow_daily_type WHERE day = ANY(%s)", (days,))
+    c.execute("""
+        INSERT INTO stock_flow_daily_type (day, product_type, stock_in, stock_out)
+        SELECT f.day, p.product_type, SUM(f.stock_in), SUM(f.stock_out)
+        FROM stock_flow_daily f
+        JOIN Product p ON p.id = f.product_id
+        WHERE f.day = ANY(%s)
+        GROUP BY f.day, p.product_type
+    """, (days,))
+    c.execute("""
+        INSERT INTO app_state (key, value, updated_at)
+        VALUES ('stock_flow_rolled_through', %s, NOW())
+        ON CONFLICT (key) DO UPDATE
+        SET value = GREATEST(app_state.value::date, EXCLUDED.value::date)::text, updated_at = NOW()
+    """, (target.isoformat(),))
+    conn.commit()
+    return len(days)
+
+
+DASHBOARD_COLUMNS = ('total_stocks', 'medicines', 'supplies',
+                     'stockins_medicines', 'stockins_supplies',
+                     'stockouts_medicines', 'stockouts_supplies',
+                     'out_of_stocks', 'total_orders', 'expiring_soon')
+
+_dashboard_cache = {'summary': None, 'at': 0.0}
+
+# Stock in/out of the last 7 days by type, read from the rollups
+DASHBOARD_FLOW_SQL = f"""
+    SELECT
+        SUM(CASE WHEN product_type = 'medicine' THEN stock_in ELSE 0 END) AS stockins_medicines,
+        SUM(CASE WHEN product_type = 'supply' THEN stock_in ELSE 0 END) AS stockins_supplies,
+        SUM(CASE WHEN product_type = 'medicine' THEN stock_out ELSE 0 END) AS stockouts_medicines,
+        SUM(CASE WHEN product_type = 'supply' THEN stock_out ELSE 0 END) AS stockouts_supplies
+    FROM ({stock_flow_days_sql("CURRENT_DATE - 7", "'infinity'")}) flow"""
+
+
+def refresh_dashboard_summary(conn):
+    # Rebuild every dashboard figure in one statement. refreshed_version is
+    # the version seen by this statement's snapshot, so a write committed
+    # while the refresh runs leaves the row stale rather than being lost.
+    # Writes only bump the version instead of applying deltas to the row:
+    # every write updating the one summary row would serialise all writers
+    # on its lock, and near-expiry and the 7-day window move with the date
+    # anyway. The rebuild costs one pass per write burst, not per read, and
+    # the stock-in/out figures come from the daily rollups.
+    c = conn.cursor()
+    c.execute(f"""
+        INSERT INTO dashboard_summary (id, {', '.join(DASHBOARD_COLUMNS)},
+                                       refreshed_version, refreshed_on, refreshed_at)
+        SELECT 1,
+            (SELECT COALESCE(SUM(stock_quantity), 0) FROM Product WHERE status = 'active'),
+            (SELECT COUNT(*) FROM Product WHERE status = 'active' AND product_type = 'medicine'),
+            (SELECT COUNT(*) FROM Product WHERE status = 'active' AND product_type = 'supply'),
+            COALESCE(fl.stockins_medicines, 0), COALESCE(fl.stockins_supplies, 0),
+            COALESCE(fl.stockouts_medicines, 0), COALESCE(fl.stockouts_supplies, 0),
+            (SELECT COUNT(*) FROM Product WHERE stock_status = 'out of stock' AND status = 'active'),
+            (SELECT COUNT(*) FROM "Order"),
+            (SELECT COALESCE(json_agg(json_build_object(
+                        'code', p.id, 'name', pr.product_name, 'expiration', p.expiration_date)
+                        ORDER BY p.expiration_date), '[]')
+             FROM Purchase p
+             JOIN Product pr ON p.product_id = pr.id
+             WHERE p.status = 'near expiry'),
+            COALESCE((SELECT version FROM dashboard_summary WHERE id = 1), 1),
+            CURRENT_DATE,
+            NOW()
+        FROM ({DASHBOARD_FLOW_SQL}) fl
+        ON CONFLICT (id) DO UPDATE SET
+            {', '.join(f'{col} = EXCLUDED.{col}' for col in DASHBOARD_COLUMNS)},
+            refreshed_version = EXCLUDED.refreshed_version,
+            refreshed_on = EXCLUDED.refreshed_on,
+            refreshed_at = EXCLUDED.refreshed_at
+        RETURNING {', '.join(DASHBOARD_COLUMNS)}
+    """)
+    summary = dict(zip(DASHBOARD_COLUMNS, c.fetchone()))
+    conn.commit()
+    return summary
+
+
+def get_dashboard_summary(conn):
+    # Served from a short-lived in-process cache, then from the summary row,
+    # and only rebuilt when a write or the date change has made it stale
+    cached = _dashboard_cache['summary']
+    if cached is not None and time.monotonic() - _dashboard_cache['at'] < DASHBOARD_CACHE_TTL:
+        return cached
 
+    c = conn.cursor()
+    c.execute(f"""
+        SELECT {', '.join(DASHBOARD_COLUMNS)},
+               version > refreshed_version OR refreshed_on IS DISTINCT FROM CURRENT_DATE
+        FROM dashboard_summary
+        WHERE id = 1
+    """)
+    row = c.fetchone()
+    if row is None or row[-1]:
+        summary = refresh_dashboard_summary(conn)
+    else:
+        summary = dict(zip(DASHBOARD_COLUMNS, row[:-1]))
+        conn.rollback()
+
+    _dashboard_cache['summary'] = summary
+    _dashboard_cache['at'] = time.monotonic()
+    return summary
+
+
+def invalidate_dashboard(conn, product_ids=None):
+    # Called after a product/purchase/order write has committed. The version
+    # bump is its own short transaction so writers don't queue on this row.
+    # The alerts of product_ids are re-checked by this worker's expiry
+    # engine; without them (bulk imports) they wait for its next full pass.
+    _dashboard_cache['summary'] = None
+    if expiry_engine is not None and product_ids:
+        expiry_engine.touch(product_ids)
+    try:
+        c = conn.cursor()
+        c.execute("UPDATE dashboard_summary SET version = version + 1 WHERE id = 1")
         conn.commit()
     except Exception as e:
-        print(f"Error updating expiry notifications: {e}")
-    finally:
-        if conn:
+        print(f"Error invalidating dashboard summary: {e}")
+        conn.rollback()
+
+
+# Categories, product types and product names for the form dropdowns. Each
+# worker keeps a copy tagged with the reference_version it was loaded at,
+# and re-reads the version at most every REFERENCE_CHECK_SECONDS.
+_reference_cache = {'data': None, 'checked_at': 0.0}
+_reference_lock = threading.Lock()
+
+
+def load_reference_data(conn):
+    c = conn.cursor()
+    # Version first: a write landing between the two reads leaves newer data
+    # under the older version, which the next check reloads
+    c.execute("SELECT value::bigint FROM app_state WHERE key = 'reference_version'")
+    row = c.fetchone()
+    version = row[0] if row else 0
+    c.execute("SELECT id, category_name FROM Category ORDER BY id")
+    categories = c.fetchall()
+    c.execute("SELECT DISTINCT product_type FROM Product ORDER BY product_type")
+    product_types = [row[0] for row in c.fetchall()]
+    c.execute("SELECT id, product_name FROM Product ORDER BY product_name ASC")
+    products = c.fetchall()
+    conn.rollback()
+    return {
+        'version': version,
+        'categories': categories,
+        'product_types': product_types,
+        'products': products,
+    }
+
+
+def get_reference_data(conn):
+    cached = _reference_cache['data']
+    if cached is not None and time.monotonic() - _reference_cache['checked_at'] < REFERENCE_CHECK_SECONDS:
+        return cached
+
+    with _reference_lock:
+        cached = _reference_cache['data']
+        if cached is not None and time.monotonic() - _reference_cache['checked_at'] < REFERENCE_CHECK_SECONDS:
+            return cached
+        if cached is not None:
+            c = conn.cursor()
+            c.execute("SELECT value::bigint FROM app_state WHERE key = 'reference_version'")
+            row = c.fetchone()
+            conn.rollback()
+            if row and row[0] == cached['version']:
+                _reference_cache['checked_at'] = time.monotonic()
+                return cached
+        data = load_reference_data(conn)
+        _reference_cache['data'] = data
+        _reference_cache['checked_at'] = time.monotonic()
+        return data
+
+
+def invalidate_reference_data(conn):
+    # Called after a product write has committed; other workers pick the
+    # new version up on their next check
+    _reference_cache['data'] = None
+    try:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO app_state (key, value, updated_at)
+            VALUES ('reference_version', '1', NOW())
+            ON CONFLICT (key) DO UPDATE
+            SET value = (app_state.value::bigint + 1)::text, updated_at = NOW()
+        """)
+        conn.commit()
+    except Exception as e:
+        print(f"Error invalidating reference data: {e}")
+        conn.rollback()
+
+
+class ExpiryEngine(threading.Thread):
+    """Background thread that reconciles purchase expiry status and alerts,
+    takes any stock ledger snapshots that are due and rolls up stock flow.
+
+    The full run happens every ``interval`` seconds and just after midnight,
+    when every near-expiry/expired boundary moves by one day. In between,
+    products touched by stock writes are collected and ``wake_delay``
+    seconds after the first one only their alerts are re-checked, so a
+    burst of writes is one small pass.
+    """
+
+    def __init__(self, interval, wake_delay=0):
+        super().__init__(name='expiry-engine', daemon=True)
+        self.interval = interval
+        self.wake_delay = wake_delay
+        self._wake = threading.Event()
+        self._touched = set()
+        self._touched_lock = threading.Lock()
+
+    def run(self):
+        next_run = 0
+        while True:
+            if time.monotonic() >= next_run:
+                try:
+                    with db_connection() as conn:
+                        reconcile_expiry(conn)
+                        take_stock_snapshots(conn)
+                        refresh_stock_flow_rollups(conn)
+                except Exception as e:
+                    print(f"Error in expiry engine: {e}")
+                next_run = time.monotonic() + self.seconds_until_next_run()
+            elif self._wake.is_set():
+                time.sleep(self.wake_delay)
+                with self._touched_lock:
+                    product_ids, self._touched = self._touched, set()
+                    self._wake.clear()
+                try:
+                    with db_connection() as conn:
+                        reconcile_product_alerts(conn, product_ids)
+                except Exception as e:
+                    print(f"Error checking product alerts: {e}")
+            self._wake.wait(max(0.0, next_run - time.monotonic()))
+
+    def seconds_until_next_run(self):
+        now = datetime.now()
+        midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        return max(1.0, min(self.interval, (midnight - now).total_seconds() + 1))
+
+    def touch(self, product_ids):
+        with self._touched_lock:
+            self._touched.update(int(product_id) for product_id in product_ids)
+            self._wake.set()
+
+
+class NotificationListener(threading.Thread):
+    """Fans Postgres NOTIFY payloads on ``channel`` out to subscriber queues.
+
+    One listener per worker process holds a dedicated connection (LISTEN is
+    session state, so it can't come from the pool). Subscribers that fall
+    more than ``max_backlog`` events behind drop events rather than block.
+    """
+
+    def __init__(self, dsn, channel, max_backlog=100):
+        super().__init__(name=f'listener-{channel}', daemon=True)
+        self.dsn = dsn
+        self.channel = channel
+        self.max_backlog = max_backlog
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def subscribe(self):
+        events = queue.Queue(maxsize=self.max_backlog)
+        with self._lock:
+            self._subscribers.add(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self._lock:
+            self._subscribers.discard(events)
+
+    def subscriber_count(self):
+        with self._lock:
+            return len(self._subscribers)
+
+    def publish(self, payload):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for events in subscribers:
+            try:
+                events.put_nowait(payload)
+            except queue.Full:
+                pass
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception as e:
+                print(f"Error in {self.name}, reconnecting: {e}")
+                time.sleep(5)
+
+    def listen(self):
+        conn = psycopg2.connect(self.dsn)
+        try:
+            conn.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            c = conn.cursor()
+            c.execute(f"LISTEN {self.channel}")
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    self.publish(conn.notifies.pop(0).payload)
+        finally:
             conn.close()
 
 
+notification_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_notification_listener():
+    # Started by the first stream client, not at import
+    global notification_listener
+    if notification_listener is None:
+        with _listener_lock:
+            if notification_listener is None:
+                notification_listener = NotificationListener(DATABASE_URL, NOTIFICATION_CHANNEL)
+                notification_listener.start()
+    return notification_listener
+
+
+expiry_engine = None
+_background_started = False
+_background_lock = threading.Lock()
+
+
+@app.before_request
+def start_background_workers():
+    # Started on the first request so each gunicorn worker runs its own threads
+    global _background_started, expiry_engine
+    if _background_started:
+        return
+    with _background_lock:
+        if _background_started:
+            return
+        _background_started = True
+        if EXPIRY_ENGINE_ENABLED:
+            expiry_engine = ExpiryEngine(EXPIRY_INTERVAL_SECONDS, EXPIRY_WAKE_DELAY_SECONDS)
+            expiry_engine.start()
+
+
+class InsufficientStock(Exception):
+    pass
+
+
+def allocate_fefo(conn, product_id, quantity):
+    # Split a stock-out across unexpired batches, earliest expiry first.
+    # Rows are read through a FOR UPDATE cursor, which locks each batch only
+    # as it is fetched, so just the batches actually consumed are locked and
+    # the scan stops as soon as the quantity is covered.
+    allocation = []
+    needed = quantity
+    with conn.cursor(name='fefo_allocation') as c:
+        c.execute("""
+            SELECT id, batch_number, remaining_quantity, expiration_date
+            FROM Purchase
+            WHERE product_id = %s
+              AND remaining_quantity > 0
+              AND expiration_date > CURRENT_DATE
+            ORDER BY expiration_date, id
+            FOR UPDATE
+        """, (product_id,))
+        while needed > 0:
+            row = c.fetchone()
+            if row is None:
+                break
+            take = min(needed, row[2])
+            allocation.append({
+                'purchase_id': row[0],
+                'batch_number': row[1],
+                'quantity': take,
+                'expiration_date': row[3].isoformat(),
+            })
+            needed -= take
+
+    if needed > 0:
+        raise InsufficientStock(f'Insufficient stock: {quantity - needed} of {quantity} available')
+    return allocation
+
+
+# Bulk import of products and purchases. Rows are parsed as they stream in,
+# loaded into a temporary staging table with COPY, validated with a handful
+# of set-based UPDATEs, and merged with one INSERT ... SELECT.
+def import_int(value):
+    return int(str(value).strip())
+
+
+def import_date(value):
+    return date.fromisoformat(str(value).strip()).isoformat()
+
+
+def import_text(value):
+    value = '' if value is None else str(value).strip()
+    if not value:
+        raise ValueError('empty')
+    return value
+
+
+IMPORT_SPECS = {
+    'products': {
+        'columns': (('product_name', 'TEXT', import_text),
+                    ('product_type', 'TEXT', import_text),
+                    ('category_id', 'INTEGER', import_int)),
+        'checks': (
+            ("product_type must be 'medicine' or 'supply'",
+             "product_type NOT IN ('medicine', 'supply')"),
+            ('unknown category_id',
+             "NOT EXISTS (SELECT 1 FROM Category c WHERE c.id = s.category_id)"),
+        ),
+        'merge': """
+            INSERT INTO Product (product_name, product_type, category_id, stock_quantity)
+            SELECT product_name, product_type, category_id, 0
+            FROM import_staging
+            WHERE error IS NULL
+            ORDER BY line_no
+        """,
+    },
+    'purchases': {
+        'columns': (('product_id', 'INTEGER', import_int),
+                    ('purchase_quantity', 'INTEGER', import_int),
+                    ('expiration_date', 'DATE', import_date),
+                    ('supplier', 'TEXT', import_text)),
+        'checks': (
+            ('unknown product_id',
+             "NOT EXISTS (SELECT 1 FROM Product p WHERE p.id = s.product_id)"),
+            ('purchase_quantity must be positive',
+             "purchase_quantity <= 0"),
+            ('expiration_date is not in the future',
+             "expiration_date <= CURRENT_DATE"),
+        ),
+        'merge': f"""
+            INSERT INTO Purchase
+            (product_id, purchase_quantity, remaining_quantity, expiration_date, supplier, status)
+            SELECT product_id, purchase_quantity, purchase_quantity, expiration_date, supplier,
+                   {expiry_status_sql('expiration_date')}
+            FROM import_staging
+            WHERE error IS NULL
+            ORDER BY line_no
+        """,
+    },
+}
+
+
+def read_import_records(stream, fmt):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'jsonl':
+        for line in text:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+    else:
+        yield from csv.DictReader(text)
+
+
+def staging_lines(records, columns):
+    # One CSV line per record: line number, parsed values, parse errors
+    out = io.StringIO()
+    writer = csv.writer(out)
+    for line_no, record in enumerate(records, 1):
+        values = []
+        errors = []
+        for name, _, parse in columns:
+            try:
+                values.append(parse(record.get(name)) if isinstance(record, dict) else None)
+            except (TypeError, ValueError):
+                values.append(None)
+                errors.append(f'invalid {name}')
+        if not isinstance(record, dict):
+            errors = ['unreadable row']
+        writer.writerow([line_no] + ['' if v is None else v for v in values] + ['; '.join(errors)])
+        yield out.getvalue()
+        out.seek(0)
+        out.truncate()
+
+
+class IterReader:
+    """Minimal file-like object over an iterator of strings, for COPY FROM."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def import_rows(conn, kind, stream, fmt='csv', atomic=False):
+    spec = IMPORT_SPECS[kind]
+    columns = spec['columns']
+    c = conn.cursor()
+    c.execute(f"""
+        CREATE TEMP TABLE import_staging (
+            line_no INTEGER PRIMARY KEY,
+            {', '.join(f'{name} {sql_type}' for name, sql_type, _ in columns)},
+            error TEXT
+        ) ON COMMIT DROP
+    """)
+    c.copy_expert(
+        f"COPY import_staging (line_no, {', '.join(name for name, _, _ in columns)}, error) FROM STDIN WITH (FORMAT csv)",
+        IterReader(staging_lines(read_import_records(stream, fmt), columns)))
+    c.execute("ANALYZE import_staging")
+
+    for message, condition in spec['checks']:
+        c.execute(f"UPDATE import_staging s SET error = %s WHERE error IS NULL AND {condition}", (message,))
+
+    c.execute("SELECT COUNT(*), COUNT(error) FROM import_staging")
+    total, failed = c.fetchone()
+    c.execute("SELECT line_no, error FROM import_staging WHERE error IS NOT NULL ORDER BY line_no LIMIT %s",
+              (IMPORT_MAX_ERRORS,))
+    errors = [{'line': line_no, 'error': error} for line_no, error in c.fetchall()]
+
+    imported = 0
+    if failed and atomic:
+        conn.rollback()
+    else:
+        c.execute(spec['merge'])
+        imported = c.rowcount
+        conn.commit()
+    return {'rows': total, 'imported': imported, 'rejected': failed, 'errors': errors}
+
+
+def import_format(filename, requested):
+    if requested in ('csv', 'jsonl'):
+        return requested
+    return 'jsonl' if (filename or '').lower().endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+# Streaming exports. Each export reads through a named (server-side) cursor
+# in EXPORT_BATCH_SIZE batches and yields them as they arrive, so memory use
+# is flat and the header goes out before the query has produced a row.
+EXPORT_SPECS = {
+    'orders': {
+        'fields': ('order_id', 'order_date', 'customer', 'product_id', 'product_name',
+                   'batch_number', 'order_quantity'),
+        'query': """
+            SELECT o.order_id, o.order_date, o.customer, o.product_id, p.product_name,
+                   o.batch_number, o.order_quantity
+            FROM "Order" o
+            LEFT JOIN Product p ON o.product_id = p.id
+        """,
+        'date': 'o.order_date',
+        'product': 'o.product_id',
+        'order': 'o.order_date, o.order_id',
+    },
+    'purchases': {
+        'fields': ('id', 'purchase_date', 'product_id', 'product_name', 'batch_number', 'supplier',
+                   'purchase_quantity', 'remaining_quantity', 'expiration_date', 'status'),
+        'query': """
+            SELECT pu.id, pu.purchase_date, pu.product_id, pr.product_name, pu.batch_number,
+                   pu.supplier, pu.purchase_quantity, pu.remaining_quantity,
+                   pu.expiration_date, pu.status
+            FROM Purchase pu
+            LEFT JOIN Product pr ON pu.product_id = pr.id
+        """,
+        'date': 'pu.purchase_date',
+        'product': 'pu.product_id',
+        'order': 'pu.purchase_date, pu.id',
+    },
+    'activity': {
+        'fields': ('id', 'activity_time', 'username', 'activity'),
+        'query': """
+            SELECT id, activity_time, username, activity
+            FROM user_activity
+        """,
+        'date': 'activity_time',
+        'product': None,
+        'order': 'activity_time, id',
+    },
+}
+
+
+def export_query(spec, date_from=None, date_to=None, product_id=None):
+    where = []
+    params = []
+    if date_from:
+        where.append(f"{spec['date']} >= %s")
+        params.append(date_from)
+    if date_to:
+        where.append(f"{spec['date']} < %s::date + 1")
+        params.append(date_to)
+    if product_id is not None and spec['product']:
+        where.append(f"{spec['product']} = %s")
+        params.append(product_id)
+    sql = f"""
+        {spec['query']}
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY {spec['order']}
+    """
+    return sql, params
+
+
+def stream_export(spec, sql, params, fmt):
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    def flush():
+        data = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return data
+
+    if fmt == 'csv':
+        writer.writerow(spec['fields'])
+        yield flush()
+
+    with db_connection() as conn:
+        with conn.cursor(name='export') as c:
+            c.itersize = EXPORT_BATCH_SIZE
+            c.execute(sql, params)
+            while True:
+                rows = c.fetchmany(EXPORT_BATCH_SIZE)
+                if not rows:
+                    break
+                for row in rows:
+                    if fmt == 'csv':
+                        writer.writerow(row)
+                    else:
+                        record = {field: json_value(value) for field, value in zip(spec['fields'], row)}
+                        out.write(json.dumps(record, default=str) + '\n')
+                yield flush()
+
+
+# Keyset-paginated list views for /products, /purchases and /orders.
+# Each page continues strictly after the (sort key, id) of the previous
+# page's last row, so a page costs the same however deep it is.
+def like_escape(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def like_pattern(value):
+    return f'%{like_escape(value)}%'
+
+
+LIST_VIEWS = {
+    'products': {
+        'columns': """p.id, p.product_name, p.product_type, p.stock_quantity,
+                   c.category_name, p.stock_status, p.low_stock_threshold""",
+        'source': """Product p
+            LEFT JOIN Category c ON p.category_id = c.id""",
+        'fields': ('id', 'product_name', 'product_type', 'stock_quantity', 'category_name', 'stock_status',
+                   'low_stock_threshold'),
+        'id': 'p.id',
+        'sorts': {
+            'code': 'p.id',
+            'name': 'p.product_name',
+            'type': 'p.product_type',
+            'category': "COALESCE(c.category_name, '')",
+            'quantity': 'p.stock_quantity',
+            'status': "COALESCE(p.stock_status, '')",
+        },
+        'default_sort': ('code', 'asc'),
+        'filters': {
+            'q': ("p.product_name ILIKE %s", like_pattern),
+            'type': ("p.product_type = %s", None),
+            'category': ("c.category_name = %s", None),
+            'status': ("p.stock_status = %s", None),
+        },
+        'rows_template': '_product_rows.html',
+    },
+    'purchases': {
+        'columns': """pu.id, pr.product_name, pu.batch_number, pu.purchase_quantity,
+                   pu.remaining_quantity, pu.expiration_date, pu.status,
+                   pu.purchase_date, pu.supplier""",
+        'source': """Purchase pu
+            LEFT JOIN Product pr ON pu.product_id = pr.id""",
+        'fields': ('id', 'product_name', 'batch_number', 'purchase_quantity', 'remaining_quantity',
+                   'expiration_date', 'status', 'purchase_date', 'supplier'),
+        'id': 'pu.id',
+        'sorts': {
+            'date': "COALESCE(pu.purchase_date, DATE '0001-01-01')",
+            'expiration': 'pu.expiration_date',
+            'quantity': 'pu.purchase_quantity',
+            'remaining': 'pu.remaining_quantity',
+            'name': "COALESCE(pr.product_name, '')",
+            'supplier': "COALESCE(pu.supplier, '')",
+        },
+        'default_sort': ('date', 'desc'),
+        'filters': {
+            'q': ("(pr.product_name ILIKE %s OR pu.batch_number::text ILIKE %s OR pu.supplier ILIKE %s)",
+                  like_pattern),
+            'batch': ("pu.batch_number::text ILIKE %s", like_pattern),
+            'product_id': ("pu.product_id = %s", int),
+            'status': ("CASE WHEN %s = 'sold out' THEN pu.remaining_quantity = 0 ELSE pu.status = %s END", None),
+            'date': ("pu.purchase_date >= %s::date AND pu.purchase_date < %s::date + 1", date.fromisoformat),
+        },
+        'rows_template': '_purchase_rows.html',
+    },
+    'orders': {
+        'columns': """o.order_id, p.product_name, o.order_quantity, o.batch_number,
+                   o.order_date, o.customer""",
+        'source': """"Order" o
+            LEFT JOIN Product p ON o.product_id = p.id""",
+        'fields': ('order_id', 'product_name', 'order_quantity', 'batch_number', 'order_date', 'customer'),
+        'id': 'o.order_id',
+        'sorts': {
+            'date': "COALESCE(o.order_date, DATE '0001-01-01')",
+            'quantity': 'o.order_quantity',
+            'name': "COALESCE(p.product_name, '')",
+            'customer': "COALESCE(o.customer, '')",
+        },
+        'default_sort': ('date', 'desc'),
+        'filters': {
+            'q': ("(p.product_name ILIKE %s OR o.customer ILIKE %s OR o.batch_number::text ILIKE %s)",
+                  like_pattern),
+            'batch': ("o.batch_number::text ILIKE %s", like_pattern),
+            'product_id': ("o.product_id = %s", int),
+            'date': ("o.order_date >= %s::date AND o.order_date < %s::date + 1", date.fromisoformat),
+        },
+        'rows_template': '_order_rows.html',
+    },
+}
+
+
+def cursor_text(value):
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return value
+
+
+# How a cursor's sort value is read back, by sort name; text otherwise
+SORT_VALUE_TYPES = {
+    'code': int,
+    'quantity': int,
+    'remaining': int,
+    'date': date.fromisoformat,
+    'expiration': date.fromisoformat,
+}
+
+
+def encode_page_cursor(sort, sort_value, row_id):
+    raw = json.dumps([sort, sort_value, row_id], default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_page_cursor(token, sort):
+    # A cursor only continues the sort it was taken from
+    try:
+        cursor_sort, sort_value, row_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        sort_value = SORT_VALUE_TYPES.get(cursor_sort, cursor_text)(sort_value)
+        row_id = int(row_id)
+    except Exception:
+        raise ValueError('Invalid page cursor')
+    if cursor_sort != sort:
+        raise ValueError('Page cursor is for a different sort order')
+    return sort_value, row_id
+
+
+def fetch_page(c, view, args):
+    # Returns (rows, next_cursor); raises ValueError on a bad cursor or filter
+    sort = args.get('sort')
+    if sort not in view['sorts']:
+        sort = view['default_sort'][0]
+    direction = args.get('dir', view['default_sort'][1])
+    direction = 'DESC' if direction == 'desc' else 'ASC'
+    sort_expr = view['sorts'][sort]
+    limit = min(max(args.get('limit', LIST_PAGE_SIZE, type=int), 1), LIST_PAGE_MAX)
+
+    where = []
+    params = []
+    for name, (condition, convert) in view['filters'].items():
+        value = args.get(name, '').strip()
+        if value:
+            if convert:
+                try:
+                    value = convert(value)
+                except ValueError:
+                    raise ValueError(f'Invalid {name} filter')
+            where.append(condition)
+            params.extend([value] * condition.count('%s'))
+
+    cursor = args.get('cursor')
+    if cursor:
+        where.append(f"({sort_expr}, {view['id']}) {'<' if direction == 'DESC' else '>'} (%s, %s)")
+        params.extend(decode_page_cursor(cursor, sort))
+
+    c.execute(f"""
+        SELECT {view['columns']}, {sort_expr}, {view['id']}
+        FROM {view['source']}
+        {'WHERE ' + ' AND '.join(where) if where else ''}
+        ORDER BY {sort_expr} {direction}, {view['id']} {direction}
+        LIMIT %s
+    """, params + [limit + 1])
+    rows = c.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor(sort, rows[-1][-2], rows[-1][-1])
+    return [row[:-2] for row in rows], next_cursor
+
+
+# Fuzzy search, one ranked sub-query per result type. Each matches on the
+# trigram word-similarity operator (typos) or a prefix ILIKE, both of which
+# are answered from the gin_trgm_ops indexes.
+SEARCH_QUERIES = {
+    'product': """
+        SELECT 'product', p.id::text, p.product_name, p.product_type,
+               GREATEST(word_similarity(%(q)s, p.product_name),
+                        CASE WHEN p.product_name ILIKE %(prefix)s THEN 1 ELSE 0 END) AS score
+        FROM Product p
+        WHERE %(q)s <%% p.product_name OR p.product_name ILIKE %(prefix)s
+        ORDER BY score DESC
+        LIMIT %(limit)s
+    """,
+    'batch': """
+        SELECT 'batch', pu.id::text, pu.batch_number::text,
+               COALESCE(pr.product_name, '') || ' (exp. ' || pu.expiration_date || ')',
+               GREATEST(word_similarity(%(q)s, pu.batch_number::text),
+                        CASE WHEN pu.batch_number::text ILIKE %(prefix)s THEN 1 ELSE 0 END) AS score
+        FROM Purchase pu
+        LEFT JOIN Product pr ON pu.product_id = pr.id
+        WHERE %(q)s <%% pu.batch_number::text OR pu.batch_number::text ILIKE %(prefix)s
+        ORDER BY score DESC
+        LIMIT %(limit)s
+    """,
+    'supplier': """
+        SELECT 'supplier', NULL, pu.supplier, COUNT(*) || ' batches',
+               MAX(GREATEST(word_similarity(%(q)s, pu.supplier),
+                            CASE WHEN pu.supplier ILIKE %(prefix)s THEN 1 ELSE 0 END)) AS score
+        FROM Purchase pu
+        WHERE %(q)s <%% pu.supplier OR pu.supplier ILIKE %(prefix)s
+        GROUP BY pu.supplier
+        ORDER BY score DESC
+        LIMIT %(limit)s
+    """,
+    'customer': """
+        SELECT 'customer', NULL, o.customer, COUNT(*) || ' orders',
+               MAX(GREATEST(word_similarity(%(q)s, o.customer),
+                            CASE WHEN o.customer ILIKE %(prefix)s THEN 1 ELSE 0 END)) AS score
+        FROM "Order" o
+        WHERE %(q)s <%% o.customer OR o.customer ILIKE %(prefix)s
+        GROUP BY o.customer
+        ORDER BY score DESC
+        LIMIT %(limit)s
+    """,
+}
+
+
+def json_value(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
 
 # Routes
 @app.route('/')
@@ -174,7 +2265,7 @@ def auth():
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
         c.execute("""
@@ -183,27 +2274,53 @@ def auth():
             WHERE username = %s
         """, (username,))
         user = c.fetchone()
+        conn.rollback()
 
-        if user and check_password_hash(user[2], password):
+        # Hand the connection back while the hash runs; it's the slow part
+        get_pool().putconn(g.pop('db_conn'))
+
+        if user and get_hash_executor().run(check_password_hash, user[2], password):
             session['logged_in'] = True
             session['user_id'] = user[0]
             session['username'] = user[1]
             session['name'] = user[3]
             session['role'] = user[4]
 
+            if password_needs_rehash(user[2]):
+                rehash_password(user[0], user[2], password)
+
             log_activity(user[1], "Logged in")
             return redirect(url_for('dashboard'))
         else:
             # Pass the error to template
             return render_template('index.html', error="Invalid login, please try again.", username=username)
 
+    except HashQueueFull:
+        return (render_template('index.html', error="Too many logins right now, please try again in a moment.",
+                                username=username),
+                503, {'Retry-After': '2'})
     except Exception as e:
         print(f"Login exception: {str(e)}")  # <-- Debug line
         return render_template('index.html', error=f"Login error: {str(e)}", username=username)
 
-    finally:
+
+def rehash_password(user_id, old_hash, password):
+    # Upgrade a stored hash to PASSWORD_HASH_METHOD. Best effort: a busy
+    # executor or a concurrent password change just leaves it for next time.
+    conn = None
+    try:
+        new_hash = get_hash_executor().run(hash_password, password)
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("UPDATE users SET password = %s WHERE id = %s AND password = %s",
+                  (new_hash, user_id, old_hash))
+        conn.commit()
+    except HashQueueFull:
+        pass
+    except Exception as e:
+        print(f"Error rehashing password for user {user_id}: {str(e)}")
         if conn:
-            conn.close()
+            conn.rollback()
 
 
 
@@ -215,109 +2332,38 @@ def logout():
     return redirect(url_for('login'))
 
 
+def dashboard_context(summary):
+    # Template arguments for admin.html; shared with the async dashboard
+    return {
+        'total_stocks': summary['total_stocks'],
+        'out_of_stocks': summary['out_of_stocks'],
+        'total_orders': summary['total_orders'],
+        'expiring_soon': [{'code': item['code'],
+                           'name': item['name'],
+                           'expiration': datetime.strptime(item['expiration'], '%Y-%m-%d').date()}
+                          for item in summary['expiring_soon']],
+        'medicines': summary['medicines'],
+        'supplies': summary['supplies'],
+        'stockins_medicines': summary['stockins_medicines'],
+        'stockins_supplies': summary['stockins_supplies'],
+        'stockouts_medicines': summary['stockouts_medicines'],
+        'stockouts_supplies': summary['stockouts_supplies'],
+    }
+
+
 @app.route('/dashboard')
 @login_required
 def dashboard():
-    update_expiry_status()
-    update_expiry_notifications()
+    ensure_expiry_reconciled()
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-
-        c = conn.cursor()
-        
-        # Get total stocks (sum of quantity of active products)
-        c.execute("""
-            SELECT SUM(stock_quantity) 
-            FROM Product 
-            WHERE status = 'active'
-        """)
-        total_stocks_quantity = c.fetchone()[0] or 0
-
-        # Get total medicines and supplies (count of active products by type)
-        c.execute("""
-            SELECT 
-                SUM(CASE WHEN product_type = 'medicine' THEN 1 ELSE 0 END) as medicines,
-                SUM(CASE WHEN product_type = 'supply' THEN 1 ELSE 0 END) as supplies
-            FROM Product 
-            WHERE status = 'active'
-        """)
-        result = c.fetchone()
-        total_medicines_count = result[0] or 0
-        total_supplies_count = result[1] or 0
-
-        # Get stock-ins for this week (medicines and supplies)
-        c.execute("""
-            SELECT 
-                SUM(CASE WHEN pr.product_type = 'medicine' THEN p.purchase_quantity ELSE 0 END) as medicines,
-                SUM(CASE WHEN pr.product_type = 'supply' THEN p.purchase_quantity ELSE 0 END) as supplies
-            FROM Purchase p
-            JOIN Product pr ON p.product_id = pr.id
-            WHERE p.purchase_date >= CURRENT_DATE - INTERVAL '7 days'
-        """)
-        result_stockins = c.fetchone()
-        stockins_medicines = result_stockins[0] or 0
-        stockins_supplies = result_stockins[1] or 0
-
-        # Get stock-outs for this week (medicines and supplies)
-        c.execute("""
-            SELECT 
-                SUM(CASE WHEN pr.product_type = 'medicine' THEN o.order_quantity ELSE 0 END) as medicines,
-                SUM(CASE WHEN pr.product_type = 'supply' THEN o.order_quantity ELSE 0 END) as supplies
-            FROM "Order" o
-            JOIN Product pr ON o.product_id = pr.id
-            WHERE o.order_date >= CURRENT_DATE - INTERVAL '7 days'
-        """)
-        result_stockouts = c.fetchone()
-        stockouts_medicines = result_stockouts[0] or 0
-        stockouts_supplies = result_stockouts[1] or 0
-
-        # Get total out of stock items
-        c.execute("""
-            SELECT COUNT(*) 
-            FROM Product 
-            WHERE stock_status = 'out of stock' AND status = 'active'
-        """)
-        total_out_of_stock = c.fetchone()[0] or 0
-
-        # Get total orders
-        c.execute("""
-            SELECT COUNT(*) 
-            FROM "Order"
-        """)
-        total_orders = c.fetchone()[0] or 0
-
-        # Get total purchases with near-expiry status
-        c.execute("""
-            SELECT COUNT(*) 
-            FROM Purchase 
-            WHERE status = 'near expiry'
-        """)
-        total_expiring_soon = c.fetchone()[0] or 0
-
-        # Get expiring soon items with details
-        c.execute("""
-            SELECT p.id as code, pr.product_name as name, p.expiration_date as expiration
-            FROM Purchase p
-            JOIN Product pr ON p.product_id = pr.id
-            WHERE p.status = 'near expiry'
-            ORDER BY p.expiration_date ASC
-        """)
-        expiring_soon = [{'code': row[0], 'name': row[1], 'expiration': row[2]} for row in c.fetchall()]
-
-        return render_template('admin.html', 
-                             total_stocks=total_stocks_quantity,
-                             out_of_stocks=total_out_of_stock,
-                             total_orders=total_orders,
-                             expiring_soon=expiring_soon,
-                             medicines=total_medicines_count,
-                             supplies=total_supplies_count,
-                             stockins_medicines=stockins_medicines,
-                             stockins_supplies=stockins_supplies,
-                             stockouts_medicines=stockouts_medicines,
-                             stockouts_supplies=stockouts_supplies)
+        conn = get_db()
+        summary = get_dashboard_summary(conn)
+        return render_template('admin.html', **dashboard_context(summary))
     except Exception as e:
+        if conn:
+            conn.rollback()
         print(f"Error in dashboard route: {str(e)}")
         flash(f'Error loading dashboard: {str(e)}', 'error')
         return render_template('admin.html', 
@@ -331,125 +2377,259 @@ def dashboard():
                              stockins_supplies=0,
                              stockouts_medicines=0,
                              stockouts_supplies=0)
-    finally:
-        if conn is not None:
-            conn.close()
 
 @app.route('/products')
 @login_required
 def products():
-    update_expiry_status()
-    update_expiry_notifications()
+    ensure_expiry_reconciled()
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
-        c.execute("""
-            SELECT p.id, p.product_name, p.product_type, p.stock_quantity, 
-                   c.category_name, p.stock_status
-            FROM Product p
-            LEFT JOIN Category c ON p.category_id = c.id
-            ORDER BY p.id DESC
-        """)
-        products = c.fetchall()
-        c.execute("SELECT id, category_name FROM Category")
-        categories = c.fetchall()
-        c.execute("SELECT DISTINCT product_type FROM Product")
-        product_types = [row[0] for row in c.fetchall()]
+        products, next_cursor = fetch_page(c, LIST_VIEWS['products'], request.args)
+        reference = get_reference_data(conn)
         return render_template('products.html', 
                              products=products,
-                             categories=categories,
-                             product_types=product_types)
+                             next_cursor=next_cursor,
+                             categories=reference['categories'],
+                             product_types=reference['product_types'])
     except Exception as e:
         print(f"Error in products route: {str(e)}")
         flash(f'Error loading products: {str(e)}', 'error')
         return render_template('products.html', products=[], categories=[], product_types=[])
-    finally:
-        if conn is not None:
-            conn.close()
 
 @app.route('/purchases')
 @login_required
 def purchases():
-    update_expiry_status()
-    update_expiry_notifications()
+    ensure_expiry_reconciled()
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
-        c.execute("""
-    SELECT 
-        pu.id, 
-        pr.product_name, 
-        pu.batch_number, 
-        pu.purchase_quantity, 
-        pu.remaining_quantity, 
-        pu.expiration_date, 
-        pu.status, 
-        pu.purchase_date,
-        pu.supplier
-    FROM Purchase pu
-    LEFT JOIN Product pr ON pu.product_id = pr.id
-    ORDER BY pu.purchase_date DESC
-""")
-
-        purchases = c.fetchall()
-        c.execute("SELECT id, product_name FROM Product ORDER BY product_name ASC")
-        products = c.fetchall()
-        print("Purchases fetched:", purchases)
-        return render_template('purchase.html', purchases=purchases, products=products)
+        purchases, next_cursor = fetch_page(c, LIST_VIEWS['purchases'], request.args)
+        return render_template('purchase.html', purchases=purchases, next_cursor=next_cursor,
+                               products=get_reference_data(conn)['products'])
     except Exception as e:
         print(f"Error in purchases route: {str(e)}")
         flash(f'Error loading purchases: {str(e)}', 'error')
         return render_template('purchase.html', purchases=[], products=[])
-    finally:
-        if conn is not None:
-            conn.close()
 
 @app.route('/orders')
 @login_required
 def orders():
-    update_expiry_status()
-    update_expiry_notifications()
+    ensure_expiry_reconciled()
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
-        c.execute("""
-    SELECT o.order_id, p.product_name, o.order_quantity, o.batch_number, o.order_date, o.customer
-    FROM "Order" o
-    LEFT JOIN Product p ON o.product_id = p.id
-    ORDER BY o.order_date DESC
-""")
-
-        orders = c.fetchall()
-        c.execute("SELECT id, product_name FROM Product ORDER BY product_name ASC")
-        products = c.fetchall()
-        print("Orders fetched:", orders)
-        return render_template('orders.html', orders=orders, products=products)
+        orders, next_cursor = fetch_page(c, LIST_VIEWS['orders'], request.args)
+        return render_template('orders.html', orders=orders, next_cursor=next_cursor,
+                               products=get_reference_data(conn)['products'])
     except Exception as e:
         print(f"Error in orders route: {str(e)}")
         flash(f'Error loading orders: {str(e)}', 'error')
         return render_template('orders.html', orders=[], products=[])
-    finally:
-        if conn is not None:
-            conn.close()
+
+# One page of a list view, as JSON rows or (format=html) as rendered <tr>s
+@app.route('/api/<any(products, purchases, orders):list_name>')
+@login_required
+def list_page(list_name):
+    view = LIST_VIEWS[list_name]
+    conn = None
+    try:
+        conn = get_db()
+        rows, next_cursor = fetch_page(conn.cursor(), view, request.args)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(f"Error in {list_name} list: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error loading {list_name}: {str(e)}'}), 500
+
+    if request.args.get('format') == 'html':
+        html = render_template(view['rows_template'], rows=rows, first_page=not request.args.get('cursor'))
+        return jsonify({'success': True, 'html': html, 'next': next_cursor})
+    return jsonify({
+        'success': True,
+        'rows': [{field: json_value(value) for field, value in zip(view['fields'], row)} for row in rows],
+        'next': next_cursor,
+    })
+
+# Dropdown data for the product, purchase and order forms. The ETag is the
+# reference version, so browsers revalidate with a 304 until a product write.
+@app.route('/api/reference-data')
+@login_required
+def reference_data():
+    try:
+        reference = get_reference_data(get_db())
+    except Exception as e:
+        print(f"Error loading reference data: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error loading reference data: {str(e)}'}), 500
+
+    etag = f'"ref-{reference["version"]}"'
+    if request.headers.get('If-None-Match') == etag:
+        return '', 304, {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    response = jsonify({
+        'success': True,
+        'version': reference['version'],
+        'categories': [{'id': row[0], 'name': row[1]} for row in reference['categories']],
+        'product_types': reference['product_types'],
+        'products': [{'id': row[0], 'name': row[1]} for row in reference['products']],
+    })
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+# Stock on hand at a point in time, from the stock ledger.
+# ?at=YYYY-MM-DD (close of that day) or an ISO timestamp; ?product_id=
+# narrows to one product; ?by=product totals the batches.
+@app.route('/api/stock-as-of')
+@login_required
+def stock_as_of_api():
+    at_arg = request.args.get('at', '')
+    by_batch = request.args.get('by', 'batch') != 'product'
+    try:
+        if len(at_arg) == 10:
+            at = datetime.combine(date.fromisoformat(at_arg) + timedelta(days=1), datetime.min.time())
+        else:
+            at = datetime.fromisoformat(at_arg)
+        product_id = request.args.get('product_id', type=int)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'at must be YYYY-MM-DD or an ISO timestamp'}), 400
+
+    try:
+        rows = stock_as_of(get_db(), at, product_id, by_batch)
+    except Exception as e:
+        print(f"Error reading stock ledger: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error reading stock ledger: {str(e)}'}), 500
+
+    if by_batch:
+        items = [{'product_id': r[0], 'product_name': r[1], 'batch_number': r[2], 'quantity': r[3]}
+                 for r in rows]
+    else:
+        items = [{'product_id': r[0], 'product_name': r[1], 'quantity': r[2]} for r in rows]
+    return jsonify({'success': True, 'at': at.isoformat(), 'items': items})
+
+# Stock-in/stock-out time series from the daily rollups.
+# ?from=&to= (YYYY-MM-DD, default the last 30 days), ?grain=day|week|month|year,
+# ?product_id= or ?type= to narrow, ?compare=previous_year to add the same
+# range one year earlier.
+@app.route('/api/stock-flow')
+@login_required
+def stock_flow():
+    grain = request.args.get('grain', 'day')
+    if grain not in ('day', 'week', 'month', 'year'):
+        return jsonify({'success': False, 'message': 'grain must be day, week, month or year'}), 400
+    try:
+        date_to = date.fromisoformat(request.args['to']) if request.args.get('to') else date.today()
+        date_from = (date.fromisoformat(request.args['from']) if request.args.get('from')
+                     else date_to - timedelta(days=29))
+        product_id = request.args.get('product_id', type=int)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'from and to must be YYYY-MM-DD'}), 400
+    if date_from > date_to or (date_to - date_from).days >= STOCK_FLOW_MAX_DAYS:
+        return jsonify({'success': False,
+                        'message': f'Range must run forward and cover at most {STOCK_FLOW_MAX_DAYS} days'}), 400
+    product_type = request.args.get('type') or None
+
+    def year_earlier(day):
+        try:
+            return day.replace(year=day.year - 1)
+        except ValueError:
+            return day.replace(year=day.year - 1, day=28)
+
+    try:
+        conn = get_db()
+        result = {
+            'success': True,
+            'grain': grain,
+            'from': date_from.isoformat(),
+            'to': date_to.isoformat(),
+            'series': stock_flow_series(conn, date_from, date_to, grain, product_id, product_type),
+        }
+        if request.args.get('compare') == 'previous_year':
+            result['previous_year'] = stock_flow_series(conn, year_earlier(date_from), year_earlier(date_to),
+                                                        grain, product_id, product_type)
+        return jsonify(result)
+    except Exception as e:
+        print(f"Error reading stock flow: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error reading stock flow: {str(e)}'}), 500
+
+# Consumption forecast and reorder report, most urgent products first.
+# ?reorder=1 keeps only products with a suggested order, ?product_id=
+# narrows to one product, ?limit= caps the product list.
+@app.route('/api/forecast')
+@login_required
+def forecast_report():
+    report = get_forecast_report()
+    if report is None:
+        return jsonify({'success': False, 'message': 'Forecast is not available yet'}), 503
+
+    rows = report['products']
+    batches = report['batches_at_risk']
+    product_id = request.args.get('product_id', type=int)
+    if product_id is not None:
+        rows = [row for row in rows if row['product_id'] == product_id]
+        batches = [row for row in batches if row['product_id'] == product_id]
+    if request.args.get('reorder') == '1':
+        rows = [row for row in rows if row['suggested_order'] > 0]
+    limit = request.args.get('limit', type=int)
+    if limit:
+        rows = rows[:limit]
+
+    response = jsonify(dict(report, success=True, products=rows, batches_at_risk=batches))
+    response.headers['Cache-Control'] = 'private, max-age=60'
+    return response
+
+# Ranked, typed search across products, batches, suppliers and customers.
+# ?types=product,batch narrows the result types.
+@app.route('/search')
+@login_required
+def search():
+    q = request.args.get('q', '').strip()
+    types = [t for t in request.args.get('types', ','.join(SEARCH_QUERIES)).split(',') if t in SEARCH_QUERIES]
+    if len(q) < 2 or not types:
+        return jsonify({'query': q, 'results': [], 'timed_out': False})
+
+    params = {'q': q, 'prefix': f'{like_escape(q)}%', 'limit': SEARCH_LIMIT}
+    sql = ' UNION ALL '.join(f'({SEARCH_QUERIES[t]})' for t in types)
+
+    conn = None
+    try:
+        conn = get_db()
+        c = conn.cursor()
+        # SET LOCAL lasts until the rollback below
+        c.execute("SET LOCAL statement_timeout = %s", (SEARCH_TIMEOUT_MS,))
+        c.execute("SET LOCAL pg_trgm.word_similarity_threshold = %s", (SEARCH_SIMILARITY,))
+        c.execute(f"SELECT * FROM ({sql}) r ORDER BY 5 DESC, 3 LIMIT %(limit)s", params)
+        results = [{'type': r[0], 'id': r[1], 'label': r[2], 'detail': r[3], 'score': round(float(r[4]), 3)}
+                   for r in c.fetchall()]
+        conn.rollback()
+        return jsonify({'query': q, 'results': results, 'timed_out': False})
+    except psycopg2.errors.QueryCanceled:
+        conn.rollback()
+        return jsonify({'query': q, 'results': [], 'timed_out': True})
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(f"Error in search: {str(e)}")
+        return jsonify({'query': q, 'results': [], 'timed_out': False, 'message': str(e)}), 500
 
 @app.route('/notification')
 @login_required
 def notification():
-    update_expiry_status()
-    update_expiry_notifications()
+    ensure_expiry_reconciled()
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
         c.execute("""
@@ -458,22 +2638,18 @@ def notification():
             ORDER BY created_at DESC
         """)
         notifications = c.fetchall()
-        print("Fetched notifications:", notifications)  # Debug print
         return render_template('notification.html', notifications=notifications)
     except Exception as e:
         print(f"Error in notification route: {str(e)}")
         flash(f'Error loading notifications: {str(e)}', 'error')
         return render_template('notification.html', notifications=[])
-    finally:
-        if conn is not None:
-            conn.close()
 
 @app.route('/add-product', methods=['POST'])
 @login_required
 def add_product():
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
         
@@ -481,16 +2657,20 @@ def add_product():
         product_name = request.form['product_name']
         product_type = request.form['product_type']
         category_id = request.form['category_id']
+        low_stock_threshold = request.form.get('low_stock_threshold') or None
         
         # Insert new product
         c.execute("""
             INSERT INTO Product (product_name, product_type, category_id, 
-                               stock_quantity)
-            VALUES (%s, %s, %s, 0)
+                               stock_quantity, low_stock_threshold)
+            VALUES (%s, %s, %s, 0, COALESCE(%s::int, 10))
             RETURNING id
-        """, (product_name, product_type, category_id))
+        """, (product_name, product_type, category_id, low_stock_threshold))
+        product_id = c.fetchone()[0]
         
         conn.commit()
+        invalidate_dashboard(conn, [product_id])
+        invalidate_reference_data(conn)
         log_activity(session['username'], f"Added product '{product_name}'")
 
         flash('Product added successfully!', 'success')
@@ -501,9 +2681,6 @@ def add_product():
             conn.rollback()
         flash(f'Error adding product: {str(e)}', 'error')
         return redirect(url_for('products'))
-    finally:
-        if conn is not None:
-            conn.close()
 
 @app.route('/edit-product/<int:product_id>', methods=['POST'])
 @login_required
@@ -511,19 +2688,31 @@ def edit_product(product_id):
     product_name = request.form['product_name']
     product_type = request.form['product_type']
     category_id = request.form['category_id']
+    low_stock_threshold = request.form.get('low_stock_threshold') or None
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
+        # stock_status follows a threshold change straight away; otherwise
+        # it is only recomputed by the next purchase write
         c.execute("""
             UPDATE Product
-            SET product_name = %s, product_type = %s, category_id = %s
-            WHERE id = %s
-        """, (product_name, product_type, category_id, product_id))
+            SET product_name = %(name)s, product_type = %(type)s, category_id = %(category_id)s,
+                low_stock_threshold = COALESCE(%(threshold)s::int, low_stock_threshold),
+                stock_status = CASE
+                    WHEN stock_quantity <= 0 THEN 'out of stock'
+                    WHEN stock_quantity < COALESCE(%(threshold)s::int, low_stock_threshold) THEN 'low stock'
+                    ELSE 'in stock'
+                END
+            WHERE id = %(id)s
+        """, {'name': product_name, 'type': product_type, 'category_id': category_id,
+              'threshold': low_stock_threshold, 'id': product_id})
 
         conn.commit()
+        invalidate_dashboard(conn, [product_id])
+        invalidate_reference_data(conn)
         log_activity(session['username'], f"Edited product ID {product_id}")
 
         flash('Product updated successfully!', 'success')
@@ -533,22 +2722,20 @@ def edit_product(product_id):
             conn.rollback()
             return jsonify({'success': False, 'message': f'Error updating product: {str(e)}'})
 
-    finally:
-        if conn:
-            conn.close()
-
 
 @app.route('/delete-product/<int:product_id>', methods=['POST'])
 @login_required
 def delete_product(product_id):
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
         # Either delete or mark inactive
         c.execute("DELETE FROM Product WHERE id = %s", (product_id,))
         conn.commit()
+        invalidate_dashboard(conn, [product_id])
+        invalidate_reference_data(conn)
         log_activity(session['username'], f"Deleted product ID {product_id}")
         
         return jsonify({'success': True, 'message': 'Product deleted successfully!'})
@@ -556,16 +2743,13 @@ def delete_product(product_id):
         if conn:
             conn.rollback()
         return jsonify({'success': False, 'message': 'This product has associated purchases or orders. Please remove references before deleting.'})
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/add-purchase', methods=['POST'])
 @login_required
 def add_purchase():
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
 
@@ -574,13 +2758,15 @@ def add_purchase():
         expiration_date = request.form['expiration_date']
         supplier = request.form['supplier']
 
-        c.execute("""
+        c.execute(f"""
             INSERT INTO Purchase 
-            (product_id, purchase_quantity, remaining_quantity, expiration_date, supplier)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (product_id, purchase_quantity, purchase_quantity, expiration_date, supplier))
+            (product_id, purchase_quantity, remaining_quantity, expiration_date, supplier, status)
+            VALUES (%s, %s, %s, %s, %s, {expiry_status_sql('%s::date')})
+        """, (product_id, purchase_quantity, purchase_quantity, expiration_date, supplier,
+              expiration_date, expiration_date))
 
         conn.commit()
+        invalidate_dashboard(conn, [product_id])
         log_activity(session['username'], f"Added stock-in: product_id {product_id}, qty {purchase_quantity}, expiration {expiration_date}")
 
         return jsonify({'success': True, 'message': 'Purchase added successfully!'})
@@ -588,9 +2774,6 @@ def add_purchase():
         if conn:
             conn.rollback()
         return jsonify({'success': False, 'message': f'Error adding purchase: {str(e)}'})
-    finally:
-        if conn:
-            conn.close()
 
 
 @app.route('/edit-purchase/<int:purchase_id>', methods=['POST'])
@@ -602,25 +2785,45 @@ def edit_purchase(purchase_id):
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
 
-        c.execute("SELECT batch_number FROM Purchase WHERE id = %s", (purchase_id,))
-        batch_number = c.fetchone()[0]
-
-        c.execute("""SELECT COALESCE(SUM(order_quantity), 0) 
-                     FROM "Order" WHERE product_id=%s AND batch_number=%s""",
-                  (product_id, batch_number))
-        total_ordered_quantity = c.fetchone()[0]
-
-        new_remaining_quantity = max(new_purchase_quantity - total_ordered_quantity, 0)
-
-        c.execute("""UPDATE Purchase
-                     SET product_id=%s, purchase_quantity=%s, remaining_quantity=%s, expiration_date=%s
-                     WHERE id=%s""",
-                  (product_id, new_purchase_quantity, new_remaining_quantity, expiration_date, purchase_id))
+        # What has been ordered from the batch is purchase_quantity minus
+        # remaining_quantity, so the new remainder follows from the row
+        # itself. A quantity below what has been ordered is refused rather
+        # than clamped, which would lose the ordered units for good.
+        c.execute(f"""
+            WITH old AS (
+                SELECT id, product_id, purchase_quantity - remaining_quantity AS ordered
+                FROM Purchase
+                WHERE id = %(id)s
+                FOR UPDATE
+            ), updated AS (
+                UPDATE Purchase pu
+                SET product_id = %(product_id)s, purchase_quantity = %(quantity)s,
+                    remaining_quantity = pu.remaining_quantity + %(quantity)s - pu.purchase_quantity,
+                    expiration_date = %(expiration)s,
+                    status = {expiry_status_sql('%(expiration)s::date')}
+                FROM old
+                WHERE pu.id = old.id AND %(quantity)s >= old.ordered
+                RETURNING pu.id
+            )
+            SELECT product_id, ordered, (SELECT COUNT(*) FROM updated) FROM old
+        """, {'id': purchase_id, 'product_id': product_id, 'quantity': new_purchase_quantity,
+              'expiration': expiration_date})
+        row = c.fetchone()
+        if row is None:
+            conn.rollback()
+            return jsonify({'success': False, 'message': 'Purchase not found.'})
+        old_product_id, ordered, updated = row
+        if not updated:
+            conn.rollback()
+            return jsonify({'success': False,
+                            'message': f'{ordered} units of this batch have already been ordered; '
+                                       f'the quantity cannot be lower.'}), 400
         conn.commit()
+        invalidate_dashboard(conn, [product_id, old_product_id])
         log_activity(session['username'], f"Edited stock-in ID {purchase_id}")
 
         return jsonify({'success': True, 'message': "Purchase updated successfully!"})
@@ -628,9 +2831,6 @@ def edit_purchase(purchase_id):
         if conn:
             conn.rollback()
         return jsonify({'success': False, 'message': f'Error updating purchase: {str(e)}'})
-    finally:
-        if conn:
-            conn.close()
 
 
 
@@ -639,7 +2839,7 @@ def edit_purchase(purchase_id):
 def delete_purchase(purchase_id):
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
         c.execute("SELECT product_id, batch_number FROM Purchase WHERE id = %s", (purchase_id,))
@@ -657,6 +2857,7 @@ def delete_purchase(purchase_id):
 
         c.execute("DELETE FROM Purchase WHERE id = %s", (purchase_id,))
         conn.commit()
+        invalidate_dashboard(conn, [product_id])
         log_activity(session['username'], f"Deleted stock-in ID {purchase_id}")
 
         return jsonify({'success': True, 'message': "Purchase deleted successfully!"})
@@ -664,9 +2865,6 @@ def delete_purchase(purchase_id):
         if conn:
             conn.rollback()
         return jsonify({'success': False, 'message': f'Error deleting purchase: {str(e)}'})
-    finally:
-        if conn:
-            conn.close()
 
 
 @app.route('/add-order', methods=['POST'])
@@ -678,75 +2876,156 @@ def add_order():
     order_quantity = int(data.get('order_quantity', 0))
     customer = data.get('customer')
 
-    if not product_id or not batch_number or order_quantity <= 0 or not customer:
+    # Without a batch number the order is allocated first-expiry-first-out
+    if not product_id or order_quantity <= 0 or not customer:
         return jsonify({'success': False, 'message': 'Invalid input'}), 400
+    product_id = int(product_id)
 
+    conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
-        c.execute("""
-            INSERT INTO "Order" (product_id, order_quantity, batch_number, customer)
-            VALUES (%s, %s, %s, %s)
-        """, (product_id, order_quantity, batch_number, customer))
-        conn.commit()
-        log_activity(session['username'], f"Added stock-out: product_id {product_id}, batch {batch_number}, qty {order_quantity}")
+        if batch_number:
+            # Lock the batch, check its stock and insert in one statement; the
+            # stock trigger deducts from the batch we hold locked
+            c.execute("""
+                WITH batch AS (
+                    SELECT id, remaining_quantity
+                    FROM Purchase
+                    WHERE product_id = %(product_id)s AND batch_number = %(batch_number)s
+                    FOR UPDATE
+                ), inserted AS (
+                    INSERT INTO "Order" (product_id, order_quantity, batch_number, customer)
+                    SELECT %(product_id)s, %(quantity)s, %(batch_number)s, %(customer)s
+                    WHERE (SELECT SUM(remaining_quantity) FROM batch) >= %(quantity)s
+                    RETURNING order_id
+                )
+                SELECT (SELECT COUNT(*) FROM batch),
+                       (SELECT COALESCE(SUM(remaining_quantity), 0) FROM batch),
+                       (SELECT order_id FROM inserted)
+            """, {'product_id': product_id, 'batch_number': batch_number,
+                  'quantity': order_quantity, 'customer': customer})
+            found, available, order_id = c.fetchone()
+            if not found:
+                conn.rollback()
+                return jsonify({'success': False, 'message': f'Batch {batch_number} not found for this product'})
+            if order_id is None:
+                raise InsufficientStock(f'Insufficient stock: {available} of {order_quantity} available')
+            allocation = [{'order_id': order_id, 'batch_number': batch_number, 'quantity': order_quantity}]
+        else:
+            allocation = allocate_fefo(conn, product_id, order_quantity)
+            order_ids = execute_values(c, """
+                INSERT INTO "Order" (product_id, order_quantity, batch_number, customer)
+                VALUES %s
+                RETURNING order_id
+            """, [(product_id, line['quantity'], line['batch_number'], customer) for line in allocation],
+                fetch=True)
+            for line, row in zip(allocation, order_ids):
+                line['order_id'] = row[0]
 
-        return jsonify({'success': True, 'message': 'Order added successfully!'})
+        conn.commit()
+        invalidate_dashboard(conn, [product_id])
+        batches = ', '.join(f"{line['batch_number']} x{line['quantity']}" for line in allocation)
+        log_activity(session['username'], f"Added stock-out: product_id {product_id}, batch {batches}, qty {order_quantity}")
+
+        return jsonify({'success': True, 'message': 'Order added successfully!', 'allocation': allocation})
+    except InsufficientStock as e:
+        conn.rollback()
+        return jsonify({'success': False, 'message': str(e)})
     except Exception as e:
         if conn:
             conn.rollback()
         return jsonify({'success': False, 'message': f'Error adding order: {str(e)}'})
-    finally:
-        if conn:
-            conn.close()
 
 
 
+# Moves an order's quantity between batches in one statement. The order row
+# and the (at most two) batches it touches are locked; old and new batch are
+# netted first so a same-batch edit is one update. Stock is only checked on
+# batches the edit takes from, and nothing is written unless all of them
+# can cover it.
+EDIT_ORDER_SQL = """
+    WITH old AS (
+        SELECT product_id, batch_number, order_quantity
+        FROM "Order"
+        WHERE order_id = %(order_id)s
+        FOR UPDATE
+    ), deltas AS (
+        SELECT product_id, batch_number, SUM(delta) AS delta
+        FROM (
+            SELECT product_id, batch_number, order_quantity AS delta FROM old
+            UNION ALL
+            SELECT %(product_id)s, %(batch_number)s, 0 - %(quantity)s FROM old
+        ) d
+        GROUP BY product_id, batch_number
+    ), locked AS (
+        SELECT pu.id, pu.product_id, pu.batch_number, d.delta,
+               pu.remaining_quantity + d.delta AS remaining
+        FROM Purchase pu
+        JOIN deltas d ON pu.product_id = d.product_id AND pu.batch_number = d.batch_number
+        FOR UPDATE OF pu
+    ), checks AS (
+        SELECT EXISTS (SELECT 1 FROM deltas d
+                       WHERE NOT EXISTS (SELECT 1 FROM locked l
+                                         WHERE l.product_id = d.product_id
+                                           AND l.batch_number = d.batch_number)) AS missing,
+               EXISTS (SELECT 1 FROM locked WHERE delta < 0 AND remaining < 0) AS short
+    ), checked AS (
+        SELECT missing, NOT (missing OR short) AS ok FROM checks
+    ), stock AS (
+        UPDATE Purchase pu
+        SET remaining_quantity = l.remaining
+        FROM locked l, checked
+        WHERE pu.id = l.id AND checked.ok AND l.delta <> 0
+        RETURNING pu.id
+    ), updated AS (
+        UPDATE "Order"
+        SET product_id = %(product_id)s, batch_number = %(batch_number)s,
+            order_quantity = %(quantity)s, customer = %(customer)s
+        FROM checked
+        WHERE order_id = %(order_id)s AND checked.ok
+        RETURNING order_id
+    )
+    SELECT (SELECT COUNT(*) FROM old),
+           (SELECT COUNT(*) FROM updated),
+           (SELECT missing FROM checked),
+           (SELECT product_id FROM old)
+"""
+
+
 @app.route('/edit-order/<int:order_id>', methods=['POST'])
 @login_required
 def edit_order(order_id):
     data = request.get_json()
-    product_id = data['product_id']
+    product_id = int(data['product_id'])
     batch_number = data['batch_number']
     new_quantity = int(data['order_quantity'])
+    customer = data.get('customer')
+
+    if new_quantity <= 0 or not batch_number:
+        return jsonify({'success': False, 'message': 'Invalid input'}), 400
 
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
-
-        # Get old order info
-        c.execute('SELECT product_id, batch_number, order_quantity FROM "Order" WHERE order_id=%s', (order_id,))
-        old_order = c.fetchone()
-        if not old_order:
+        c.execute(EDIT_ORDER_SQL, {'order_id': order_id, 'product_id': product_id,
+                                   'batch_number': batch_number, 'quantity': new_quantity,
+                                   'customer': customer})
+        found, updated, missing_batch, old_product_id = c.fetchone()
+        if not found:
+            conn.rollback()
             return jsonify({'success': False, 'message': 'Order not found'})
-
-        old_product_id, old_batch, old_quantity = old_order
-
-        # 1️⃣ Update remaining quantity in old purchase
-        c.execute("""UPDATE Purchase
-                     SET remaining_quantity = remaining_quantity + %s
-                     WHERE product_id=%s AND batch_number=%s""",
-                  (old_quantity, old_product_id, old_batch))
-
-        # 2️⃣ Update order
-        customer = data.get('customer')
-        c.execute("""
-    UPDATE "Order"
-    SET product_id=%s, batch_number=%s, order_quantity=%s, customer=%s
-    WHERE order_id=%s
-""", (product_id, batch_number, new_quantity, customer, order_id))
-
-
-        # 3️⃣ Deduct from new purchase remaining_quantity
-        c.execute("""UPDATE Purchase
-                     SET remaining_quantity = remaining_quantity - %s
-                     WHERE product_id=%s AND batch_number=%s""",
-                  (new_quantity, product_id, batch_number))
+        if not updated:
+            conn.rollback()
+            if missing_batch:
+                return jsonify({'success': False, 'message': f'Batch {batch_number} not found for this product'})
+            return jsonify({'success': False, 'message': f'Insufficient stock in batch {batch_number}'})
 
         conn.commit()
+        invalidate_dashboard(conn, [product_id, old_product_id])
         log_activity(session['username'], f"Edited stock-out ID {order_id}")
 
         return jsonify({'success': True, 'message': 'Order updated successfully'})
@@ -754,9 +3033,6 @@ def edit_order(order_id):
         if conn:
             conn.rollback()
         return jsonify({'success': False, 'message': f'Error editing order: {str(e)}'})
-    finally:
-        if conn:
-            conn.close()
 
 
 @app.route('/delete-order/<int:order_id>', methods=['POST'])
@@ -764,99 +3040,408 @@ def edit_order(order_id):
 def delete_order(order_id):
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
-        # Get order details
-        c.execute('SELECT product_id, batch_number, order_quantity FROM "Order" WHERE order_id=%s', (order_id,))
-        order = c.fetchone()
-        if not order:
+        # Delete the order and return its quantity to the batch in one statement
+        c.execute("""
+            WITH deleted AS (
+                DELETE FROM "Order"
+                WHERE order_id = %s
+                RETURNING product_id, batch_number, order_quantity
+            ), restored AS (
+                UPDATE Purchase pu
+                SET remaining_quantity = pu.remaining_quantity + d.order_quantity
+                FROM deleted d
+                WHERE pu.product_id = d.product_id AND pu.batch_number = d.batch_number
+                RETURNING pu.id
+            )
+            SELECT (SELECT COUNT(*) FROM deleted), (SELECT COUNT(*) FROM restored),
+                   (SELECT product_id FROM deleted)
+        """, (order_id,))
+        deleted, _, product_id = c.fetchone()
+        if not deleted:
+            conn.rollback()
             return jsonify({'success': False, 'message': 'Order not found'})
-
-        product_id, batch_number, quantity = order
-
-        # Update purchase remaining quantity
-        c.execute("""UPDATE Purchase
-                     SET remaining_quantity = remaining_quantity + %s
-                     WHERE product_id=%s AND batch_number=%s""",
-                  (quantity, product_id, batch_number))
-
-        # Delete order
-        c.execute('DELETE FROM "Order" WHERE order_id=%s', (order_id,))
         conn.commit()
 
+        invalidate_dashboard(conn, [product_id])
         log_activity(session['username'], f"Deleted stock-out ID {order_id}")
         return jsonify({'success': True, 'message': 'Order deleted successfully'})
     except Exception as e:
         if conn:
             conn.rollback()
         return jsonify({'success': False, 'message': f'Error deleting order: {str(e)}'})
-    finally:
+
+
+def parse_order_lines(lines):
+    # Returns (parsed, errors): parsed lines keep their position in the
+    # request so results line up with what the client sent
+    parsed, errors = [], {}
+    for i, line in enumerate(lines):
+        try:
+            product_id = int(line['product_id'])
+            quantity = int(line['order_quantity'])
+        except (KeyError, TypeError, ValueError):
+            errors[i] = 'product_id and order_quantity are required'
+            continue
+        if quantity <= 0:
+            errors[i] = 'order_quantity must be positive'
+            continue
+        parsed.append({'line': i, 'product_id': product_id, 'quantity': quantity,
+                       'batch_number': (line.get('batch_number') or '').strip() or None})
+    return parsed, errors
+
+
+def allocate_order_lines(c, lines):
+    # Lock every batch the cart can draw on in one statement (in id order,
+    # so concurrent carts lock in the same order), then allocate the lines
+    # in request order against the locked quantities. A line with a batch
+    # takes from that batch; one without is allocated first-expiry-first-out.
+    explicit = [(line['product_id'], line['batch_number']) for line in lines if line['batch_number']]
+    fefo_products = sorted({line['product_id'] for line in lines if not line['batch_number']})
+    c.execute("""
+        SELECT id, product_id, batch_number, remaining_quantity, expiration_date
+        FROM Purchase
+        WHERE (product_id, batch_number) IN (SELECT * FROM unnest(%s::int[], %s::text[]))
+           OR (product_id = ANY(%s::int[]) AND remaining_quantity > 0 AND expiration_date > CURRENT_DATE)
+        ORDER BY id
+        FOR UPDATE
+    """, ([p for p, _ in explicit], [b for _, b in explicit], fefo_products))
+    batches = {}
+    fefo = {}
+    for batch_id, product_id, batch_number, remaining, expiration in c.fetchall():
+        key = (product_id, batch_number)
+        batches[key] = batches.get(key, 0) + remaining
+        if remaining > 0 and expiration > date.today():
+            fefo.setdefault(product_id, []).append((expiration, batch_id, batch_number))
+    for candidates in fefo.values():
+        candidates.sort()
+
+    for line in lines:
+        if line['batch_number']:
+            key = (line['product_id'], line['batch_number'])
+            if key not in batches:
+                line['error'] = f"Batch {line['batch_number']} not found for this product"
+            elif batches[key] < line['quantity']:
+                line['error'] = f"Insufficient stock: {batches[key]} of {line['quantity']} available"
+            else:
+                batches[key] -= line['quantity']
+                line['allocation'] = [{'batch_number': line['batch_number'], 'quantity': line['quantity']}]
+            continue
+
+        candidates = fefo.get(line['product_id'], [])
+        available = sum(batches[(line['product_id'], b)] for _, _, b in candidates)
+        if available < line['quantity']:
+            line['error'] = f"Insufficient stock: {available} of {line['quantity']} available"
+            continue
+        allocation, needed = [], line['quantity']
+        for _, _, batch_number in candidates:
+            key = (line['product_id'], batch_number)
+            take = min(needed, batches[key])
+            if take > 0:
+                batches[key] -= take
+                allocation.append({'batch_number': batch_number, 'quantity': take})
+                needed -= take
+            if needed == 0:
+                break
+        line['allocation'] = allocation
+
+
+# Many order lines in one transaction. mode 'atomic' (default) adds every
+# line or none; 'partial' adds the lines that can be filled and reports the
+# rest. Accepted lines are inserted with one multi-row INSERT, so the stock
+# trigger deducts from each batch once.
+@app.route('/orders/batch', methods=['POST'])
+@login_required
+def add_order_batch():
+    data = request.get_json(silent=True) or {}
+    customer = data.get('customer')
+    mode = data.get('mode', 'atomic')
+    lines = data.get('lines')
+
+    if not customer or mode not in ('atomic', 'partial') or not isinstance(lines, list) or not lines:
+        return jsonify({'success': False, 'message': 'customer, mode and a non-empty lines list are required'}), 400
+    if len(lines) > ORDER_BATCH_MAX_LINES:
+        return jsonify({'success': False, 'message': f'At most {ORDER_BATCH_MAX_LINES} lines per request'}), 400
+
+    parsed, errors = parse_order_lines(lines)
+    if errors and mode == 'atomic':
+        return jsonify({'success': False, 'message': 'Invalid lines; nothing was added',
+                        'results': [{'line': i, 'success': False, 'message': msg}
+                                    for i, msg in sorted(errors.items())]}), 400
+
+    conn = None
+    try:
+        conn = get_db()
+
+        c = conn.cursor()
+        allocate_order_lines(c, parsed)
+        for line in parsed:
+            if 'error' in line:
+                errors[line['line']] = line.pop('error')
+
+        accepted = [line for line in parsed if line['line'] not in errors]
+        if (mode == 'atomic' and errors) or not accepted:
+            conn.rollback()
+            results = [{'line': i, 'success': False, 'message': msg} for i, msg in sorted(errors.items())]
+            return jsonify({'success': False, 'message': 'No lines were added', 'results': results})
+
+        rows = [(line['product_id'], part['quantity'], part['batch_number'], customer)
+                for line in accepted for part in line['allocation']]
+        order_ids = execute_values(c, """
+            INSERT INTO "Order" (product_id, order_quantity, batch_number, customer)
+            VALUES %s
+            RETURNING order_id
+        """, rows, fetch=True, page_size=len(rows))
+        ids = iter(row[0] for row in order_ids)
+        for line in accepted:
+            for part in line['allocation']:
+                part['order_id'] = next(ids)
+
+        conn.commit()
+        invalidate_dashboard(conn, {line['product_id'] for line in accepted})
+        log_activity(session['username'],
+                     f"Added stock-out batch for {customer}: {len(accepted)} lines, {len(rows)} orders")
+
+        results = [{'line': line['line'], 'success': True, 'allocation': line['allocation']} for line in accepted]
+        results += [{'line': i, 'success': False, 'message': msg} for i, msg in errors.items()]
+        results.sort(key=lambda result: result['line'])
+        return jsonify({
+            'success': True,
+            'message': f'{len(accepted)} of {len(lines)} lines added',
+            'results': results,
+        })
+    except Exception as e:
         if conn:
-            conn.close()
+            conn.rollback()
+        return jsonify({'success': False, 'message': f'Error adding orders: {str(e)}'})
 
 
 def get_notifications(limit=10):
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = get_db()
 
     c = conn.cursor()
     c.execute("SELECT id, message, created_at, is_read FROM Notification ORDER BY created_at DESC LIMIT %s", (limit,))
     notifications = c.fetchall()
-    conn.close()
     return notifications
 
-from flask import jsonify
 
-# Return notifications as JSON
+# Shared with the async notification feed in asgi.py. latest is the
+# (updated_at, id) of the most recently changed row, or None.
+def notification_feed_etag(since, latest):
+    latest = tuple(latest) if latest else None
+    return hashlib.md5(f"{since}|{latest}".encode()).hexdigest()
+
+
+def notification_feed(rows, latest, since):
+    # rows are (id, message, created_at, is_read, ignored, type)
+    notif_list = []
+    removed = []
+    for n in rows:
+        if n[4]:
+            removed.append(n[0])
+            continue
+        notif_list.append({
+            'id': n[0],
+            'message': n[1],
+            'created_at': n[2].isoformat(),
+            'is_read': n[3],
+            'ignored': n[4],
+            'type': n[5]
+        })
+    return {
+        'notifications': notif_list,
+        'removed': removed,
+        'cursor': latest[0].isoformat() if latest else since,
+    }
+
+# Return notifications as JSON.
+# Without ?since= this is every active notification; with ?since=<cursor>
+# only rows changed after the cursor, with ignored rows reported in 'removed'.
+# Rows changed within NOTIFICATION_FEED_OVERLAP of the cursor are sent again
+# so a transaction that commits late is never skipped; clients merge by id.
 @app.route('/notification-json')
 @login_required
 def notification_json():
-    update_expiry_status()
-    update_expiry_notifications()
+    since = request.args.get('since')
+    try:
+        since_ts = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        return jsonify({'error': 'Invalid since cursor'}), 400
+
+    ensure_expiry_reconciled()
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
+        conn = get_db()
 
         c = conn.cursor()
-        # Only return notifications that are not ignored
         c.execute("""
-            SELECT id, message, created_at, is_read, ignored, type
+            SELECT updated_at, id
             FROM notification
-            ORDER BY created_at DESC
+            ORDER BY updated_at DESC, id DESC
+            LIMIT 1
         """)
-        notifications = c.fetchall()
-        notif_list = []
-        for n in notifications:
-            notif_list.append({
-                'id': n[0],
-                'message': n[1],
-                'created_at': n[2].isoformat(),
-                'is_read': n[3],
-                'ignored': n[4],
-                'type': n[5]
-            })
-        return jsonify(notif_list)
+        latest = c.fetchone()
+
+        # Unchanged feed: answer 304 before touching the table again
+        etag = notification_feed_etag(since, latest)
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+            response.set_etag(etag)
+            return response
+
+        if since_ts is None:
+            c.execute("""
+                SELECT id, message, created_at, is_read, ignored, type
+                FROM notification
+                WHERE ignored = FALSE
+                ORDER BY created_at DESC
+            """)
+        else:
+            c.execute("""
+                SELECT id, message, created_at, is_read, ignored, type
+                FROM notification
+                WHERE updated_at > %s - %s * INTERVAL '1 second'
+                ORDER BY created_at DESC
+            """, (since_ts, NOTIFICATION_FEED_OVERLAP))
+
+        response = jsonify(notification_feed(c.fetchall(), latest, since))
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except Exception as e:
         print(f"Error fetching notifications: {str(e)}")
-        return jsonify([])
-    finally:
-        if conn:
-            conn.close()
+        return jsonify({'notifications': [], 'removed': [], 'cursor': since})
 
-@app.route('/touch-notification/<int:notif_id>', methods=['POST'])
+# Server-sent events: one message per notification insert or state change.
+# Connected clients hold no database connection and cost no queries while idle.
+@app.route('/notification-stream')
 @login_required
-def touch_notification(notif_id):
-    conn = psycopg2.connect(DATABASE_URL)
+def notification_stream():
+    listener = get_notification_listener()
+    if listener.subscriber_count() >= SSE_MAX_CLIENTS:
+        return app.response_class('Too many open streams', status=503, headers={'Retry-After': '60'})
+    events = listener.subscribe()
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                try:
+                    payload = events.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'event: notification\ndata: {payload}\n\n'
+        finally:
+            listener.unsubscribe(events)
+
+    return app.response_class(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+def update_notification_state(conn, ids=None, notif_type=None, read=None, ignored=None, touch=False):
+    # One UPDATE for any mix of read/ignored/last_notified changes. Targets
+    # are the given ids, or every active notification (optionally of one
+    # type). Rows already in the requested state are not rewritten.
+    sets, params = [], []
+    if read is not None:
+        sets.append("is_read = %s")
+        params.append(read)
+    if ignored is not None:
+        sets.append("ignored = %s")
+        params.append(ignored)
+    if touch:
+        sets.append("last_notified = NOW()")
+
+    where, where_params = [], []
+    if ids is not None:
+        where.append("id = ANY(%s::int[])")
+        where_params.append(ids)
+    else:
+        where.append("ignored = FALSE")
+    if notif_type is not None:
+        where.append("type = %s")
+        where_params.append(notif_type)
+    if not touch:
+        changed = []
+        if read is not None:
+            changed.append("is_read IS DISTINCT FROM %s")
+            where_params.append(read)
+        if ignored is not None:
+            changed.append("ignored IS DISTINCT FROM %s")
+            where_params.append(ignored)
+        where.append("(" + " OR ".join(changed) + ")")
 
     c = conn.cursor()
-    c.execute("""
+    c.execute(f"""
         UPDATE notification
-        SET last_notified = NOW()
-        WHERE id = %s
-    """, (notif_id,))
+        SET {', '.join(sets)}
+        WHERE {' AND '.join(where)}
+    """, params + where_params)
+    updated = c.rowcount
     conn.commit()
-    conn.close()
-    return jsonify({'status': 'ok'})
+    return updated
+
+
+# Bulk notification state. JSON body:
+#   ids: [1, 2, ...]  or  all: true  (every active notification), optionally
+#   narrowed with type: 'near-expiry'
+#   read / ignored: true|false, touch: true (sets last_notified)
+@app.route('/notifications/state', methods=['POST'])
+@login_required
+def notification_state():
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    notif_type = data.get('type')
+    read = data.get('read')
+    ignored = data.get('ignored')
+    touch = bool(data.get('touch'))
+
+    if ids is not None:
+        if not isinstance(ids, list) or not all(type(i) is int for i in ids):
+            return jsonify({'success': False, 'message': 'ids must be a list of integers'}), 400
+        if not ids:
+            return jsonify({'success': True, 'updated': 0})
+    elif not data.get('all') and notif_type is None:
+        return jsonify({'success': False, 'message': 'Give ids, all or type'}), 400
+    if any(v is not None and not isinstance(v, bool) for v in (read, ignored)):
+        return jsonify({'success': False, 'message': 'read and ignored must be true or false'}), 400
+    if read is None and ignored is None and not touch:
+        return jsonify({'success': False, 'message': 'Nothing to change'}), 400
+
+    conn = None
+    try:
+        conn = get_db()
+        updated = update_notification_state(conn, ids=ids, notif_type=notif_type,
+                                            read=read, ignored=ignored, touch=touch)
+        if ids is None:
+            target = f"type {notif_type}" if notif_type else "all"
+            changes = ', '.join(k for k, v in (('read', read), ('ignored', ignored)) if v is not None)
+            log_activity(session['username'], f"Set {changes} on {updated} notifications ({target})")
+        return jsonify({'success': True, 'updated': updated})
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(f"Error updating notifications: {str(e)}")
+        return jsonify({'success': False, 'message': f'Error updating notifications: {str(e)}'})
+
+
+@app.route('/touch-notification/<int:notif_id>', methods=['POST'])
+@login_required
+def touch_notification(notif_id):
+    conn = None
+    try:
+        conn = get_db()
+        update_notification_state(conn, ids=[notif_id], touch=True)
+        return jsonify({'status': 'ok'})
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(f"Error touching notification: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)})
 
 # Mark a notification as ignored
 @app.route('/ignore-notification/<int:notif_id>', methods=['POST'])
@@ -864,40 +3449,234 @@ def touch_notification(notif_id):
 def ignore_notification(notif_id):
     conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-
-        c = conn.cursor()
-        c.execute("""
-            UPDATE notification
-            SET ignored = TRUE
-            WHERE id = %s
-        """, (notif_id,))
-        conn.commit()
+        conn = get_db()
+        update_notification_state(conn, ids=[notif_id], ignored=True)
         return jsonify({'status': 'success'})
     except Exception as e:
+        if conn:
+            conn.rollback()
         print(f"Error ignoring notification: {str(e)}")
         return jsonify({'status': 'error', 'message': str(e)})
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/read-notification/<int:notif_id>', methods=['POST'])
 @login_required
 def read_notification(notif_id):
-    conn = psycopg2.connect(DATABASE_URL)
+    conn = None
+    try:
+        conn = get_db()
+        update_notification_state(conn, ids=[notif_id], read=True)
+        return jsonify({'status': 'ok'})
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        print(f"Error reading notification: {str(e)}")
+        return jsonify({'status': 'error', 'message': str(e)})
 
-    c = conn.cursor()
-    c.execute("""
-        UPDATE notification
-        SET is_read = TRUE
-        WHERE id = %s
-    """, (notif_id,))
-    conn.commit()
-    conn.close()
-    return jsonify({'status': 'ok'})
+
+# Streaming export: ?format=csv|jsonl, ?from=/?to= (inclusive dates) and
+# ?product_id= (orders and purchases)
+@app.route('/export/<any(orders, purchases, activity):kind>')
+@login_required
+def export_data(kind):
+    spec = EXPORT_SPECS[kind]
+    fmt = 'jsonl' if request.args.get('format') == 'jsonl' else 'csv'
+    try:
+        date_from = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+        date_to = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+        product_id = request.args.get('product_id', type=int)
+    except ValueError:
+        return jsonify({'success': False, 'message': 'Invalid date filter'}), 400
+
+    sql, params = export_query(spec, date_from, date_to, product_id)
+    log_activity(session['username'], f"Exported {kind}")
+    filename = f"{kind}-{datetime.now():%Y%m%d-%H%M%S}.{fmt}"
+    return app.response_class(
+        stream_export(spec, sql, params, fmt),
+        mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                 'X-Accel-Buffering': 'no'})
+
+
+# Bulk import. Send the file as multipart field 'file' or as the raw body;
+# ?format=csv|jsonl (default from the file name, else csv). Valid rows are
+# imported and invalid ones reported, or with ?atomic=1 nothing is imported
+# if any row is invalid.
+@app.route('/import/<any(products, purchases):kind>', methods=['POST'])
+@login_required
+def import_data(kind):
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    fmt = import_format(upload.filename if upload else None, request.args.get('format'))
+    atomic = request.args.get('atomic') == '1'
+
+    conn = None
+    try:
+        conn = get_db()
+        report = import_rows(conn, kind, stream, fmt, atomic)
+        if report['imported']:
+            invalidate_dashboard(conn)
+            if kind == 'products':
+                invalidate_reference_data(conn)
+            log_activity(session['username'], f"Imported {report['imported']} {kind}")
+        return jsonify({'success': not (atomic and report['rejected']), **report})
+    except Exception as e:
+        if conn:
+            conn.rollback()
+        return jsonify({'success': False, 'message': f'Error importing {kind}: {str(e)}'})
+
+
+@app.cli.command('import-data')
+@click.argument('kind', type=click.Choice(list(IMPORT_SPECS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None)
+@click.option('--atomic', is_flag=True, help='Import nothing if any row is invalid.')
+def import_data_command(kind, path, fmt, atomic):
+    """Bulk import products or purchases from a CSV or JSONL file."""
+    with open(path, 'rb') as f:
+        conn = get_db()
+        report = import_rows(conn, kind, f, import_format(path, fmt), atomic)
+        if report['imported']:
+            invalidate_dashboard(conn)
+            if kind == 'products':
+                invalidate_reference_data(conn)
+            log_activity('cli', f"Imported {report['imported']} {kind} from {os.path.basename(path)}")
+    click.echo(json.dumps(report, indent=2))
+
+
+@app.cli.command('db-upgrade')
+def db_upgrade_command():
+    """Apply pending schema migrations."""
+    with db_connection() as conn:
+        applied = apply_migrations(conn)
+    click.echo(f"{len(applied)} migration(s) applied")
+
+
+@app.cli.command('db-verify-plans')
+def db_verify_plans_command():
+    """Check that the hot queries are planned on their indexes."""
+    with db_connection() as conn:
+        failures = verify_query_plans(conn)
+    for failure in failures:
+        click.echo(failure, err=True)
+    if failures:
+        raise SystemExit(1)
+    click.echo(f"{len(PLAN_CHECKS)} query plans OK")
+
+
+@app.cli.command('stock-snapshot')
+def stock_snapshot_command():
+    """Take any stock ledger snapshots that are due."""
+    with db_connection() as conn:
+        taken = take_stock_snapshots(conn)
+    for snapshot_date, batches in taken:
+        click.echo(f"Snapshot {snapshot_date}: {batches} batches")
+    if not taken:
+        click.echo("No snapshot due")
+
+
+@app.cli.command('stock-reconcile')
+def stock_reconcile_command():
+    """Check stock counters against the stock ledger; exits 1 on any mismatch."""
+    with db_connection() as conn:
+        mismatches = reconcile_stock_ledger(conn)
+    for level, product_id, batch_number, counter, ledger in mismatches:
+        where = f"product {product_id}" + (f" batch {batch_number}" if batch_number else "")
+        click.echo(f"{level} mismatch: {where}: counter {counter}, ledger {ledger}", err=True)
+    if mismatches:
+        raise SystemExit(1)
+    click.echo("Stock counters match the ledger")
+
+
+@app.cli.command('stock-flow-rollup')
+@click.option('--rebuild', is_flag=True, help='Recompute the daily rollups from Purchase and "Order" first.')
+def stock_flow_rollup_command(rebuild):
+    """Roll the daily stock flow up by product type (the nightly job)."""
+    with db_connection() as conn:
+        days = refresh_stock_flow_rollups(conn, rebuild=rebuild)
+    if days is None:
+        click.echo("Another worker is rolling up stock flow; try again shortly", err=True)
+        raise SystemExit(1)
+    click.echo(f"Rolled up {days} days")
+
+
+@app.cli.command('reconcile')
+def reconcile_command():
+    """Reconcile batch expiry status and raise/resolve stock and expiry alerts."""
+    with db_connection() as conn:
+        if not reconcile_expiry(conn):
+            click.echo("Another worker is reconciling; try again shortly", err=True)
+            raise SystemExit(1)
+
+
+# Runtime statistics for this worker process
+@app.route('/stats')
+@login_required
+def stats():
+    return jsonify({
+        'pool': get_pool().stats(),
+        'stream_clients': notification_listener.subscriber_count() if notification_listener else 0,
+        'activity_writer': activity_writer.stats() if activity_writer else None,
+        'password_hashing': hash_executor.stats() if hash_executor else None,
+    })
+
+
+# Slow and repeated statements captured by QUERY_PROFILING
+@app.route('/debug/queries')
+@admin_required
+def debug_queries():
+    with _query_log_lock:
+        entries = list(query_log)
+    entries.reverse()
+
+    # Slow statements grouped by SQL text, worst total time first
+    hotspots = {}
+    for entry in entries:
+        if entry['kind'] != 'slow':
+            continue
+        spot = hotspots.setdefault(entry['sql'], {'sql': entry['sql'], 'count': 0, 'total_ms': 0.0,
+                                                  'max_ms': 0.0, 'call_site': entry['call_site']})
+        spot['count'] += 1
+        spot['total_ms'] = round(spot['total_ms'] + entry['ms'], 2)
+        spot['max_ms'] = max(spot['max_ms'], entry['ms'])
+    hotspots = sorted(hotspots.values(), key=lambda spot: spot['total_ms'], reverse=True)
+
+    if request.args.get('format') == 'json':
+        return jsonify({'enabled': QUERY_PROFILING, 'threshold_ms': SLOW_QUERY_MS,
+                        'hotspots': hotspots, 'entries': entries})
+    return render_template('debug_queries.html', enabled=QUERY_PROFILING, threshold_ms=SLOW_QUERY_MS,
+                           hotspots=hotspots, entries=entries)
+
+
+# Prometheus scrape endpoint for this worker process
+@app.route('/metrics')
+def metrics_endpoint():
+    if METRICS_TOKEN:
+        if request.headers.get('Authorization') != f'Bearer {METRICS_TOKEN}':
+            return 'Unauthorized', 401
+    elif 'logged_in' not in session:
+        return 'Unauthorized', 401
+    elif session.get('role') != 'admin':
+        return 'Forbidden', 403
+    pool_stats = get_pool().stats()
+    gauges = [
+        ('medisync_db_pool_in_use', pool_stats['in_use']),
+        ('medisync_db_pool_idle', pool_stats['idle']),
+        ('medisync_db_pool_max', pool_stats['max_size']),
+        ('medisync_db_pool_timeouts_total', pool_stats['timeouts']),
+        ('medisync_stream_clients', notification_listener.subscriber_count() if notification_listener else 0),
+    ]
+    if activity_writer:
+        gauges.append(('medisync_activity_queue_depth', activity_writer.stats()['queue_depth']))
+    if hash_executor:
+        gauges.append(('medisync_auth_hash_rejected_total', hash_executor.stats()['rejected']))
+    return metrics.render(gauges), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 
 if __name__ == '__main__':
     init_db()
-    from waitress import serve
-    serve(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
+    if SERVER_MODE == 'async':
+        import uvicorn
+        uvicorn.run('asgi:app', host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
+    else:
+        from waitress import serve
+        serve(app, host='0.0.0.0', port=int(os.environ.get('PORT', 8080)))
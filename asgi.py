@@ -0,0 +1,421 @@
+"""ASGI entry point for the async serving mode (SERVER_MODE=async).
+
+The dashboard, the notification poll and the notification stream are
+served natively on asyncpg: the dashboard aggregates run concurrently when
+the summary needs rebuilding, and an idle poll or stream client costs a
+coroutine rather than a thread. Every other route is the unchanged Flask
+app, run on a thread pool through a2wsgi.
+
+    SERVER_MODE=async gunicorn -c gunicorn.conf.py
+
+Sessions are the Flask session cookie, so a user logged in through either
+side is logged in on both. Run bench.py with --url against each mode to
+compare them.
+"""
+import asyncio
+import json
+import time
+from datetime import date, datetime
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+import asyncpg
+from a2wsgi import WSGIMiddleware
+from flask import flash, render_template, session as flask_session
+from itsdangerous import BadSignature
+
+import app as medisync
+
+flask_app = medisync.app
+wsgi_app = WSGIMiddleware(flask_app, workers=medisync.ASYNC_WSGI_THREADS)
+
+
+class AsyncDatabase:
+    """asyncpg pool plus the shared LISTEN connection for the stream."""
+
+    def __init__(self, dsn, max_size):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.pool = None
+        self.hub = None
+        self._lock = asyncio.Lock()
+
+    async def start(self):
+        async with self._lock:
+            if self.pool is None:
+                self.pool = await asyncpg.create_pool(self.dsn, min_size=1, max_size=self.max_size)
+                self.hub = NotificationHub(self.dsn, medisync.NOTIFICATION_CHANNEL)
+                self.hub.start()
+
+    async def close(self):
+        if self.hub:
+            await self.hub.stop()
+        if self.pool:
+            await self.pool.close()
+
+
+class NotificationHub:
+    """Async counterpart of app.NotificationListener.
+
+    One LISTEN connection per worker fans payloads out to subscriber
+    queues; a subscriber more than ``max_backlog`` events behind drops them.
+    """
+
+    def __init__(self, dsn, channel, max_backlog=100):
+        self.dsn = dsn
+        self.channel = channel
+        self.max_backlog = max_backlog
+        self.subscribers = set()
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def subscribe(self):
+        events = asyncio.Queue(maxsize=self.max_backlog)
+        self.subscribers.add(events)
+        return events
+
+    def unsubscribe(self, events):
+        self.subscribers.discard(events)
+
+    def publish(self, connection, pid, channel, payload):
+        for events in list(self.subscribers):
+            try:
+                events.put_nowait(payload)
+            except asyncio.QueueFull:
+                pass
+
+    async def run(self):
+        while True:
+            try:
+                conn = await asyncpg.connect(self.dsn)
+                closed = asyncio.Event()
+                conn.add_termination_listener(lambda _: closed.set())
+                await conn.add_listener(self.channel, self.publish)
+                try:
+                    await closed.wait()
+                finally:
+                    await conn.close()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error in notification hub, reconnecting: {e}")
+            await asyncio.sleep(5)
+
+
+db = AsyncDatabase(medisync.DATABASE_URL, medisync.ASYNC_DB_POOL_MAX)
+
+
+# ---------------------------------------------------------------------------
+# Request helpers
+
+def request_session(scope):
+    # Decode the signed Flask session cookie
+    cookies = SimpleCookie()
+    for name, value in scope['headers']:
+        if name == b'cookie':
+            cookies.load(value.decode('latin-1'))
+    cookie = cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if cookie is None or serializer is None:
+        return {}
+    try:
+        return serializer.loads(cookie.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def request_header(scope, name):
+    name = name.lower().encode()
+    for key, value in scope['headers']:
+        if key == name:
+            return value.decode('latin-1')
+    return None
+
+
+def etag_matches(scope, etag):
+    header = request_header(scope, 'if-none-match')
+    if not header:
+        return False
+    tags = [tag.strip().removeprefix('W/').strip('"') for tag in header.split(',')]
+    return etag in tags or '*' in tags
+
+
+async def respond(send, status, body=b'', content_type='text/plain; charset=utf-8', headers=()):
+    if isinstance(body, str):
+        body = body.encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', content_type.encode())]
+                   + [(k.encode(), v.encode()) for k, v in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def redirect_to_login(send):
+    await respond(send, 302, headers=[('location', '/')])
+
+
+async def ensure_expiry_reconciled():
+    # The reconcile itself stays on the sync path; only a worker that is
+    # behind today's watermark pays for the thread hop
+    if medisync._expiry_reconciled_on == date.today().isoformat():
+        return
+
+    def reconcile():
+        with flask_app.app_context():
+            medisync.ensure_expiry_reconciled()
+
+    await asyncio.to_thread(reconcile)
+
+
+# ---------------------------------------------------------------------------
+# Dashboard
+
+# The same figures as refresh_dashboard_summary(), one query per group of
+# columns so they can run concurrently on separate connections
+DASHBOARD_QUERIES = [
+    (('total_stocks',), "SELECT COALESCE(SUM(stock_quantity), 0)::bigint FROM Product WHERE status = 'active'"),
+    (('medicines',), "SELECT COUNT(*) FROM Product WHERE status = 'active' AND product_type = 'medicine'"),
+    (('supplies',), "SELECT COUNT(*) FROM Product WHERE status = 'active' AND product_type = 'supply'"),
+    (('stockins_medicines', 'stockins_supplies', 'stockouts_medicines', 'stockouts_supplies'), f"""
+        SELECT COALESCE(stockins_medicines, 0)::bigint, COALESCE(stockins_supplies, 0)::bigint,
+               COALESCE(stockouts_medicines, 0)::bigint, COALESCE(stockouts_supplies, 0)::bigint
+        FROM ({medisync.DASHBOARD_FLOW_SQL}) fl"""),
+    (('out_of_stocks',), "SELECT COUNT(*) FROM Product WHERE stock_status = 'out of stock' AND status = 'active'"),
+    (('total_orders',), 'SELECT COUNT(*) FROM "Order"'),
+    (('expiring_soon',), """
+        SELECT COALESCE(json_agg(json_build_object(
+                    'code', p.id, 'name', pr.product_name, 'expiration', p.expiration_date)
+                    ORDER BY p.expiration_date), '[]')
+        FROM Purchase p
+        JOIN Product pr ON p.product_id = pr.id
+        WHERE p.status = 'near expiry'"""),
+]
+
+
+async def fetch_row(sql, *args):
+    async with db.pool.acquire() as conn:
+        return await conn.fetchrow(sql, *args)
+
+
+async def refresh_dashboard_summary():
+    # The version is read before the aggregates, so a write that commits
+    # while they run leaves the row stale rather than being lost
+    version = (await fetch_row(
+        "SELECT COALESCE((SELECT version FROM dashboard_summary WHERE id = 1), 1)"))[0]
+    rows = await asyncio.gather(*(fetch_row(sql) for _, sql in DASHBOARD_QUERIES))
+
+    summary = {}
+    for (columns, _), row in zip(DASHBOARD_QUERIES, rows):
+        summary.update(zip(columns, row))
+
+    columns = medisync.DASHBOARD_COLUMNS
+    params = [summary[col] for col in columns]
+    placeholders = ', '.join(f'${i + 1}' + ('::json' if col == 'expiring_soon' else '')
+                             for i, col in enumerate(columns))
+    async with db.pool.acquire() as conn:
+        await conn.execute(f"""
+            INSERT INTO dashboard_summary (id, {', '.join(columns)},
+                                           refreshed_version, refreshed_on, refreshed_at)
+            VALUES (1, {placeholders}, ${len(columns) + 1}, CURRENT_DATE, NOW())
+            ON CONFLICT (id) DO UPDATE SET
+                {', '.join(f'{col} = EXCLUDED.{col}' for col in columns)},
+                refreshed_version = EXCLUDED.refreshed_version,
+                refreshed_on = EXCLUDED.refreshed_on,
+                refreshed_at = EXCLUDED.refreshed_at
+        """, *params, version)
+
+    summary['expiring_soon'] = json.loads(summary['expiring_soon'])
+    return summary
+
+
+async def get_dashboard_summary():
+    # Same cache and staleness rules as app.get_dashboard_summary(); the
+    # in-process cache is shared with the sync routes in this worker
+    cache = medisync._dashboard_cache
+    cached = cache['summary']
+    if cached is not None and time.monotonic() - cache['at'] < medisync.DASHBOARD_CACHE_TTL:
+        return cached
+
+    columns = medisync.DASHBOARD_COLUMNS
+    row = await fetch_row(f"""
+        SELECT {', '.join(columns)},
+               version > refreshed_version OR refreshed_on IS DISTINCT FROM CURRENT_DATE
+        FROM dashboard_summary
+        WHERE id = 1
+    """)
+    if row is None or row[-1]:
+        summary = await refresh_dashboard_summary()
+    else:
+        summary = dict(zip(columns, row[:-1]))
+        summary['expiring_soon'] = json.loads(summary['expiring_soon'])
+
+    cache['summary'] = summary
+    cache['at'] = time.monotonic()
+    return summary
+
+
+async def dashboard(scope, receive, send, session):
+    await ensure_expiry_reconciled()
+    error = None
+    try:
+        summary = await get_dashboard_summary()
+    except Exception as e:
+        # As app.dashboard(): flash the error and show an empty dashboard
+        print(f"Error in dashboard route: {str(e)}")
+        error = e
+        summary = dict.fromkeys(medisync.DASHBOARD_COLUMNS, 0) | {'expiring_soon': []}
+
+    # Rendering needs a request context for url_for and session in
+    # layout.html. The template pops flashed messages from the session, so
+    # it is saved back onto the response like Flask would.
+    cookie = request_header(scope, 'cookie')
+    with flask_app.test_request_context('/dashboard', headers={'Cookie': cookie} if cookie else {}):
+        if error is not None:
+            flash(f'Error loading dashboard: {str(error)}', 'error')
+        html = render_template('admin.html', **medisync.dashboard_context(summary))
+        response = flask_app.response_class(html)
+        flask_app.session_interface.save_session(flask_app, flask_session, response)
+    headers = [(name, value) for name, value in response.headers.items()
+               if name.lower() in ('set-cookie', 'vary')]
+    await respond(send, 200, html, 'text/html; charset=utf-8', headers=headers)
+
+
+# ---------------------------------------------------------------------------
+# Notifications
+
+async def notification_json(scope, receive, send, session):
+    query = parse_qs(scope['query_string'].decode())
+    since = query.get('since', [None])[0]
+    try:
+        since_ts = datetime.fromisoformat(since) if since else None
+    except ValueError:
+        await respond(send, 400, json.dumps({'error': 'Invalid since cursor'}), 'application/json')
+        return
+
+    await ensure_expiry_reconciled()
+    try:
+        async with db.pool.acquire() as conn:
+            latest = await conn.fetchrow("""
+                SELECT updated_at, id
+                FROM notification
+                ORDER BY updated_at DESC, id DESC
+                LIMIT 1
+            """)
+
+            etag = medisync.notification_feed_etag(since, latest)
+            if etag_matches(scope, etag):
+                await respond(send, 304, headers=[('etag', f'"{etag}"')])
+                return
+
+            if since_ts is None:
+                rows = await conn.fetch("""
+                    SELECT id, message, created_at, is_read, ignored, type
+                    FROM notification
+                    WHERE ignored = FALSE
+                    ORDER BY created_at DESC
+                """)
+            else:
+                rows = await conn.fetch("""
+                    SELECT id, message, created_at, is_read, ignored, type
+                    FROM notification
+                    WHERE updated_at > $1::timestamp - $2::int * INTERVAL '1 second'
+                    ORDER BY created_at DESC
+                """, since_ts, medisync.NOTIFICATION_FEED_OVERLAP)
+    except Exception as e:
+        print(f"Error fetching notifications: {str(e)}")
+        await respond(send, 200, json.dumps({'notifications': [], 'removed': [], 'cursor': since}),
+                      'application/json')
+        return
+
+    body = json.dumps(medisync.notification_feed(rows, latest, since))
+    await respond(send, 200, body, 'application/json',
+                  headers=[('etag', f'"{etag}"'), ('cache-control', 'no-cache')])
+
+
+async def notification_stream(scope, receive, send, session):
+    events = db.hub.subscribe()
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', b'text/event-stream'),
+                        (b'cache-control', b'no-cache'),
+                        (b'x-accel-buffering', b'no')],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n', 'more_body': True})
+        while not disconnected.done():
+            next_event = asyncio.ensure_future(events.get())
+            done, _ = await asyncio.wait({next_event, disconnected}, timeout=medisync.SSE_HEARTBEAT_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if next_event in done:
+                message = f'event: notification\ndata: {next_event.result()}\n\n'
+            else:
+                next_event.cancel()
+                if disconnected in done:
+                    break
+                message = ': keep-alive\n\n'
+            await send({'type': 'http.response.body', 'body': message.encode(), 'more_body': True})
+    finally:
+        disconnected.cancel()
+        db.hub.unsubscribe(events)
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+# ---------------------------------------------------------------------------
+# Application
+
+ROUTES = {
+    ('GET', '/dashboard'): dashboard,
+    ('GET', '/notification-json'): notification_json,
+    ('GET', '/notification-stream'): notification_stream,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await db.start()
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await db.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    handler = ROUTES.get((scope.get('method'), scope.get('path'))) if scope['type'] == 'http' else None
+    if handler is None:
+        await wsgi_app(scope, receive, send)
+        return
+
+    session = request_session(scope)
+    if not session.get('logged_in'):
+        await redirect_to_login(send)
+        return
+    if db.pool is None:
+        await db.start()
+    await handler(scope, receive, send, session)
@@ -0,0 +1,832 @@
+"""Load test and benchmark harness for MediSync.
+
+Seed a local PostgreSQL database with a synthetic dataset, then drive the
+routes with concurrent virtual users and write the results as JSON:
+
+    DATABASE_URL=postgresql://localhost/medisync_bench python bench.py seed --products 2000
+    DATABASE_URL=postgresql://localhost/medisync_bench python bench.py run --users 16 --duration 60 --out before.json
+    python bench.py compare before.json after.json
+    DATABASE_URL=... python bench.py login --methods pbkdf2:sha256:600000,scrypt:32768:8:1
+    DATABASE_URL=... python bench.py stress --writers 50 --stock 2000
+    DATABASE_URL=... python bench.py seed --products 10000 --batches 60000 --orders 3000000 --days 1095
+    DATABASE_URL=... python bench.py forecast
+    python bench.py forecast --synthetic --products 10000 --days 1095
+
+``run`` uses the Flask test client in-process by default. Pass ``--url`` to
+drive a running server instead (start it with QUERY_COUNT_HEADER=1 to get
+queries per request).
+"""
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime
+
+import numpy as np
+
+# Must be set before app is imported; the header is how queries per request
+# are counted in both modes
+os.environ.setdefault('QUERY_COUNT_HEADER', '1')
+
+import app as medisync
+from werkzeug.security import check_password_hash, generate_password_hash
+
+BENCH_USERNAME = 'bench'
+BENCH_PASSWORD = 'bench-password'
+
+
+# ---------------------------------------------------------------------------
+# Dataset
+
+def seed(args):
+    rnd_seed = (args.seed % 1000) / 1000.0
+    with medisync.db_connection() as conn:
+        medisync.apply_migrations(conn)
+        c = conn.cursor()
+        c.execute("SELECT setseed(%s)", (rnd_seed,))
+
+        c.execute('''TRUNCATE "Order", Purchase, notification, Product, Category, user_activity,
+                              stock_movement, stock_snapshot, stock_snapshot_run,
+                              stock_flow_daily, stock_flow_daily_type, stock_flow_dirty_day
+                     RESTART IDENTITY CASCADE''')
+        c.execute("DELETE FROM app_state WHERE key = 'stock_flow_rolled_through'")
+
+        c.execute("""
+            INSERT INTO Category (category_name)
+            SELECT 'Category ' || g FROM generate_series(1, %s) g
+        """, (args.categories,))
+
+        c.execute("""
+            INSERT INTO Product (product_name, product_type, category_id, stock_quantity, stock_status, status)
+            SELECT
+                'Product ' || g || ' ' || (ARRAY['Paracetamol', 'Amoxicillin', 'Gauze', 'Syringe',
+                                                 'Ibuprofen', 'Cetirizine', 'Bandage', 'Saline'])[1 + g %% 8],
+                CASE WHEN g %% 3 = 0 THEN 'supply' ELSE 'medicine' END,
+                1 + g %% %s,
+                0, 'out of stock', 'active'
+            FROM generate_series(1, %s) g
+        """, (args.categories, args.products))
+
+        c.execute("""
+            INSERT INTO Purchase (product_id, batch_number, purchase_quantity, remaining_quantity,
+                                  expiration_date, supplier, purchase_date)
+            SELECT product_id, 'B' || lpad(g::text, 6, '0'), quantity, quantity,
+                   purchase_date + shelf_days, 'Supplier ' || supplier, purchase_date
+            FROM (
+                SELECT g,
+                       1 + (g - 1) %% %s AS product_id,
+                       100 + floor(random() * 900)::int AS quantity,
+                       CURRENT_DATE - floor(random() * %s)::int AS purchase_date,
+                       30 + floor(random() * 700)::int AS shelf_days,
+                       1 + floor(random() * 50)::int AS supplier
+                FROM generate_series(1, %s) g
+            ) s
+        """, (args.products, args.days, args.batches))
+        c.execute("SELECT setval('purchase_batch_seq', %s)", (args.batches,))
+        c.execute(f"UPDATE Purchase SET status = {medisync.expiry_status_sql('expiration_date')}")
+
+        # Orders go through the stock triggers like real stock-outs do
+        c.execute("""
+            INSERT INTO "Order" (product_id, order_quantity, batch_number, customer, order_date)
+            SELECT pu.product_id, 1 + floor(random() * 5)::int, pu.batch_number,
+                   'Customer ' || (g %% 500), GREATEST(pu.purchase_date, CURRENT_DATE - floor(random() * %s)::int)
+            FROM generate_series(1, %s) g
+            JOIN Purchase pu ON pu.id = 1 + (g - 1) %% %s
+        """, (args.days, args.orders, args.batches))
+
+        c.execute("""
+            INSERT INTO notification (message, type, product_id, batch_id, is_read, ignored, created_at)
+            SELECT 'Batch ' || pu.batch_number || ' needs attention',
+                   (ARRAY['low-stock', 'out-of-stock', 'near-expiry', 'expired'])[1 + g %% 4],
+                   pu.product_id, pu.batch_number, g %% 5 = 0, g %% 7 = 0,
+                   NOW() - make_interval(mins => g)
+            FROM generate_series(1, %s) g
+            JOIN Purchase pu ON pu.id = 1 + (g - 1) %% %s
+        """, (args.notifications, args.batches))
+
+        c.execute("""
+            UPDATE Product p
+            SET stock_quantity = s.quantity,
+                stock_status = CASE WHEN s.quantity <= 0 THEN 'out of stock'
+                                    WHEN s.quantity < 10 THEN 'low stock'
+                                    ELSE 'in stock' END
+            FROM (SELECT product_id, SUM(remaining_quantity) AS quantity
+                  FROM Purchase GROUP BY product_id) s
+            WHERE p.id = s.product_id
+        """)
+
+        c.execute("""
+            INSERT INTO users (username, password, full_name, role)
+            VALUES (%s, %s, 'Benchmark User', 'admin')
+            ON CONFLICT (username) DO UPDATE SET password = EXCLUDED.password
+        """, (BENCH_USERNAME, medisync.hash_password(BENCH_PASSWORD)))
+        conn.commit()
+
+        c.execute("ANALYZE")
+        conn.commit()
+        medisync.refresh_stock_flow_rollups(conn)
+        medisync.refresh_dashboard_summary(conn)
+
+    print(f"Seeded {args.products} products, {args.batches} batches, {args.orders} orders, "
+          f"{args.notifications} notifications")
+
+
+# ---------------------------------------------------------------------------
+# Clients. Both return (status, headers, body) and keep a session cookie.
+
+class TestClient:
+    def __init__(self):
+        self.client = medisync.app.test_client()
+
+    def request(self, method, path, form=None, json_body=None, headers=None):
+        response = self.client.open(path, method=method, data=form, json=json_body, headers=headers or {})
+        return response.status_code, response.headers, response.get_data()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class HTTPClient:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+
+    def request(self, method, path, form=None, json_body=None, headers=None):
+        headers = dict(headers or {})
+        data = None
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=60) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            # Redirects and 304s land here too; they are not failures
+            return e.code, e.headers, e.read()
+
+
+# ---------------------------------------------------------------------------
+# Scenarios. Each takes a virtual user and returns (status, headers, body).
+
+class OrderPool:
+    """Orders shared by the virtual users: half are edited, the rest deleted once each."""
+
+    def __init__(self, rows):
+        self.lock = threading.Lock()
+        self.editable = rows[:len(rows) // 2]
+        self.deletable = [row[0] for row in rows[len(rows) // 2:]]
+
+    def take_deletable(self):
+        with self.lock:
+            return self.deletable.pop() if self.deletable else None
+
+
+class VirtualUser:
+    def __init__(self, client, rnd, context):
+        self.client = client
+        self.rnd = rnd
+        self.context = context
+        self.notif_cursor = None
+        self.notif_etag = None
+
+    def login(self):
+        return self.client.request('POST', '/auth', form={'username': BENCH_USERNAME, 'password': BENCH_PASSWORD})
+
+
+def scenario_auth(vu):
+    return vu.login()
+
+
+def scenario_dashboard(vu):
+    return vu.client.request('GET', '/dashboard')
+
+
+def scenario_products(vu):
+    return vu.client.request('GET', '/products')
+
+
+def scenario_purchases(vu):
+    return vu.client.request('GET', '/purchases')
+
+
+def scenario_orders(vu):
+    return vu.client.request('GET', '/orders')
+
+
+def scenario_list_filter(vu):
+    term = vu.rnd.choice(['para', 'amox', 'gauze', 'syr', 'ibu', 'product 1'])
+    return vu.client.request('GET', '/api/products?' + urllib.parse.urlencode({'q': term}))
+
+
+def scenario_notification_poll(vu):
+    # Mirrors the 30s poll in layout.html, including the cursor and ETag
+    path = '/notification-json'
+    if vu.notif_cursor:
+        path += '?' + urllib.parse.urlencode({'since': vu.notif_cursor})
+    headers = {'If-None-Match': vu.notif_etag} if vu.notif_etag else {}
+    status, response_headers, body = vu.client.request('GET', path, headers=headers)
+    if status == 200:
+        vu.notif_etag = response_headers.get('ETag')
+        vu.notif_cursor = json.loads(body).get('cursor')
+    return status, response_headers, body
+
+
+def scenario_add_order(vu):
+    product_id = vu.rnd.randint(1, vu.context['products'])
+    return vu.client.request('POST', '/add-order', json_body={
+        'product_id': product_id, 'order_quantity': 1, 'customer': 'Bench customer'})
+
+
+def scenario_edit_order(vu):
+    order_id, product_id, batch_number, customer = vu.rnd.choice(vu.context['orders'].editable)
+    return vu.client.request('POST', f'/edit-order/{order_id}', json_body={
+        'product_id': product_id, 'batch_number': batch_number,
+        'order_quantity': vu.rnd.randint(1, 3), 'customer': customer})
+
+
+def scenario_delete_order(vu):
+    order_id = vu.context['orders'].take_deletable()
+    if order_id is None:
+        return None
+    return vu.client.request('POST', f'/delete-order/{order_id}')
+
+
+# name: (function, relative weight in the default mix)
+SCENARIOS = {
+    'auth': (scenario_auth, 1),
+    'dashboard': (scenario_dashboard, 4),
+    'products': (scenario_products, 3),
+    'purchases': (scenario_purchases, 3),
+    'orders': (scenario_orders, 3),
+    'list_filter': (scenario_list_filter, 3),
+    'notification_poll': (scenario_notification_poll, 10),
+    'add_order': (scenario_add_order, 2),
+    'edit_order': (scenario_edit_order, 1),
+    'delete_order': (scenario_delete_order, 1),
+}
+
+
+def is_failure(status, body):
+    if status >= 500 or status in (400, 401, 403, 404, 409):
+        return True
+    if body[:1] == b'{':
+        try:
+            return json.loads(body).get('success') is False
+        except ValueError:
+            return False
+    return False
+
+
+# ---------------------------------------------------------------------------
+# Runner
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Nearest-rank percentile
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples, elapsed):
+    latencies = [s[0] * 1000 for s in samples]
+    queries = [s[2] for s in samples if s[2] is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for s in samples if s[1]),
+        'rejected_503': sum(1 for s in samples if s[3] == 503),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'p50': round(percentile(latencies, 50), 3) if latencies else None,
+            'p95': round(percentile(latencies, 95), 3) if latencies else None,
+            'p99': round(percentile(latencies, 99), 3) if latencies else None,
+            'max': round(max(latencies), 3) if latencies else None,
+        },
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def load_context(args):
+    with medisync.db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM Product")
+        products = c.fetchone()[0]
+        c.execute('SELECT order_id, product_id, batch_number, customer FROM "Order" ORDER BY order_id DESC LIMIT %s',
+                  (args.order_pool,))
+        orders = OrderPool(c.fetchall())
+        conn.rollback()
+    if not products:
+        sys.exit('No products found; run "bench.py seed" first')
+    return {'products': products, 'orders': orders}
+
+
+def make_client(args):
+    return HTTPClient(args.url) if args.url else TestClient()
+
+
+def run_worker(vu, names, weights, deadline, results, lock):
+    local = {name: [] for name in names}
+    while time.monotonic() < deadline:
+        name = vu.rnd.choices(names, weights)[0]
+        start = time.perf_counter()
+        try:
+            response = SCENARIOS[name][0](vu)
+        except Exception as e:
+            local[name].append((time.perf_counter() - start, True, None, None))
+            print(f"{name}: {e}", file=sys.stderr)
+            continue
+        if response is None:
+            continue
+        status, headers, body = response
+        count = headers.get('X-Query-Count')
+        local[name].append((time.perf_counter() - start, is_failure(status, body),
+                            int(count) if count is not None else None, status))
+    with lock:
+        for name, samples in local.items():
+            results[name].extend(samples)
+
+
+def run_users(users, names, weights, duration):
+    results = {name: [] for name in names}
+    lock = threading.Lock()
+    start = time.monotonic()
+    threads = [threading.Thread(target=run_worker, args=(vu, names, weights, start + duration, results, lock))
+               for vu in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results, time.monotonic() - start
+
+
+def run(args):
+    names = args.scenarios.split(',') if args.scenarios else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenario(s): {', '.join(unknown)}")
+    weights = [SCENARIOS[name][1] for name in names]
+    context = load_context(args)
+
+    users = []
+    for i in range(args.users):
+        vu = VirtualUser(make_client(args), random.Random(args.seed + i), context)
+        status, _, _ = vu.login()
+        if status != 302:
+            sys.exit(f"Login failed with status {status}; run 'bench.py seed' to create the bench user")
+        users.append(vu)
+
+    if args.warmup:
+        run_users(users, names, weights, args.warmup)
+    results, elapsed = run_users(users, names, weights, args.duration)
+
+    report = {
+        'meta': run_meta(args, context),
+        'total': summarize([s for samples in results.values() for s in samples], elapsed),
+        'scenarios': {name: summarize(samples, elapsed) for name, samples in results.items()},
+    }
+    write_report(report, args.out)
+    print_report(report)
+
+
+def run_meta(args, context):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit or None,
+        'mode': 'http' if args.url else 'test_client',
+        'url': args.url,
+        'users': args.users,
+        'duration_seconds': args.duration,
+        'warmup_seconds': args.warmup,
+        'seed': args.seed,
+        'products': context['products'],
+        'db_pool_max': medisync.DB_POOL_MAX,
+    }
+
+
+def write_report(report, path):
+    if path:
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {path}")
+
+
+def print_report(report):
+    print(f"{'scenario':<20}{'reqs':>8}{'err':>6}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'q/req':>7}")
+    rows = list(report['scenarios'].items()) + [('TOTAL', report['total'])]
+    for name, s in rows:
+        lat = s['latency_ms']
+        print(f"{name:<20}{s['requests']:>8}{s['errors']:>6}{fmt(s['throughput_rps']):>9}"
+              f"{fmt(lat['p50']):>9}{fmt(lat['p95']):>9}{fmt(lat['p99']):>9}{fmt(s['queries_per_request']):>7}")
+
+
+def fmt(value):
+    return '-' if value is None else f'{value:.1f}'
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    def delta(old, cur):
+        if old in (None, 0) or cur is None:
+            return '-'
+        return f'{(cur - old) / old * 100:+.1f}%'
+
+    print(f"{'scenario':<20}{'p50':>18}{'p95':>18}{'p99':>18}{'rps':>18}{'q/req':>14}")
+    names = [n for n in base['scenarios'] if n in new['scenarios']] + ['TOTAL']
+    for name in names:
+        b = base['total'] if name == 'TOTAL' else base['scenarios'][name]
+        n = new['total'] if name == 'TOTAL' else new['scenarios'][name]
+        cells = [delta(b['latency_ms'][k], n['latency_ms'][k]) for k in ('p50', 'p95', 'p99')]
+        cells.append(delta(b['throughput_rps'], n['throughput_rps']))
+        cells.append(delta(b['queries_per_request'], n['queries_per_request']))
+        print(f"{name:<20}" + ''.join(f'{c:>18}' for c in cells[:4]) + f'{cells[4]:>14}')
+
+
+# ---------------------------------------------------------------------------
+# Login throughput: how fast one thread can verify a hash at each cost, and
+# what concurrent logins do to login and dashboard latency. Use it to pick
+# PASSWORD_HASH_METHOD for the hardware the app runs on.
+
+def set_bench_password(method):
+    with medisync.db_connection() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE users SET password = %s WHERE username = %s",
+                  (generate_password_hash(BENCH_PASSWORD, method=method), BENCH_USERNAME))
+        conn.commit()
+
+
+def hash_rate(method, seconds=2.0):
+    stored = generate_password_hash(BENCH_PASSWORD, method=method)
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        check_password_hash(stored, BENCH_PASSWORD)
+        count += 1
+    return round(count / (time.perf_counter() - start), 2)
+
+
+def login(args):
+    methods = args.methods.split(',')
+    context = load_context(args)
+    names = ['auth', 'dashboard']
+    weights = [args.login_weight, 1]
+    report = {'meta': run_meta(args, context), 'methods': {}}
+    report['meta']['auth_hash_workers'] = medisync.AUTH_HASH_WORKERS
+    report['meta']['auth_hash_queue'] = medisync.AUTH_HASH_QUEUE
+
+    for method in methods:
+        # Match the app's method so logins don't rehash mid-run (in-process
+        # only; with --url the server's PASSWORD_HASH_METHOD must match)
+        medisync.PASSWORD_HASH_METHOD = method
+        set_bench_password(method)
+        users = []
+        for i in range(args.users):
+            vu = VirtualUser(make_client(args), random.Random(args.seed + i), context)
+            status, _, _ = vu.login()
+            if status != 302:
+                sys.exit(f"Login failed with status {status} for {method}")
+            users.append(vu)
+        results, elapsed = run_users(users, names, weights, args.duration)
+        report['methods'][method] = {
+            'single_thread_verifications_per_second': hash_rate(method),
+            'scenarios': {name: summarize(samples, elapsed) for name, samples in results.items()},
+        }
+
+    write_report(report, args.out)
+    print(f"{'method':<28}{'hash/s':>8}{'logins/s':>10}{'p95':>9}{'503s':>7}{'dash p95':>10}")
+    for method, result in report['methods'].items():
+        auth, dash = result['scenarios']['auth'], result['scenarios']['dashboard']
+        print(f"{method:<28}{fmt(result['single_thread_verifications_per_second']):>8}"
+              f"{fmt(auth['throughput_rps']):>10}{fmt(auth['latency_ms']['p95']):>9}{auth['rejected_503']:>7}"
+              f"{fmt(dash['latency_ms']['p95']):>10}")
+
+
+# ---------------------------------------------------------------------------
+# Stock-out stress test: many writers adding, editing and deleting orders
+# against one batch. Afterwards the batch must balance exactly against its
+# orders and never have been oversold.
+
+def create_stress_batch(stock):
+    with medisync.db_connection() as conn:
+        c = conn.cursor()
+        c.execute("""
+            INSERT INTO Product (product_name, product_type, stock_quantity, status)
+            VALUES ('Stress test product', 'medicine', 0, 'active')
+            RETURNING id
+        """)
+        product_id = c.fetchone()[0]
+        c.execute(f"""
+            INSERT INTO Purchase (product_id, purchase_quantity, remaining_quantity, expiration_date, supplier, status)
+            VALUES (%s, %s, %s, CURRENT_DATE + 365, 'Stress test', {medisync.expiry_status_sql('CURRENT_DATE + 365')})
+            RETURNING id, batch_number
+        """, (product_id, stock, stock))
+        purchase_id, batch_number = c.fetchone()
+        conn.commit()
+    return product_id, purchase_id, batch_number
+
+
+def check_stress_batch(product_id, purchase_id, batch_number, stock):
+    with medisync.db_connection() as conn:
+        c = conn.cursor()
+        c.execute("SELECT remaining_quantity FROM Purchase WHERE id = %s", (purchase_id,))
+        remaining = c.fetchone()[0]
+        c.execute('SELECT COALESCE(SUM(order_quantity), 0), COUNT(*) FROM "Order" '
+                  'WHERE product_id = %s AND batch_number = %s', (product_id, batch_number))
+        ordered, orders = c.fetchone()
+        conn.rollback()
+    return {
+        'stock': stock,
+        'remaining': remaining,
+        'ordered': int(ordered),
+        'orders': orders,
+        'oversold': max(0, int(ordered) - stock),
+        'drift': remaining - (stock - int(ordered)),
+    }
+
+
+def drop_stress_batch(product_id):
+    # The ledger follows remaining_quantity, so deleting the orders leaves it
+    # alone and deleting the batch writes off what it still held; the
+    # product's movements net to zero and it drops out of stock-as-of
+    with medisync.db_connection() as conn:
+        c = conn.cursor()
+        c.execute('DELETE FROM "Order" WHERE product_id = %s', (product_id,))
+        c.execute("DELETE FROM Purchase WHERE product_id = %s", (product_id,))
+        c.execute("DELETE FROM Product WHERE id = %s", (product_id,))
+        conn.commit()
+
+
+def stress_writer(vu, batch, args, deadline, results, lock):
+    product_id, batch_number = batch
+    orders = []
+    local = {'add_order': [], 'edit_order': [], 'delete_order': []}
+    while time.monotonic() < deadline:
+        op = vu.rnd.choices(['add_order', 'edit_order', 'delete_order'], [6, 2, 2])[0]
+        if op != 'add_order' and not orders:
+            op = 'add_order'
+        quantity = vu.rnd.randint(1, args.max_quantity)
+        start = time.perf_counter()
+        if op == 'add_order':
+            status, _, body = vu.client.request('POST', '/add-order', json_body={
+                'product_id': product_id, 'batch_number': batch_number,
+                'order_quantity': quantity, 'customer': 'Stress test'})
+        elif op == 'edit_order':
+            order_id = vu.rnd.choice(orders)
+            status, _, body = vu.client.request('POST', f'/edit-order/{order_id}', json_body={
+                'product_id': product_id, 'batch_number': batch_number,
+                'order_quantity': quantity, 'customer': 'Stress test'})
+        else:
+            order_id = orders.pop(vu.rnd.randrange(len(orders)))
+            status, _, body = vu.client.request('POST', f'/delete-order/{order_id}')
+        elapsed = time.perf_counter() - start
+
+        result = json.loads(body) if body[:1] == b'{' else {}
+        if result.get('success'):
+            outcome = 'ok'
+            if op == 'add_order':
+                orders.append(result['allocation'][0]['order_id'])
+        elif 'nsufficient stock' in result.get('message', ''):
+            outcome = 'rejected'
+        else:
+            outcome = 'error'
+        local[op].append((elapsed, outcome, status))
+    with lock:
+        for op, samples in local.items():
+            results[op].extend(samples)
+
+
+def stress(args):
+    if not args.url:
+        # Every in-process writer needs its own connection to contend at all
+        medisync.DB_POOL_MAX = max(medisync.DB_POOL_MAX, args.writers + 2)
+    product_id, purchase_id, batch_number = create_stress_batch(args.stock)
+
+    users = []
+    for i in range(args.writers):
+        vu = VirtualUser(make_client(args), random.Random(args.seed + i), None)
+        status, _, _ = vu.login()
+        if status != 302:
+            sys.exit(f"Login failed with status {status}; run 'bench.py seed' to create the bench user")
+        users.append(vu)
+
+    results = {'add_order': [], 'edit_order': [], 'delete_order': []}
+    lock = threading.Lock()
+    start = time.monotonic()
+    threads = [threading.Thread(target=stress_writer,
+                                args=(vu, (product_id, batch_number), args, start + args.duration, results, lock))
+               for vu in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - start
+
+    balance = check_stress_batch(product_id, purchase_id, batch_number, args.stock)
+    operations = {}
+    for op, samples in results.items():
+        latencies = [s[0] * 1000 for s in samples]
+        operations[op] = {
+            'requests': len(samples),
+            'ok': sum(1 for s in samples if s[1] == 'ok'),
+            'rejected_insufficient_stock': sum(1 for s in samples if s[1] == 'rejected'),
+            'errors': sum(1 for s in samples if s[1] == 'error'),
+            'throughput_rps': round(len(samples) / elapsed, 2),
+            'latency_ms': {
+                'p50': round(percentile(latencies, 50), 3) if latencies else None,
+                'p95': round(percentile(latencies, 95), 3) if latencies else None,
+                'p99': round(percentile(latencies, 99), 3) if latencies else None,
+            },
+        }
+    passed = balance['oversold'] == 0 and balance['drift'] == 0 and balance['remaining'] >= 0
+    report = {
+        'meta': {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'mode': 'http' if args.url else 'test_client',
+            'writers': args.writers,
+            'duration_seconds': args.duration,
+            'stock': args.stock,
+        },
+        'passed': passed,
+        'balance': balance,
+        'throughput_rps': round(sum(len(s) for s in results.values()) / elapsed, 2),
+        'operations': operations,
+    }
+    if not args.keep:
+        drop_stress_batch(product_id)
+
+    write_report(report, args.out)
+    for op, o in operations.items():
+        lat = o['latency_ms']
+        print(f"{op:<14}{o['requests']:>7} reqs {o['ok']:>7} ok {o['rejected_insufficient_stock']:>6} rejected "
+              f"{o['errors']:>5} errors  p50 {fmt(lat['p50'])} p95 {fmt(lat['p95'])} p99 {fmt(lat['p99'])} ms")
+    print(f"throughput {report['throughput_rps']} req/s; balance {balance}")
+    print('PASS' if passed else 'FAIL: batch does not balance against its orders')
+    if not passed:
+        sys.exit(1)
+
+
+# ---------------------------------------------------------------------------
+# Forecast report build time. Against the seeded database the two reads and
+# the NumPy pass are timed separately; --synthetic times the NumPy pass
+# alone on generated inputs (daily orders for --days per product, lookback
+# window as configured) without a database.
+
+def synthetic_forecast_inputs(args):
+    rng = np.random.default_rng(args.seed)
+    lookback = medisync.FORECAST_LOOKBACK_DAYS
+    rates = rng.gamma(1.5, 4.0, args.products)
+    daily = rng.poisson(rates[:, None], size=(args.products, args.days)).astype(np.float64)
+    window = daily[:, -lookback:]
+    batches = args.products * args.batches_per_product
+    return {
+        'stock_days': np.full(args.products, min(lookback, args.days)),
+        'out_sum': window.sum(axis=1),
+        'out_sumsq': (window * window).sum(axis=1),
+        'batch_product': rng.integers(0, args.products, batches),
+        'batch_remaining': rng.integers(1, 1000, batches),
+        'batch_days': rng.integers(1, 730, batches),
+    }
+
+
+def forecast(args):
+    timings = {'load': [], 'compute': [], 'total': []}
+    if args.synthetic:
+        inputs = synthetic_forecast_inputs(args)
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            medisync.build_forecast(lead_time_days=medisync.FORECAST_LEAD_TIME_DAYS,
+                                    service_z=medisync.FORECAST_SERVICE_Z,
+                                    cover_days=medisync.FORECAST_COVER_DAYS, **inputs)
+            timings['compute'].append(time.perf_counter() - start)
+        scale = {'products': args.products, 'days': args.days,
+                 'batches': args.products * args.batches_per_product}
+    else:
+        with medisync.db_connection() as conn:
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                inputs = medisync.load_forecast_inputs(conn)
+                loaded = time.perf_counter()
+                medisync.build_forecast_report(conn, inputs)
+                done = time.perf_counter()
+                timings['load'].append(loaded - start)
+                timings['compute'].append(done - loaded)
+                timings['total'].append(done - start)
+            _, products, batches = inputs
+            c = conn.cursor()
+            c.execute('SELECT COUNT(*), MIN(order_date), MAX(order_date) FROM "Order"')
+            orders, first, last = c.fetchone()
+            conn.rollback()
+        scale = {'products': len(products), 'open_batches': len(batches), 'orders': orders,
+                 'order_days': (last - first).days + 1 if first else 0}
+
+    report = {
+        'meta': {'started_at': datetime.now().isoformat(timespec='seconds'),
+                 'mode': 'synthetic' if args.synthetic else 'database',
+                 'repeat': args.repeat,
+                 'lookback_days': medisync.FORECAST_LOOKBACK_DAYS,
+                 **scale},
+        'seconds': {phase: {'p50': percentile(values, 50), 'max': max(values)}
+                    for phase, values in timings.items() if values},
+    }
+    write_report(report, args.out)
+    print(', '.join(f"{key} {value}" for key, value in scale.items()))
+    for phase, stats in report['seconds'].items():
+        print(f"{phase:<10}p50 {stats['p50'] * 1000:8.1f} ms   max {stats['max'] * 1000:8.1f} ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('seed', help='Load a synthetic dataset (replaces inventory data)')
+    p.add_argument('--products', type=int, default=1000)
+    p.add_argument('--batches', type=int, default=5000)
+    p.add_argument('--orders', type=int, default=20000)
+    p.add_argument('--notifications', type=int, default=2000)
+    p.add_argument('--categories', type=int, default=20)
+    p.add_argument('--days', type=int, default=365, help='Days of purchase and order history')
+    p.add_argument('--seed', type=int, default=42)
+    p.set_defaults(func=seed)
+
+    p = sub.add_parser('run', help='Drive the routes with concurrent virtual users')
+    p.add_argument('--url', help='Base URL of a running server; default is the in-process test client')
+    p.add_argument('--users', type=int, default=8)
+    p.add_argument('--duration', type=float, default=30)
+    p.add_argument('--warmup', type=float, default=5)
+    p.add_argument('--scenarios', help='Comma-separated subset of: ' + ', '.join(SCENARIOS))
+    p.add_argument('--order-pool', type=int, default=5000, help='Existing orders used by edit/delete')
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--out', help='Write the results JSON here')
+    p.set_defaults(func=run)
+
+    p = sub.add_parser('login', help='Measure login throughput at one or more hash costs')
+    p.add_argument('--methods', default='pbkdf2:sha256:600000,scrypt:16384:8:1,scrypt:32768:8:1',
+                   help='Comma-separated werkzeug hash methods to compare')
+    p.add_argument('--url', help='Base URL of a running server; default is the in-process test client')
+    p.add_argument('--users', type=int, default=32)
+    p.add_argument('--duration', type=float, default=20)
+    p.add_argument('--login-weight', type=int, default=3, help='Logins per dashboard view in the mix')
+    p.add_argument('--order-pool', type=int, default=0)
+    p.add_argument('--warmup', type=float, default=0)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--out', help='Write the results JSON here')
+    p.set_defaults(func=login)
+
+    p = sub.add_parser('stress', help='Concurrent writers on one batch; checks for oversell')
+    p.add_argument('--url', help='Base URL of a running server; default is the in-process test client')
+    p.add_argument('--writers', type=int, default=50)
+    p.add_argument('--duration', type=float, default=30)
+    p.add_argument('--stock', type=int, default=2000, help='Starting quantity of the contended batch')
+    p.add_argument('--max-quantity', type=int, default=5)
+    p.add_argument('--keep', action='store_true', help='Keep the stress product and its orders afterwards')
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--out', help='Write the results JSON here')
+    p.set_defaults(func=stress)
+
+    p = sub.add_parser('forecast', help='Time the forecast report build')
+    p.add_argument('--synthetic', action='store_true', help='Generated inputs, no database')
+    p.add_argument('--products', type=int, default=10000, help='With --synthetic')
+    p.add_argument('--days', type=int, default=1095, help='Days of order history with --synthetic')
+    p.add_argument('--batches-per-product', type=int, default=6, help='With --synthetic')
+    p.add_argument('--repeat', type=int, default=5)
+    p.add_argument('--seed', type=int, default=42)
+    p.add_argument('--out', help='Write the results JSON here')
+    p.set_defaults(func=forecast)
+
+    p = sub.add_parser('compare', help='Compare two result files')
+    p.add_argument('base')
+    p.add_argument('new')
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
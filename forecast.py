@@ -0,0 +1,97 @@
+"""Consumption forecasting and reorder points for the whole catalogue.
+
+Every figure is computed for all products and batches at once on NumPy
+arrays; the caller supplies the per-product order totals and the open
+batches (see app.load_forecast_inputs).
+
+Batches are assumed to be consumed first-expiry-first at each product's
+average daily rate, and a batch still holding stock on its expiration date
+is written off. Under that model the quantity served by a product's first
+i batches by the time batch i expires is
+
+    U[i] = min(U[i-1] + R[i], rate * D[i])
+
+(R remaining quantity, D days until expiry), which unrolls to a running
+minimum over each product's batches and so vectorises along the rows of a
+(products x batches) matrix.
+"""
+import numpy as np
+
+
+def build_forecast(stock_days, out_sum, out_sumsq, batch_product, batch_remaining, batch_days,
+                   lead_time_days, service_z, cover_days):
+    """Forecast every product.
+
+    Per product (arrays of length n, index = product position):
+      stock_days   days of history the averages are taken over (>= 1)
+      out_sum      quantity ordered over those days
+      out_sumsq    sum of squared daily order quantities over those days
+    Per open batch (any order):
+      batch_product    product position of the batch
+      batch_remaining  quantity left
+      batch_days       days until it expires (>= 1)
+
+    Returns a dict of per-product arrays (``rate``, ``std``,
+    ``usable_stock``, ``days_of_supply``, ``expiring_unused``,
+    ``reorder_point``, ``suggested_order``) and per-batch arrays in the
+    input order (``batch_consumed``, ``batch_expiring_unused``).
+    """
+    n = len(stock_days)
+    stock_days = np.maximum(np.asarray(stock_days, dtype=np.float64), 1.0)
+    out_sum = np.asarray(out_sum, dtype=np.float64)
+    out_sumsq = np.asarray(out_sumsq, dtype=np.float64)
+
+    rate = out_sum / stock_days
+    std = np.sqrt(np.maximum(out_sumsq / stock_days - rate * rate, 0.0))
+
+    batch_product = np.asarray(batch_product, dtype=np.int64)
+    batch_remaining = np.asarray(batch_remaining, dtype=np.float64)
+    batch_days = np.asarray(batch_days, dtype=np.float64)
+
+    # Lay the batches out as one row per product, earliest expiry first
+    order = np.lexsort((batch_days, batch_product))
+    rows = batch_product[order]
+    counts = np.bincount(rows, minlength=n)
+    starts = np.cumsum(counts) - counts
+    cols = np.arange(len(rows)) - starts[rows]
+    width = int(counts.max()) if len(rows) else 0
+
+    present = np.zeros((n, width), dtype=bool)
+    remaining = np.zeros((n, width))
+    days = np.zeros((n, width))
+    present[rows, cols] = True
+    remaining[rows, cols] = batch_remaining[order]
+    days[rows, cols] = batch_days[order]
+
+    demand = rate[:, None] * days
+    cumulative = np.cumsum(remaining, axis=1)
+    served = cumulative + np.minimum(
+        np.minimum.accumulate(np.where(present, demand - cumulative, np.inf), axis=1), 0.0)
+    served_before = np.hstack([np.zeros((n, 1)), served[:, :-1]]) if width else served
+    consumed = np.where(present, np.clip(np.minimum(remaining, demand - served_before), 0.0, None), 0.0)
+
+    usable = consumed.sum(axis=1)
+    expiring_unused = remaining.sum(axis=1) - usable
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days_of_supply = np.where(rate > 0, usable / rate, np.inf)
+
+    reorder_point = rate * lead_time_days + service_z * std * np.sqrt(lead_time_days)
+    suggested_order = np.where(
+        (rate > 0) & (usable <= reorder_point),
+        np.ceil(reorder_point + rate * cover_days - usable), 0.0)
+
+    batch_consumed = np.empty(len(rows))
+    batch_consumed[order] = consumed[rows, cols]
+
+    return {
+        'rate': rate,
+        'std': std,
+        'usable_stock': usable,
+        'days_of_supply': days_of_supply,
+        'expiring_unused': expiring_unused,
+        'reorder_point': reorder_point,
+        'suggested_order': suggested_order,
+        'batch_consumed': batch_consumed,
+        'batch_expiring_unused': batch_remaining - batch_consumed,
+    }
@@ -0,0 +1,11 @@
+import os
+
+# SERVER_MODE=async serves asgi:app on uvicorn workers; the default serves
+# the Flask app directly on threaded workers
+if os.environ.get('SERVER_MODE', 'sync') == 'async':
+    wsgi_app = 'asgi:app'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'app:app'
+    worker_class = 'gthread'
+    threads = 16
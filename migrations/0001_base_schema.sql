@@ -0,0 +1,122 @@
+-- Core tables. Written with IF NOT EXISTS so databases created before
+-- migrations existed are adopted as they are.
+
+CREATE TABLE IF NOT EXISTS users (
+    id SERIAL PRIMARY KEY,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    role TEXT DEFAULT 'staff',
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS user_activity (
+    id SERIAL PRIMARY KEY,
+    username TEXT NOT NULL,
+    activity TEXT NOT NULL,
+    activity_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS Category (
+    id SERIAL PRIMARY KEY,
+    category_name TEXT NOT NULL,
+    created_at DATE DEFAULT CURRENT_DATE
+);
+
+CREATE TABLE IF NOT EXISTS Product (
+    id SERIAL PRIMARY KEY,
+    product_name TEXT NOT NULL,
+    product_type TEXT NOT NULL,
+    category_id INTEGER REFERENCES Category(id),
+    stock_quantity INTEGER NOT NULL DEFAULT 0,
+    stock_status TEXT DEFAULT 'in stock',
+    status TEXT DEFAULT 'active',
+    created_at DATE DEFAULT CURRENT_DATE
+);
+
+CREATE SEQUENCE IF NOT EXISTS purchase_batch_seq;
+
+CREATE TABLE IF NOT EXISTS Purchase (
+    id SERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL REFERENCES Product(id),
+    batch_number TEXT NOT NULL DEFAULT ('B' || lpad(nextval('purchase_batch_seq')::text, 6, '0')),
+    purchase_quantity INTEGER NOT NULL,
+    remaining_quantity INTEGER NOT NULL,
+    expiration_date DATE NOT NULL,
+    supplier TEXT,
+    status TEXT DEFAULT 'in stock',
+    purchase_date DATE DEFAULT CURRENT_DATE
+);
+
+CREATE TABLE IF NOT EXISTS "Order" (
+    order_id SERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL REFERENCES Product(id),
+    order_quantity INTEGER NOT NULL,
+    batch_number TEXT NOT NULL,
+    customer TEXT,
+    order_date DATE DEFAULT CURRENT_DATE
+);
+
+CREATE TABLE IF NOT EXISTS notification (
+    id SERIAL PRIMARY KEY,
+    message TEXT NOT NULL,
+    type TEXT,
+    product_id INTEGER,
+    batch_id TEXT,
+    is_read BOOLEAN DEFAULT FALSE,
+    ignored BOOLEAN DEFAULT FALSE,
+    last_notified TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Stock bookkeeping: an order deducts from its batch, and a product's stock
+-- follows the remaining quantity of its batches. Databases that predate
+-- migrations already carry their own triggers for this, so these are only
+-- attached to tables that have none.
+CREATE OR REPLACE FUNCTION order_deduct_stock() RETURNS trigger AS $$
+BEGIN
+    UPDATE Purchase
+    SET remaining_quantity = remaining_quantity - NEW.order_quantity
+    WHERE product_id = NEW.product_id AND batch_number = NEW.batch_number;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION purchase_sync_product_stock() RETURNS trigger AS $$
+BEGIN
+    UPDATE Product p
+    SET stock_quantity = s.quantity,
+        stock_status = CASE
+            WHEN s.quantity <= 0 THEN 'out of stock'
+            WHEN s.quantity < 10 THEN 'low stock'
+            ELSE 'in stock'
+        END
+    FROM (
+        SELECT pr.id, COALESCE(SUM(pu.remaining_quantity), 0) AS quantity
+        FROM Product pr
+        LEFT JOIN Purchase pu ON pu.product_id = pr.id
+        WHERE pr.id IN (
+            CASE WHEN TG_OP <> 'DELETE' THEN NEW.product_id END,
+            CASE WHEN TG_OP <> 'INSERT' THEN OLD.product_id END
+        )
+        GROUP BY pr.id
+    ) s
+    WHERE p.id = s.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = '"Order"'::regclass AND NOT tgisinternal) THEN
+        CREATE TRIGGER order_deduct_stock
+            AFTER INSERT ON "Order"
+            FOR EACH ROW EXECUTE FUNCTION order_deduct_stock();
+    END IF;
+    IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = 'purchase'::regclass AND NOT tgisinternal) THEN
+        CREATE TRIGGER purchase_sync_product_stock
+            AFTER INSERT OR UPDATE OR DELETE ON Purchase
+            FOR EACH ROW EXECUTE FUNCTION purchase_sync_product_stock();
+    END IF;
+END
+$$;
@@ -0,0 +1,26 @@
+-- Small key/value store for process-wide watermarks (expiry reconcile)
+CREATE TABLE IF NOT EXISTS app_state (
+    key TEXT PRIMARY KEY,
+    value TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Single-row summary behind /dashboard. Writes bump version; a refresh
+-- records the version it saw in refreshed_version.
+CREATE TABLE IF NOT EXISTS dashboard_summary (
+    id INTEGER PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    total_stocks BIGINT NOT NULL DEFAULT 0,
+    medicines INTEGER NOT NULL DEFAULT 0,
+    supplies INTEGER NOT NULL DEFAULT 0,
+    stockins_medicines BIGINT NOT NULL DEFAULT 0,
+    stockins_supplies BIGINT NOT NULL DEFAULT 0,
+    stockouts_medicines BIGINT NOT NULL DEFAULT 0,
+    stockouts_supplies BIGINT NOT NULL DEFAULT 0,
+    out_of_stocks INTEGER NOT NULL DEFAULT 0,
+    total_orders BIGINT NOT NULL DEFAULT 0,
+    expiring_soon JSON NOT NULL DEFAULT '[]',
+    version BIGINT NOT NULL DEFAULT 1,
+    refreshed_version BIGINT NOT NULL DEFAULT 0,
+    refreshed_on DATE,
+    refreshed_at TIMESTAMP
+);
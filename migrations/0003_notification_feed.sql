@@ -0,0 +1,47 @@
+-- updated_at drives the incremental /notification-json feed. Touching
+-- last_notified alone does not bump it, so toasts being shown don't resend
+-- the row.
+ALTER TABLE notification
+    ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+
+CREATE OR REPLACE FUNCTION notification_set_updated_at() RETURNS trigger AS $$
+BEGIN
+    IF ROW(NEW.message, NEW.type, NEW.is_read, NEW.ignored)
+       IS DISTINCT FROM ROW(OLD.message, OLD.type, OLD.is_read, OLD.ignored) THEN
+        NEW.updated_at := clock_timestamp();
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notification_updated_at ON notification;
+CREATE TRIGGER notification_updated_at
+    BEFORE UPDATE ON notification
+    FOR EACH ROW EXECUTE FUNCTION notification_set_updated_at();
+
+-- Push inserts and read/ignore changes to /notification-stream listeners
+CREATE OR REPLACE FUNCTION notification_notify() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' OR ROW(NEW.message, NEW.type, NEW.is_read, NEW.ignored)
+       IS DISTINCT FROM ROW(OLD.message, OLD.type, OLD.is_read, OLD.ignored) THEN
+        PERFORM pg_notify('notification_events', json_build_object(
+            'op', lower(TG_OP),
+            'id', NEW.id,
+            'message', NEW.message,
+            'type', NEW.type,
+            'created_at', NEW.created_at,
+            'is_read', NEW.is_read,
+            'ignored', NEW.ignored
+        )::text);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notification_notify ON notification;
+CREATE TRIGGER notification_notify
+    AFTER INSERT OR UPDATE ON notification
+    FOR EACH ROW EXECUTE FUNCTION notification_notify();
+
+CREATE INDEX IF NOT EXISTS notification_updated_at_idx ON notification (updated_at, id);
+CREATE INDEX IF NOT EXISTS notification_created_at_idx ON notification (created_at);
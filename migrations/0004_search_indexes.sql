@@ -0,0 +1,7 @@
+-- Trigram indexes behind /search; they also serve the ILIKE list filters
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS product_name_trgm_idx ON Product USING gin (product_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS purchase_batch_trgm_idx ON Purchase USING gin ((batch_number::text) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS purchase_supplier_trgm_idx ON Purchase USING gin (supplier gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS order_customer_trgm_idx ON "Order" USING gin (customer gin_trgm_ops);
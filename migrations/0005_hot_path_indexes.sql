@@ -0,0 +1,28 @@
+-- Indexes for the queries on the request path. Each one is checked by
+-- `flask db-verify-plans` (see PLAN_CHECKS in app.py).
+
+-- FEFO allocation only ever scans batches that still have stock
+CREATE INDEX IF NOT EXISTS purchase_fefo_idx
+    ON Purchase (product_id, expiration_date, id)
+    WHERE remaining_quantity > 0;
+
+-- Batch lookups by (product, batch) from the order and purchase routes
+CREATE INDEX IF NOT EXISTS purchase_product_batch_idx ON Purchase (product_id, batch_number);
+CREATE INDEX IF NOT EXISTS order_product_batch_idx ON "Order" (product_id, batch_number);
+
+-- Near-expiry list on the dashboard; expired and in-stock batches are skipped
+CREATE INDEX IF NOT EXISTS purchase_near_expiry_idx
+    ON Purchase (expiration_date)
+    WHERE status = 'near expiry';
+
+-- Keyset pages and date-range filters on the purchase and order lists
+CREATE INDEX IF NOT EXISTS purchase_date_idx ON Purchase (purchase_date, id);
+CREATE INDEX IF NOT EXISTS purchase_expiration_idx ON Purchase (expiration_date, id);
+CREATE INDEX IF NOT EXISTS order_date_idx ON "Order" (order_date, order_id);
+
+CREATE INDEX IF NOT EXISTS user_activity_time_idx ON user_activity (activity_time, id);
+
+-- Expiry reconcile matches open notifications to their batch
+CREATE INDEX IF NOT EXISTS notification_batch_idx
+    ON notification (product_id, batch_id)
+    WHERE ignored = FALSE;
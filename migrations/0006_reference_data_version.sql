@@ -0,0 +1,4 @@
+-- Version of the reference data (categories, product names and types)
+-- cached by each worker; bumped by product writes
+INSERT INTO app_state (key, value) VALUES ('reference_version', '1')
+ON CONFLICT (key) DO NOTHING;
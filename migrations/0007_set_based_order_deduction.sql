@@ -0,0 +1,30 @@
+-- Deduct stock once per statement rather than once per order row, so a
+-- multi-line insert from /orders/batch updates each batch a single time.
+-- Only replaces the trigger installed by 0001; databases that came with
+-- their own order trigger keep it.
+CREATE OR REPLACE FUNCTION order_deduct_stock_set() RETURNS trigger AS $$
+BEGIN
+    UPDATE Purchase pu
+    SET remaining_quantity = pu.remaining_quantity - n.quantity
+    FROM (
+        SELECT product_id, batch_number, SUM(order_quantity) AS quantity
+        FROM new_orders
+        GROUP BY product_id, batch_number
+    ) n
+    WHERE pu.product_id = n.product_id AND pu.batch_number = n.batch_number;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_trigger
+               WHERE tgrelid = '"Order"'::regclass AND tgname = 'order_deduct_stock') THEN
+        DROP TRIGGER order_deduct_stock ON "Order";
+        CREATE TRIGGER order_deduct_stock
+            AFTER INSERT ON "Order"
+            REFERENCING NEW TABLE AS new_orders
+            FOR EACH STATEMENT EXECUTE FUNCTION order_deduct_stock_set();
+    END IF;
+END
+$$;
@@ -0,0 +1,71 @@
+-- Per-product low-stock threshold, used by the stock status trigger and the
+-- notification engine. 10 was the fixed threshold before.
+ALTER TABLE Product
+    ADD COLUMN IF NOT EXISTS low_stock_threshold INTEGER NOT NULL DEFAULT 10;
+
+CREATE OR REPLACE FUNCTION purchase_sync_product_stock() RETURNS trigger AS $$
+BEGIN
+    UPDATE Product p
+    SET stock_quantity = s.quantity,
+        stock_status = CASE
+            WHEN s.quantity <= 0 THEN 'out of stock'
+            WHEN s.quantity < p.low_stock_threshold THEN 'low stock'
+            ELSE 'in stock'
+        END
+    FROM (
+        SELECT pr.id, COALESCE(SUM(pu.remaining_quantity), 0) AS quantity
+        FROM Product pr
+        LEFT JOIN Purchase pu ON pu.product_id = pr.id
+        WHERE pr.id IN (
+            CASE WHEN TG_OP <> 'DELETE' THEN NEW.product_id END,
+            CASE WHEN TG_OP <> 'INSERT' THEN OLD.product_id END
+        )
+        GROUP BY pr.id
+    ) s
+    WHERE p.id = s.id;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- One row per alert: dedup_key is type:product_id:batch_id. The engine
+-- raises an alert by inserting (or re-opening) its row and retires it by
+-- setting resolved_at, so re-running it over unchanged stock writes nothing.
+ALTER TABLE notification
+    ADD COLUMN IF NOT EXISTS dedup_key TEXT,
+    ADD COLUMN IF NOT EXISTS resolved_at TIMESTAMP;
+
+-- Adopt existing alerts: the newest row per key takes the key and older
+-- duplicates are retired.
+UPDATE notification n
+SET dedup_key = k.dedup_key
+FROM (
+    SELECT DISTINCT ON (dedup_key) id, dedup_key
+    FROM (
+        SELECT id, created_at,
+               type || ':' || product_id || ':' || COALESCE(batch_id, '') AS dedup_key
+        FROM notification
+        WHERE type IN ('low-stock', 'out-of-stock', 'near-expiry', 'expired')
+            AND product_id IS NOT NULL
+    ) s
+    ORDER BY dedup_key, created_at DESC, id DESC
+) k
+WHERE n.id = k.id AND n.dedup_key IS NULL;
+
+UPDATE notification
+SET ignored = TRUE, resolved_at = NOW()
+WHERE dedup_key IS NULL
+    AND resolved_at IS NULL
+    AND type IN ('low-stock', 'out-of-stock', 'near-expiry', 'expired')
+    AND product_id IS NOT NULL;
+
+CREATE UNIQUE INDEX IF NOT EXISTS notification_dedup_key_idx ON notification (dedup_key);
+
+-- Candidate batches for expiry alerts
+CREATE INDEX IF NOT EXISTS purchase_expiring_stock_idx
+    ON purchase (expiration_date)
+    WHERE remaining_quantity > 0;
+
+-- Open alerts, checked by every engine pass
+CREATE INDEX IF NOT EXISTS notification_open_alert_idx
+    ON notification (dedup_key)
+    WHERE resolved_at IS NULL;
@@ -0,0 +1,150 @@
+-- Append-only ledger of stock movements per batch. Receipts and edits of
+-- Purchase.purchase_quantity add to a batch, orders take from it, so the
+-- sum of a batch's movements is what Purchase.remaining_quantity should be.
+-- Written by statement-level triggers, so every write path (the routes,
+-- imports, batch orders) is covered with one INSERT per statement.
+CREATE TABLE IF NOT EXISTS stock_movement (
+    id BIGSERIAL PRIMARY KEY,
+    product_id INTEGER NOT NULL,
+    batch_number TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    source TEXT NOT NULL,
+    source_id INTEGER,
+    moved_at TIMESTAMP NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS stock_movement_moved_at_idx ON stock_movement (moved_at);
+CREATE INDEX IF NOT EXISTS stock_movement_product_idx ON stock_movement (product_id, moved_at);
+
+CREATE OR REPLACE FUNCTION stock_movement_append_only() RETURNS trigger AS $$
+BEGIN
+    RAISE EXCEPTION 'stock_movement is append-only';
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS stock_movement_append_only ON stock_movement;
+CREATE TRIGGER stock_movement_append_only
+    BEFORE UPDATE OR DELETE ON stock_movement
+    FOR EACH STATEMENT EXECUTE FUNCTION stock_movement_append_only();
+
+CREATE OR REPLACE FUNCTION purchase_ledger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT product_id, batch_number, purchase_quantity, 'purchase', id
+        FROM new_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        -- Most updates are order deductions touching remaining_quantity
+        -- only; those match no row here.
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT n.product_id, n.batch_number, n.purchase_quantity - o.purchase_quantity, 'purchase-edit', n.id
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE (n.product_id, n.batch_number) = (o.product_id, o.batch_number)
+            AND n.purchase_quantity <> o.purchase_quantity
+        UNION ALL
+        SELECT o.product_id, o.batch_number, -o.purchase_quantity, 'purchase-edit', o.id
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE (n.product_id, n.batch_number) <> (o.product_id, o.batch_number)
+        UNION ALL
+        SELECT n.product_id, n.batch_number, n.purchase_quantity, 'purchase-edit', n.id
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE (n.product_id, n.batch_number) <> (o.product_id, o.batch_number);
+    ELSE
+        -- A deleted batch writes off whatever it still held
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT product_id, batch_number, -remaining_quantity, 'purchase-delete', id
+        FROM old_rows
+        WHERE remaining_quantity <> 0;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION order_ledger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT product_id, batch_number, -order_quantity, 'order', order_id
+        FROM new_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT n.product_id, n.batch_number, o.order_quantity - n.order_quantity, 'order-edit', n.order_id
+        FROM new_rows n JOIN old_rows o ON o.order_id = n.order_id
+        WHERE (n.product_id, n.batch_number) = (o.product_id, o.batch_number)
+            AND n.order_quantity <> o.order_quantity
+        UNION ALL
+        SELECT o.product_id, o.batch_number, o.order_quantity, 'order-edit', o.order_id
+        FROM new_rows n JOIN old_rows o ON o.order_id = n.order_id
+        WHERE (n.product_id, n.batch_number) <> (o.product_id, o.batch_number)
+        UNION ALL
+        SELECT n.product_id, n.batch_number, -n.order_quantity, 'order-edit', n.order_id
+        FROM new_rows n JOIN old_rows o ON o.order_id = n.order_id
+        WHERE (n.product_id, n.batch_number) <> (o.product_id, o.batch_number);
+    ELSE
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT product_id, batch_number, order_quantity, 'order-delete', order_id
+        FROM old_rows;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS purchase_ledger_insert ON Purchase;
+CREATE TRIGGER purchase_ledger_insert
+    AFTER INSERT ON Purchase
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION purchase_ledger();
+
+DROP TRIGGER IF EXISTS purchase_ledger_update ON Purchase;
+CREATE TRIGGER purchase_ledger_update
+    AFTER UPDATE ON Purchase
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION purchase_ledger();
+
+DROP TRIGGER IF EXISTS purchase_ledger_delete ON Purchase;
+CREATE TRIGGER purchase_ledger_delete
+    AFTER DELETE ON Purchase
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION purchase_ledger();
+
+DROP TRIGGER IF EXISTS order_ledger_insert ON "Order";
+CREATE TRIGGER order_ledger_insert
+    AFTER INSERT ON "Order"
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION order_ledger();
+
+DROP TRIGGER IF EXISTS order_ledger_update ON "Order";
+CREATE TRIGGER order_ledger_update
+    AFTER UPDATE ON "Order"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION order_ledger();
+
+DROP TRIGGER IF EXISTS order_ledger_delete ON "Order";
+CREATE TRIGGER order_ledger_delete
+    AFTER DELETE ON "Order"
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION order_ledger();
+
+-- Opening balance: stock on hand when the ledger starts
+INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+SELECT product_id, batch_number, remaining_quantity, 'opening', id
+FROM Purchase
+WHERE remaining_quantity <> 0
+    AND NOT EXISTS (SELECT 1 FROM stock_movement);
+
+-- Stock per batch at the start of snapshot_date, i.e. the sum of movements
+-- before it. Batches at zero are left out; stock_snapshot_run records
+-- which dates have a snapshot.
+CREATE TABLE IF NOT EXISTS stock_snapshot_run (
+    snapshot_date DATE PRIMARY KEY,
+    batches INTEGER NOT NULL,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS stock_snapshot (
+    snapshot_date DATE NOT NULL REFERENCES stock_snapshot_run (snapshot_date),
+    product_id INTEGER NOT NULL,
+    batch_number TEXT NOT NULL,
+    quantity INTEGER NOT NULL,
+    PRIMARY KEY (snapshot_date, product_id, batch_number)
+);
@@ -0,0 +1,177 @@
+-- Daily stock-in/stock-out totals per product, keyed on purchase_date and
+-- order_date. Kept current by statement-level triggers on Purchase and
+-- "Order", which add each statement's net change.
+CREATE TABLE IF NOT EXISTS stock_flow_daily (
+    product_id INTEGER NOT NULL,
+    day DATE NOT NULL,
+    stock_in BIGINT NOT NULL DEFAULT 0,
+    stock_out BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS stock_flow_daily_day_idx ON stock_flow_daily (day);
+
+-- The same per product_type. Rolled up from stock_flow_daily by the
+-- maintenance job for days up to the 'stock_flow_rolled_through' watermark
+-- in app_state; later days are summed from stock_flow_daily on read, so
+-- every order doesn't queue on one row per type and day.
+CREATE TABLE IF NOT EXISTS stock_flow_daily_type (
+    day DATE NOT NULL,
+    product_type TEXT NOT NULL,
+    stock_in BIGINT NOT NULL DEFAULT 0,
+    stock_out BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, product_type)
+);
+
+-- Rolled-up days changed since (backdated writes, product type edits),
+-- re-rolled by the next job run and read from stock_flow_daily until then
+CREATE TABLE IF NOT EXISTS stock_flow_dirty_day (
+    day DATE PRIMARY KEY
+);
+
+CREATE OR REPLACE FUNCTION stock_flow_add(days DATE[], products INTEGER[], ins BIGINT[], outs BIGINT[])
+RETURNS void AS $$
+    INSERT INTO stock_flow_daily AS f (product_id, day, stock_in, stock_out)
+    SELECT product_id, day, SUM(stock_in), SUM(stock_out)
+    FROM unnest(days, products, ins, outs) AS d (day, product_id, stock_in, stock_out)
+    WHERE day IS NOT NULL
+    GROUP BY product_id, day
+    HAVING SUM(stock_in) <> 0 OR SUM(stock_out) <> 0
+    ORDER BY product_id, day
+    ON CONFLICT (product_id, day) DO UPDATE
+    SET stock_in = f.stock_in + EXCLUDED.stock_in,
+        stock_out = f.stock_out + EXCLUDED.stock_out;
+
+    -- Anything before yesterday may already be rolled up
+    INSERT INTO stock_flow_dirty_day (day)
+    SELECT DISTINCT day
+    FROM unnest(days) AS d (day)
+    WHERE day < CURRENT_DATE - 1
+    ON CONFLICT DO NOTHING;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION purchase_stock_flow() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM stock_flow_add(array_agg(purchase_date), array_agg(product_id),
+                               array_agg(purchase_quantity::bigint), array_agg(0::bigint))
+        FROM new_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        -- Order deductions only touch remaining_quantity and match nothing
+        PERFORM stock_flow_add(array_agg(day), array_agg(product_id), array_agg(quantity), array_agg(0::bigint))
+        FROM (
+            SELECT n.purchase_date AS day, n.product_id, n.purchase_quantity::bigint AS quantity
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.purchase_date, n.product_id, n.purchase_quantity)
+                IS DISTINCT FROM (o.purchase_date, o.product_id, o.purchase_quantity)
+            UNION ALL
+            SELECT o.purchase_date, o.product_id, -o.purchase_quantity::bigint
+            FROM new_rows n JOIN old_rows o ON o.id = n.id
+            WHERE (n.purchase_date, n.product_id, n.purchase_quantity)
+                IS DISTINCT FROM (o.purchase_date, o.product_id, o.purchase_quantity)
+        ) d;
+    ELSE
+        PERFORM stock_flow_add(array_agg(purchase_date), array_agg(product_id),
+                               array_agg(-purchase_quantity::bigint), array_agg(0::bigint))
+        FROM old_rows;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION order_stock_flow() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        PERFORM stock_flow_add(array_agg(order_date), array_agg(product_id),
+                               array_agg(0::bigint), array_agg(order_quantity::bigint))
+        FROM new_rows;
+    ELSIF TG_OP = 'UPDATE' THEN
+        PERFORM stock_flow_add(array_agg(day), array_agg(product_id), array_agg(0::bigint), array_agg(quantity))
+        FROM (
+            SELECT n.order_date AS day, n.product_id, n.order_quantity::bigint AS quantity
+            FROM new_rows n JOIN old_rows o ON o.order_id = n.order_id
+            WHERE (n.order_date, n.product_id, n.order_quantity)
+                IS DISTINCT FROM (o.order_date, o.product_id, o.order_quantity)
+            UNION ALL
+            SELECT o.order_date, o.product_id, -o.order_quantity::bigint
+            FROM new_rows n JOIN old_rows o ON o.order_id = n.order_id
+            WHERE (n.order_date, n.product_id, n.order_quantity)
+                IS DISTINCT FROM (o.order_date, o.product_id, o.order_quantity)
+        ) d;
+    ELSE
+        PERFORM stock_flow_add(array_agg(order_date), array_agg(product_id),
+                               array_agg(0::bigint), array_agg(-order_quantity::bigint))
+        FROM old_rows;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS purchase_stock_flow_insert ON Purchase;
+CREATE TRIGGER purchase_stock_flow_insert
+    AFTER INSERT ON Purchase
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION purchase_stock_flow();
+
+DROP TRIGGER IF EXISTS purchase_stock_flow_update ON Purchase;
+CREATE TRIGGER purchase_stock_flow_update
+    AFTER UPDATE ON Purchase
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION purchase_stock_flow();
+
+DROP TRIGGER IF EXISTS purchase_stock_flow_delete ON Purchase;
+CREATE TRIGGER purchase_stock_flow_delete
+    AFTER DELETE ON Purchase
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION purchase_stock_flow();
+
+DROP TRIGGER IF EXISTS order_stock_flow_insert ON "Order";
+CREATE TRIGGER order_stock_flow_insert
+    AFTER INSERT ON "Order"
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION order_stock_flow();
+
+DROP TRIGGER IF EXISTS order_stock_flow_update ON "Order";
+CREATE TRIGGER order_stock_flow_update
+    AFTER UPDATE ON "Order"
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION order_stock_flow();
+
+DROP TRIGGER IF EXISTS order_stock_flow_delete ON "Order";
+CREATE TRIGGER order_stock_flow_delete
+    AFTER DELETE ON "Order"
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION order_stock_flow();
+
+-- A product changing type moves its history to the other type's rollup
+CREATE OR REPLACE FUNCTION product_stock_flow_retype() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO stock_flow_dirty_day (day)
+    SELECT day FROM stock_flow_daily
+    WHERE product_id = NEW.id AND day < CURRENT_DATE - 1
+    ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS product_stock_flow_retype ON Product;
+CREATE TRIGGER product_stock_flow_retype
+    AFTER UPDATE OF product_type ON Product
+    FOR EACH ROW
+    WHEN (OLD.product_type IS DISTINCT FROM NEW.product_type)
+    EXECUTE FUNCTION product_stock_flow_retype();
+
+-- Backfill from existing history; the type rollup is built by the first
+-- job run and read from stock_flow_daily until then
+INSERT INTO stock_flow_daily (product_id, day, stock_in, stock_out)
+SELECT product_id, day, SUM(stock_in), SUM(stock_out)
+FROM (
+    SELECT product_id, purchase_date AS day, purchase_quantity::bigint AS stock_in, 0::bigint AS stock_out
+    FROM Purchase
+    UNION ALL
+    SELECT product_id, order_date, 0, order_quantity
+    FROM "Order"
+) flow
+WHERE day IS NOT NULL
+GROUP BY product_id, day
+ON CONFLICT (product_id, day) DO NOTHING;
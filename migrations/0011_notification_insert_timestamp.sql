@@ -0,0 +1,20 @@
+-- Stamp updated_at with the statement's wall-clock time on INSERT too. The
+-- column default is the transaction start, so rows inserted late in a long
+-- transaction (an engine pass) could commit already older than the feed's
+-- overlap window and never be sent.
+CREATE OR REPLACE FUNCTION notification_set_updated_at() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        NEW.updated_at := clock_timestamp();
+    ELSIF ROW(NEW.message, NEW.type, NEW.is_read, NEW.ignored)
+          IS DISTINCT FROM ROW(OLD.message, OLD.type, OLD.is_read, OLD.ignored) THEN
+        NEW.updated_at := clock_timestamp();
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS notification_updated_at ON notification;
+CREATE TRIGGER notification_updated_at
+    BEFORE INSERT OR UPDATE ON notification
+    FOR EACH ROW EXECUTE FUNCTION notification_set_updated_at();
@@ -0,0 +1,7 @@
+-- purchase_date and order_date are nullable, and a NULL sort key never
+-- satisfies the keyset row comparison. The list pages sort on the date with
+-- NULLs folded to 0001-01-01; these indexes serve that expression.
+CREATE INDEX IF NOT EXISTS purchase_page_date_idx
+    ON Purchase ((COALESCE(purchase_date, DATE '0001-01-01')), id);
+CREATE INDEX IF NOT EXISTS order_page_date_idx
+    ON "Order" ((COALESCE(order_date, DATE '0001-01-01')), order_id);
@@ -0,0 +1,66 @@
+-- Record what remaining_quantity actually did rather than what was asked
+-- for. An order delete whose batch could not be restored, an edit the
+-- counter didn't follow in full, or rows removed behind the routes' backs
+-- all left stock in the ledger that no longer existed. Every movement now
+-- comes from the Purchase row's remaining_quantity, old against new.
+CREATE OR REPLACE FUNCTION purchase_ledger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT product_id, batch_number, remaining_quantity, 'purchase', id
+        FROM new_rows
+        WHERE remaining_quantity <> 0;
+    ELSIF TG_OP = 'UPDATE' THEN
+        -- Orders change remaining_quantity only: those are 'stock-out'
+        -- movements against the batch, edits of the batch 'purchase-edit'
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT n.product_id, n.batch_number, n.remaining_quantity - o.remaining_quantity,
+               CASE WHEN n.purchase_quantity <> o.purchase_quantity THEN 'purchase-edit' ELSE 'stock-out' END,
+               n.id
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE (n.product_id, n.batch_number) = (o.product_id, o.batch_number)
+            AND n.remaining_quantity <> o.remaining_quantity
+        UNION ALL
+        SELECT o.product_id, o.batch_number, -o.remaining_quantity, 'purchase-edit', o.id
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE (n.product_id, n.batch_number) <> (o.product_id, o.batch_number)
+            AND o.remaining_quantity <> 0
+        UNION ALL
+        SELECT n.product_id, n.batch_number, n.remaining_quantity, 'purchase-edit', n.id
+        FROM new_rows n JOIN old_rows o ON o.id = n.id
+        WHERE (n.product_id, n.batch_number) <> (o.product_id, o.batch_number)
+            AND n.remaining_quantity <> 0;
+    ELSE
+        -- A deleted batch writes off whatever it still held
+        INSERT INTO stock_movement (product_id, batch_number, quantity, source, source_id)
+        SELECT product_id, batch_number, -remaining_quantity, 'purchase-delete', id
+        FROM old_rows
+        WHERE remaining_quantity <> 0;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- Order writes reach the ledger through the batch they draw on
+DROP TRIGGER IF EXISTS order_ledger_insert ON "Order";
+DROP TRIGGER IF EXISTS order_ledger_update ON "Order";
+DROP TRIGGER IF EXISTS order_ledger_delete ON "Order";
+DROP FUNCTION IF EXISTS order_ledger();
+
+-- Bring the ledger back in line with the counters: one adjustment per
+-- batch whose movements don't add up to its remaining_quantity, including
+-- batches that have since been deleted
+INSERT INTO stock_movement (product_id, batch_number, quantity, source)
+SELECT COALESCE(b.product_id, l.product_id), COALESCE(b.batch_number, l.batch_number),
+       COALESCE(b.quantity, 0) - COALESCE(l.quantity, 0), 'adjustment'
+FROM (
+    SELECT product_id, batch_number, SUM(remaining_quantity) AS quantity
+    FROM Purchase
+    GROUP BY product_id, batch_number
+) b
+FULL JOIN (
+    SELECT product_id, batch_number, SUM(quantity) AS quantity
+    FROM stock_movement
+    GROUP BY product_id, batch_number
+) l ON l.product_id = b.product_id AND l.batch_number = b.batch_number
+WHERE COALESCE(b.quantity, 0) <> COALESCE(l.quantity, 0);
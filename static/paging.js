@@ -0,0 +1,48 @@
+// Server-side paging for the list tables. Rows are filtered, sorted and
+// rendered by /api/<list>?format=html; the page only asks for the next
+// page when "Load more" is clicked.
+function pagedTable({ url, tbody, moreButton, params, next }) {
+  let cursor = next || null;
+  let seq = 0;
+  let timer = null;
+
+  function showMore() {
+    moreButton.style.display = cursor ? '' : 'none';
+  }
+
+  async function load(append) {
+    const query = new URLSearchParams({ format: 'html' });
+    Object.entries(params()).forEach(([key, value]) => {
+      if (value) query.set(key, value);
+    });
+    if (append && cursor) query.set('cursor', cursor);
+
+    // Ignore responses to requests superseded by newer filters
+    const mine = ++seq;
+    const res = await fetch(`${url}?${query}`);
+    const data = await res.json();
+    if (mine !== seq) return;
+    if (!data.success) {
+      alert(data.message);
+      return;
+    }
+
+    if (append) {
+      tbody.insertAdjacentHTML('beforeend', data.html);
+    } else {
+      tbody.innerHTML = data.html;
+    }
+    cursor = data.next;
+    showMore();
+  }
+
+  moreButton.addEventListener('click', () => load(true));
+  showMore();
+
+  return {
+    reload() {
+      clearTimeout(timer);
+      timer = setTimeout(() => load(false), 250);
+    }
+  };
+}